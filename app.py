@@ -22,7 +22,9 @@ import batch
 import gdrive
 import gpt
 import llama
+import neo
 import parse
+import resolve
 import save
 import search
 import simon_client
@@ -109,6 +111,45 @@ async def raw_parse():
     text = post.get("text")
     model = gpt.sanitize_gpt_model_choice(post.get("model"))
     prompt_override = post.get("prompt_override", None)
+    # Merge chunk results into one locally rather than returning one result per chunk
+    merge_results = bool(post.get("merge", False))
+
+    stream_format = post.get("stream", None)
+    if stream_format in parse.STREAM_FORMATS:
+        content_type = (
+            "text/event-stream" if stream_format == "sse" else "application/x-ndjson"
+        )
+        response = await make_response(
+            parse.async_parse_streaming(
+                text,
+                model=model,
+                prompt_override=prompt_override,
+                stream_format=stream_format,
+                stream_entities=bool(post.get("stream_entities", False)),
+                merge_results=merge_results,
+            ),
+            {
+                "Content-Type": content_type,
+                "Cache-Control": "no-cache",
+                "Transfer-Encoding": "chunked",
+            },
+        )
+        response.timeout = None
+        return response
+
+    if merge_results:
+
+        async def parse_and_merge():
+            merged = await parse.async_parse_and_merge(
+                text, model=model, prompt_override=prompt_override
+            )
+            # Same shape as the unmerged response, with the merged result as its only entry
+            return {"translation": [merged]}
+
+        return await utils.make_response_with_heartbeat(
+            parse_and_merge(), log_label="parse and merge"
+        )
+
     response = await make_response(
         parse.async_parse_with_heartbeat(
             text, model=model, prompt_override=prompt_override
@@ -148,12 +189,18 @@ async def save_to_neo():
             {"status": "error", "message": "data provided not valid JSON"}
         ), 400
 
-    log_msg("Saving input text to S3...")
-    saved_input_uri = save.save_input_text_to_s3(post["input_text"])
+    log_msg("Saving input text...")
+    saved_input_uri = save.save_input_text(
+        post["input_text"], base_uri=app.config.get("WEB_SUBMISSIONS_URI")
+    )
 
     log_msg("Saving data to Neo4j...")
     save.save_data_to_neo4j(
-        data, source_uri=saved_input_uri, neo_config=app.config.get("neo4j_config")
+        data,
+        source_uri=saved_input_uri,
+        neo_config=app.config.get("neo4j"),
+        bulk=post.get("bulk_write", False),
+        bulk_batch_size=post.get("bulk_batch_size", neo.DEFAULT_BULK_BATCH_SIZE),
     )
 
     return jsonify({"status": "success"})
@@ -182,6 +229,9 @@ async def new_batch_job():
         return jsonify({"status": "error", "message": "batch job already running"}), 400
 
     required_args = ["job_type", "data_source"]
+    if post is not None and post.get("job_type") == "parse" and "resume_uri" in post:
+        # Resumed parse jobs read their data source from the original job's args
+        required_args = ["job_type", "resume_uri"]
     if post is None or not all(arg in post for arg in required_args):
         return jsonify(_wrong_payload_response()), 400
 
@@ -294,9 +344,14 @@ async def doc_search():
 
     query = post.get("query")
     papers_dir = app.search_config["papers_dir"]
-    metadata_file = app.search_config["metadata_file"]
+    metadata_store = app.search_config["metadata_store"]
     return await utils.make_response_with_heartbeat(
-        search.asearch_docs(query, papers_dir=papers_dir, metadata_file=metadata_file),
+        search.asearch_docs(
+            query,
+            papers_dir=papers_dir,
+            metadata_store=metadata_store,
+            search_index=app.search_config["search_index"],
+        ),
         log_label="Doc search",
     )
 
@@ -321,7 +376,11 @@ async def make_new_doc_set():
         )
 
     return await utils.make_response_with_heartbeat(
-        search.aupload_batch_set(files, gdrive_creds=gdrive_creds),
+        search.aupload_batch_set(
+            files,
+            gdrive_creds=gdrive_creds,
+            base_dir=app.config.get("BATCH_SET_BASE_URI") or search.DEFAULT_BATCH_SET_BASE_URI,
+        ),
         log_label="Upload new batch set",
     )
 
@@ -527,6 +586,41 @@ async def openai_setup():
     gpt.init_module(app.config)
 
 
+@app.after_serving
+async def chunk_sizing_teardown():
+    # The profile is only saved every so many observations, so keep the ones made since the last save
+    await asyncio.to_thread(gpt.get_chunk_sizing_profile().save)
+
+
+@app.before_serving
+async def conversion_cache_setup():
+    batch.init_conversion_cache(app.config)
+
+
+@app.before_serving
+async def entity_resolution_setup():
+    resolve.init_entity_resolution(app.config)
+
+
+@app.before_serving
+async def neo_setup():
+    neo_config = app.config.get("neo4j", {})
+    if not neo_config.get("uri"):
+        log_msg("NEO_URI not configured, saving to Neo4j will not be available")
+        return
+    # Connect eagerly so the first save doesn't pay for the handshake
+    driver = await asyncio.to_thread(neo.get_shared_neo4j_driver, neo_config)
+    try:
+        await asyncio.to_thread(driver.verify_connectivity)
+    except Exception as err:
+        log_msg(f"Could not connect to Neo4j at startup ({err}); will retry on first save")
+
+
+@app.after_serving
+async def neo_teardown():
+    neo.close_shared_neo4j_drivers()
+
+
 @app.before_serving
 async def batch_job_setup():
     batch.setup_status_file()
@@ -551,20 +645,41 @@ async def search_setup():
         log_msg("PAPERS_DIR not configured, /search will not be available")
         return
 
-    # Walk papers_dir and count all .txt files
-    # Only do this once, at server startup, because it may be slow for very large numbers of files
-    log_msg(f"Counting papers in {papers_dir} that will be available for /search...")
-    paper_count = 0
-    for _, _, files in os.walk(papers_dir):
-        paper_count += len(
-            [file for file in files if os.path.splitext(file)[1] == ".txt"]
-        )
+    search_index = await asyncio.to_thread(
+        search.open_search_index, app.config.get("SEARCH_INDEX_FILE", None), papers_dir
+    )
+    if search_index:
+        paper_count = await asyncio.to_thread(search_index.doc_count)
+    else:
+        log_msg("No search index available, /search will fall back to grep")
+        # Walk papers_dir and count all .txt files
+        # Only do this once, at server startup, because it may be slow for very large numbers of files
+        log_msg(f"Counting papers in {papers_dir} that will be available for /search...")
+        paper_count = 0
+        for _, _, files in os.walk(papers_dir):
+            paper_count += len(
+                [file for file in files if os.path.splitext(file)[1] == ".txt"]
+            )
     log_msg(f"{paper_count:,} papers found!")
 
+    metadata_file = app.config.get("PAPERS_METADATA_FILE", None)
+    metadata_store = None
+    if metadata_file:
+        try:
+            metadata_store = await asyncio.to_thread(
+                search.open_metadata_store, metadata_file
+            )
+        except Exception as err:
+            log_msg(
+                f"Unable to load paper metadata from {metadata_file}, search results won't include it: {err}"
+            )
+
     app.search_config = {
         "papers_dir": papers_dir,
         "paper_count": paper_count,
-        "metadata_file": app.config.get("PAPERS_METADATA_FILE", None),
+        "metadata_file": metadata_file,
+        "metadata_store": metadata_store,
+        "search_index": search_index,
     }
     log_msg(f"Search config: {app.search_config}")
 
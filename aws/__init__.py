@@ -1,5 +1,6 @@
-
 from .common import *
 from .read import *
 from .write import *
 from .uri import *
+from .storage import *
+from .aio import *
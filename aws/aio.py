@@ -0,0 +1,166 @@
+'''
+Async wrappers around the blocking storage helpers in aws.storage.
+
+Each kind of operation runs on its own bounded thread pool, which both keeps storage calls off the event loop and caps
+how many of that kind can be in flight at once. Pools aren't tied to an event loop, so they can be shared by the web
+server and batch job threads.
+'''
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+import functools
+import threading
+
+from .storage import (
+    copy_object,
+    create_output_dir_for_job,
+    create_output_dir_for_file,
+    get_objects_at_uri,
+    list_dir_page,
+    read_bytes,
+    read_file,
+    upload_file,
+    write_file,
+)
+from .uri import normalize_uri
+
+
+# Max concurrent operations of each kind, per process. Reads and writes together stay within the S3 client's
+# connection pool (see DEFAULT_MAX_POOL_CONNECTIONS), which is also plenty to keep a local disk busy.
+STORAGE_CONCURRENCY_LIMITS = {
+    'read': 24,
+    'write': 24,
+    'list': 16,
+    'upload': 4,
+}
+
+_executors = {}
+_executors_lock = threading.Lock()
+
+
+def _get_executor(op):
+    with _executors_lock:
+        executor = _executors.get(op)
+        if executor is None:
+            executor = ThreadPoolExecutor(
+                max_workers=STORAGE_CONCURRENCY_LIMITS[op], thread_name_prefix=f'storage-{op}')
+            _executors[op] = executor
+        return executor
+
+
+async def _run_storage_op(op, fn, *args, **kwargs):
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_get_executor(op), functools.partial(fn, *args, **kwargs))
+
+
+async def aget_objects_at_uri(uri):
+    return await _run_storage_op('list', get_objects_at_uri, uri)
+
+
+async def _awalk_dir_pages(uri):
+    '''
+    List every object under a storage URI, yielding (dir URI, objects, is_last_page) for each listing page as it
+    arrives.
+
+    Pages of a directory are fetched in order by following continuation tokens, while subdirectories found along the
+    way are listed concurrently (bounded by the 'list' concurrency limit).
+    '''
+    root_uri = normalize_uri(uri)
+    if not root_uri:
+        raise Exception(f'Invalid storage URI: {uri}')
+
+    pages = asyncio.Queue()
+    walk_tasks = set()
+    walk_done = object()
+
+    async def walk_dir(dir_uri):
+        try:
+            continuation_token = None
+            while True:
+                objects, subdir_uris, continuation_token = await _run_storage_op(
+                    'list', list_dir_page, dir_uri, continuation_token)
+                for subdir_uri in subdir_uris:
+                    start_walk(subdir_uri)
+                pages.put_nowait((dir_uri, objects, not continuation_token))
+                if not continuation_token:
+                    break
+        except Exception as err:
+            pages.put_nowait(err)
+        finally:
+            pages.put_nowait(walk_done)
+
+    # Number of directories being walked. Subdirectory walks are started before their parent reports done, so this
+    # only reaches zero once the whole tree has been listed.
+    walks_running = 0
+
+    def start_walk(dir_uri):
+        nonlocal walks_running
+        walks_running += 1
+        task = asyncio.create_task(walk_dir(dir_uri))
+        walk_tasks.add(task)
+        task.add_done_callback(walk_tasks.discard)
+
+    start_walk(root_uri)
+    try:
+        while walks_running:
+            item = await pages.get()
+            if item is walk_done:
+                walks_running -= 1
+                continue
+            if isinstance(item, Exception):
+                raise item
+            yield item
+    finally:
+        for task in walk_tasks:
+            task.cancel()
+
+
+async def aiter_objects_at_uri(uri):
+    '''
+    Async iterator over every object under a storage URI (recursively), yielding ObjectInfo as soon as each listing
+    page comes back so callers can start work before the listing finishes.
+    '''
+    async for _, objects, _ in _awalk_dir_pages(uri):
+        for obj in objects:
+            yield obj
+
+
+async def aiter_folders_at_uri(uri):
+    '''
+    Async iterator over the folders under a storage URI, yielding (folder name, list of object URIs) as soon as each
+    folder has been fully listed. The folder name is its path relative to uri, or '/' for objects directly under it.
+    '''
+    root_uri = normalize_uri(uri)
+    folder_objects = {}
+    async for dir_uri, objects, is_last_page in _awalk_dir_pages(root_uri):
+        folder_objects.setdefault(dir_uri, []).extend(obj.uri for obj in objects)
+        if is_last_page:
+            folder_name = dir_uri[len(root_uri):].strip('/') or '/'
+            yield folder_name, folder_objects.pop(dir_uri)
+
+
+async def aread_file(uri):
+    return await _run_storage_op('read', read_file, uri)
+
+
+async def aread_bytes(uri):
+    return await _run_storage_op('read', read_bytes, uri)
+
+
+async def awrite_file(output_uri, data):
+    return await _run_storage_op('write', write_file, output_uri, data)
+
+
+async def acopy_object(source_uri, output_uri):
+    return await _run_storage_op('write', copy_object, source_uri, output_uri)
+
+
+async def aupload_file(output_uri, file_path):
+    return await _run_storage_op('upload', upload_file, output_uri, file_path)
+
+
+async def acreate_output_dir_for_job(data_source, output_uri, dry_run=False):
+    return await _run_storage_op('write', create_output_dir_for_job, data_source, output_uri, dry_run=dry_run)
+
+
+async def acreate_output_dir_for_file(output_uri, file_name, dry_run=False):
+    return await _run_storage_op('write', create_output_dir_for_file, output_uri, file_name, dry_run=dry_run)
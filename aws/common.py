@@ -1,6 +1,8 @@
 import os
+import threading
 
 import boto3
+from botocore.config import Config as BotoConfig
 
 import utils
 from utils import log_error
@@ -21,13 +23,22 @@ def check_for_env_vars(throw_if_missing=True):
             raise Exception('AWS credentials not found in environment!')
 
 
-def get_s3_client(cl_args=None):
+DEFAULT_MAX_POOL_CONNECTIONS = 50
+SAGEMAKER_REGION = 'us-east-1'
+
+_CREDENTIAL_KEYS = ('aws_access_key_id', 'aws_secret_access_key', 'aws_session_token')
+
+# (service name, credential key) -> client
+_clients = {}
+_clients_lock = threading.Lock()
+
+
+def _get_credential_kwargs(config):
     '''
-    Create an S3 client, optionally using credential overrides from the commandline.
+    Returns the boto3.client credential kwargs for an aws config dict, or {} when using an IAM role.
     '''
-    config = utils.load_config(cl_args=cl_args)['aws']
     if config.get('aws_use_iam_role'):
-        return boto3.client('s3')
+        return {}
 
     aws_access_key_id = config.get('aws_access_key_id')
     aws_secret_access_key = config.get('aws_secret_access_key')
@@ -38,24 +49,56 @@ def get_s3_client(cl_args=None):
         )
         raise Exception('AWS credentials not found')
 
-    return boto3.client('s3', **config)
+    return {key: config[key] for key in _CREDENTIAL_KEYS if config.get(key)}
 
 
-def get_sagemaker_client(cl_args=None):
+def _get_cached_client(service_name, cl_args=None, **client_kwargs):
     '''
-    Create an S3 client, optionally using credential overrides from the commandline.
+    Returns a shared client for the service, creating one if the credentials have changed since the last call.
+
+    boto3 clients are thread-safe, so one pooled client per service is shared across threads. Creating clients isn't,
+    so that's done under a lock.
     '''
     config = utils.load_config(cl_args=cl_args)['aws']
-    if config.get('aws_use_iam_role'):
-        return boto3.client('sagemaker-runtime', region_name='us-east-1')
+    credentials = _get_credential_kwargs(config)
+    max_pool_connections = int(config.get('max_pool_connections') or DEFAULT_MAX_POOL_CONNECTIONS)
+    client_key = (service_name, tuple(sorted(credentials.items())), max_pool_connections)
 
-    aws_access_key_id = config.get('aws_access_key_id')
-    aws_secret_access_key = config.get('aws_secret_access_key')
-    if not aws_access_key_id or not aws_secret_access_key:
-        log_error(
-            'AWS credentials not found! '
-            'AWS_SECRET_KEY_ID and AWS_SECRET_ACCESS_KEY must be provided in environment.'
+    with _clients_lock:
+        client = _clients.get(client_key)
+        if client is not None:
+            return client
+
+        # Credentials changed (or first use); drop clients made with the old ones
+        for stale_key in [key for key in _clients if key[0] == service_name]:
+            del _clients[stale_key]
+
+        client_config = BotoConfig(
+            max_pool_connections=max_pool_connections,
+            tcp_keepalive=True,
         )
-        raise Exception('AWS credentials not found')
+        client = boto3.client(service_name, config=client_config, **client_kwargs, **credentials)
+        _clients[client_key] = client
+        return client
+
+
+def clear_cached_clients():
+    '''
+    Forget all cached clients, so the next call to get_s3_client etc. creates new ones.
+    '''
+    with _clients_lock:
+        _clients.clear()
 
-    return boto3.client('sagemaker-runtime', region_name='us-east-1', **config)
+
+def get_s3_client(cl_args=None):
+    '''
+    Get the shared S3 client, optionally using credential overrides from the commandline.
+    '''
+    return _get_cached_client('s3', cl_args=cl_args)
+
+
+def get_sagemaker_client(cl_args=None):
+    '''
+    Get the shared SageMaker runtime client, optionally using credential overrides from the commandline.
+    '''
+    return _get_cached_client('sagemaker-runtime', cl_args=cl_args, region_name=SAGEMAKER_REGION)
@@ -2,14 +2,70 @@
 Utilities for accesing AWS services.
 """
 
+import codecs
+from collections import namedtuple
 import os
 
+from botocore.exceptions import ClientError
+
 from utils import log_msg
 
 from .common import get_s3_client
 from .uri import parse_s3_uri
 
 
+# Binary document formats that are converted to text rather than decoded
+DOCUMENT_FILE_EXTENSIONS = (".pdf", ".doc", ".docx", ".xls", ".xlsx", ".ppt", ".pptx")
+DEFAULT_READ_RANGE_SIZE = 4 * 1024 * 1024
+
+
+ObjectInfo = namedtuple("ObjectInfo", ["uri", "key", "size", "etag"])
+
+
+def list_s3_prefix_page(bucket_name, prefix, continuation_token=None):
+    """
+    Fetch one page (up to 1000 keys) of the objects and subdirectories directly under a prefix.
+
+    Returns a tuple of (objects, subdirectory prefixes, next continuation token or None), skipping directory markers
+    and empty files.
+    """
+    list_args = {"Bucket": bucket_name, "Prefix": prefix, "Delimiter": "/"}
+    if continuation_token:
+        list_args["ContinuationToken"] = continuation_token
+    response = get_s3_client().list_objects_v2(**list_args)
+
+    objects = [
+        ObjectInfo(
+            uri=f"s3://{bucket_name}/{obj['Key']}",
+            key=obj["Key"],
+            size=obj["Size"],
+            etag=obj.get("ETag", "").strip('"'),
+        )
+        for obj in response.get("Contents", [])
+        if obj.get("Size", 0) > 0
+    ]
+    subdir_prefixes = [subdir["Prefix"] for subdir in response.get("CommonPrefixes", [])]
+    next_token = response.get("NextContinuationToken") if response.get("IsTruncated") else None
+    return objects, subdir_prefixes, next_token
+
+
+def _list_s3_prefix(bucket_name, prefix):
+    """
+    List everything directly under a prefix, following continuation tokens past the 1000 key page limit.
+    """
+    objects = []
+    subdir_prefixes = []
+    continuation_token = None
+    while True:
+        page_objects, page_subdirs, continuation_token = list_s3_prefix_page(
+            bucket_name, prefix, continuation_token
+        )
+        objects.extend(page_objects)
+        subdir_prefixes.extend(page_subdirs)
+        if not continuation_token:
+            return objects, subdir_prefixes
+
+
 def get_objects_at_s3_uri(uri):
     """
     Given an S3 URI, return a list of objects at that location.
@@ -17,24 +73,14 @@ def get_objects_at_s3_uri(uri):
     bucket_name, path = parse_s3_uri(uri)
     if not bucket_name:
         raise Exception(f"Invalid S3 URI: {uri}")
-    s3_client = get_s3_client()
-    response = s3_client.list_objects_v2(Bucket=bucket_name, Prefix=path, Delimiter="/")
+    contents, subdir_prefixes = _list_s3_prefix(bucket_name, path)
+    objects = [obj.uri for obj in contents]
 
-    # if 'Contents' not in response and 'CommonPrefixes' not in response:
-    # raise Exception('No objects found at {uri}')
-
-    contents = response.get("Contents", [])
-    # Filter out directories and empty files
-    contents = [obj for obj in contents if obj.get("Size", 0) > 0]
-    objects = [f"s3://{bucket_name}/{obj['Key']}" for obj in contents]
-
-    if "CommonPrefixes" in response:
-        # This is a directory with subdirectories
-        # Grab all the objects in the subdirectories and return those too
-        subdirectories = response["CommonPrefixes"]
-        for subdir in subdirectories:
-            subdir_uri = f"s3://{bucket_name}/{subdir['Prefix']}"
-            objects.extend(get_objects_at_s3_uri(subdir_uri))
+    # This is a directory with subdirectories
+    # Grab all the objects in the subdirectories and return those too
+    for subdir_prefix in subdir_prefixes:
+        subdir_uri = f"s3://{bucket_name}/{subdir_prefix}"
+        objects.extend(get_objects_at_s3_uri(subdir_uri))
 
     return objects
 
@@ -51,27 +97,19 @@ def get_objects_by_folder_at_s3_uri(uri):
     bucket_name, path = parse_s3_uri(uri)
     if not bucket_name:
         raise Exception(f"Invalid S3 URI: {uri}")
-    s3_client = get_s3_client()
-    response = s3_client.list_objects_v2(Bucket=bucket_name, Prefix=path, Delimiter="/")
-
-    contents = response.get("Contents", [])
-    # Filter out directories and empty files
-    contents = [obj for obj in contents if obj.get("Size", 0) > 0]
-    objects = {"/": [f"s3://{bucket_name}/{obj['Key']}" for obj in contents]}
-
-    if "CommonPrefixes" in response:
-        # This is a directory with subdirectories
-        # Grab all the objects in the subdirectories and return those too
-        subdirectories = response["CommonPrefixes"]
-        for subdir in subdirectories:
-            subdir_path = subdir["Prefix"]
-            subdir_name = __get_dir_name(subdir_path)
-            subdir_uri = f"s3://{bucket_name}/{subdir_path}"
-            subdir_objects = get_objects_by_folder_at_s3_uri(subdir_uri)
-            objects[subdir_name] = subdir_objects.pop("/")
-            while len(subdir_objects) > 0:
-                nested_subdir_name, nested_objects = subdir_objects.popitem()
-                objects[f"{subdir_name}/{nested_subdir_name}"] = nested_objects
+    contents, subdir_prefixes = _list_s3_prefix(bucket_name, path)
+    objects = {"/": [obj.uri for obj in contents]}
+
+    # This is a directory with subdirectories
+    # Grab all the objects in the subdirectories and return those too
+    for subdir_path in subdir_prefixes:
+        subdir_name = __get_dir_name(subdir_path)
+        subdir_uri = f"s3://{bucket_name}/{subdir_path}"
+        subdir_objects = get_objects_by_folder_at_s3_uri(subdir_uri)
+        objects[subdir_name] = subdir_objects.pop("/")
+        while len(subdir_objects) > 0:
+            nested_subdir_name, nested_objects = subdir_objects.popitem()
+            objects[f"{subdir_name}/{nested_subdir_name}"] = nested_objects
 
     return objects
 
@@ -89,14 +127,66 @@ def read_file_from_s3(uri):
     response = s3_client.get_object(Bucket=bucket, Key=path)
     file_data = response["Body"].read()
 
+    return file_name, decode_file_data(file_name, file_data)
+
+
+def decode_file_data(file_name, file_data):
+    """
+    Decode the raw bytes of a file as UTF-8 text, unless it's a binary document format or can't be decoded.
+    """
     # Try to decode as text if it's not a binary file
-    if not file_name.lower().endswith(
-        (".pdf", ".doc", ".docx", ".xls", ".xlsx", ".ppt", ".pptx")
-    ):
+    if not file_name.lower().endswith(DOCUMENT_FILE_EXTENSIONS):
         try:
             file_data = file_data.decode("utf-8")
         except UnicodeDecodeError:
             # If we can't decode it, return the raw bytes
             pass
 
-    return file_name, file_data
+    return file_data
+
+
+def read_bytes_from_s3(uri):
+    """
+    Read a file from S3 and return its raw bytes.
+    """
+    bucket, path = parse_s3_uri(uri)
+    response = get_s3_client().get_object(Bucket=bucket, Key=path)
+    return response["Body"].read()
+
+
+def iter_text_from_s3(uri, range_size=DEFAULT_READ_RANGE_SIZE):
+    """
+    Read a UTF-8 text file from S3 in ranged requests, yielding decoded text as each range arrives.
+
+    Multi-byte characters split across ranges are decoded correctly, and only one range is held in memory at a time.
+    Raises UnicodeDecodeError if the file isn't valid UTF-8, or an error if the object changes partway through.
+    """
+    bucket, path = parse_s3_uri(uri)
+    s3_client = get_s3_client()
+    decoder = codecs.getincrementaldecoder("utf-8")()
+
+    offset = 0
+    etag = None
+    while True:
+        range_args = {"Range": f"bytes={offset}-{offset + range_size - 1}"}
+        if etag:
+            # Fail rather than stitch together pieces of two different versions of the object
+            range_args["IfMatch"] = etag
+        try:
+            response = s3_client.get_object(Bucket=bucket, Key=path, **range_args)
+        except ClientError as err:
+            if offset == 0 and err.response.get("Error", {}).get("Code") == "InvalidRange":
+                # Ranged reads of an empty object are rejected
+                return
+            raise
+        etag = response.get("ETag")
+        data = response["Body"].read()
+        total_size = int(response["ContentRange"].rsplit("/", 1)[1])
+        offset += len(data)
+
+        is_last_range = offset >= total_size or not data
+        text = decoder.decode(data, final=is_last_range)
+        if text:
+            yield text
+        if is_last_range:
+            return
@@ -0,0 +1,369 @@
+'''
+Storage backends behind a single URI-based API, so batch jobs can read and write S3, the local filesystem or memory.
+
+s3:// URIs (and S3 HTTPS URLs) go to S3, file:// URIs and bare local paths go to the local filesystem and memory://
+URIs go to a process-wide in-memory store, which is mostly useful for benchmarks and trying things out offline.
+'''
+import codecs
+from datetime import datetime
+import os
+import shutil
+import tempfile
+import threading
+
+from utils import log_msg
+
+from .read import (
+    DEFAULT_READ_RANGE_SIZE,
+    ObjectInfo,
+    decode_file_data,
+    iter_text_from_s3,
+    list_s3_prefix_page,
+    read_bytes_from_s3,
+)
+from .uri import (
+    MEMORY_URI_PREFIX,
+    is_file_uri,
+    is_memory_uri,
+    is_valid_s3_uri,
+    normalize_uri,
+    parse_file_uri,
+    parse_s3_uri,
+)
+from .write import copy_s3_object, create_s3_folder, upload_to_s3, write_to_s3_file
+
+
+class Storage:
+    '''
+    Base class for storage backends. All methods take normalized URIs (see aws.normalize_uri).
+
+    Subclasses implement listing, reading and writing; copying, uploading and streaming text fall back to those.
+    '''
+
+    def list_dir_page(self, dir_uri, continuation_token=None):
+        '''
+        Fetch one page of the objects and subdirectories directly under a directory URI.
+
+        Returns a tuple of (list of ObjectInfo, subdirectory URIs, next continuation token or None), skipping empty files.
+        '''
+        raise NotImplementedError
+
+    def read_bytes(self, uri):
+        raise NotImplementedError
+
+    def write(self, uri, data):
+        raise NotImplementedError
+
+    def make_dir(self, dir_uri):
+        '''
+        Create a directory for output, if the backend needs one to exist before writing to it.
+        '''
+        pass
+
+    def copy(self, source_uri, output_uri):
+        self.write(output_uri, self.read_bytes(source_uri))
+
+    def upload_file(self, output_uri, file_path):
+        with open(file_path, 'rb') as f:
+            self.write(output_uri, f.read())
+
+    def iter_text(self, uri, range_size=DEFAULT_READ_RANGE_SIZE):
+        '''
+        Yield the UTF-8 text of a file in pieces. Raises UnicodeDecodeError if the file isn't valid UTF-8.
+        '''
+        text = self.read_bytes(uri).decode('utf-8')
+        if text:
+            yield text
+
+
+class S3Storage(Storage):
+    def list_dir_page(self, dir_uri, continuation_token=None):
+        bucket_name, prefix = parse_s3_uri(dir_uri)
+        objects, subdir_prefixes, next_token = list_s3_prefix_page(bucket_name, prefix, continuation_token)
+        subdir_uris = [f's3://{bucket_name}/{subdir_prefix}' for subdir_prefix in subdir_prefixes]
+        return objects, subdir_uris, next_token
+
+    def read_bytes(self, uri):
+        return read_bytes_from_s3(uri)
+
+    def write(self, uri, data):
+        write_to_s3_file(uri, data)
+
+    def make_dir(self, dir_uri):
+        create_s3_folder(dir_uri)
+
+    def copy(self, source_uri, output_uri):
+        # Copied within S3 without downloading the object
+        copy_s3_object(source_uri, output_uri)
+
+    def upload_file(self, output_uri, file_path):
+        upload_to_s3(output_uri, file_path)
+
+    def iter_text(self, uri, range_size=DEFAULT_READ_RANGE_SIZE):
+        return iter_text_from_s3(uri, range_size=range_size)
+
+
+class LocalStorage(Storage):
+    '''
+    Storage on the local filesystem, addressed by file:// URIs.
+
+    Writes go to a temporary file that's renamed into place, so a crash never leaves a half-written manifest or bundle
+    behind. Dotfiles (including those temporary files) are left out of listings.
+    '''
+
+    def list_dir_page(self, dir_uri, continuation_token=None):
+        path = parse_file_uri(dir_uri)
+        if os.path.isfile(path):
+            info = self._object_info(dir_uri, path)
+            return ([info] if info.size > 0 else []), [], None
+        if not os.path.isdir(path):
+            return [], [], None
+
+        dir_uri = dir_uri.rstrip('/') + '/'
+        objects = []
+        subdir_uris = []
+        with os.scandir(path) as entries:
+            for entry in sorted(entries, key=lambda entry: entry.name):
+                if entry.name.startswith('.'):
+                    continue
+                if entry.is_dir():
+                    subdir_uris.append(f'{dir_uri}{entry.name}/')
+                elif entry.is_file():
+                    info = self._object_info(f'{dir_uri}{entry.name}', entry.path)
+                    if info.size > 0:
+                        objects.append(info)
+        return objects, subdir_uris, None
+
+    @staticmethod
+    def _object_info(uri, path):
+        stat = os.stat(path)
+        return ObjectInfo(uri=uri, key=path, size=stat.st_size, etag=f'{stat.st_mtime_ns:x}-{stat.st_size:x}')
+
+    def read_bytes(self, uri):
+        with open(parse_file_uri(uri), 'rb') as f:
+            return f.read()
+
+    def write(self, uri, data):
+        path = parse_file_uri(uri)
+        if isinstance(data, str):
+            data = data.encode('utf-8')
+        dir_path, file_name = os.path.split(path)
+        os.makedirs(dir_path, exist_ok=True)
+        with tempfile.NamedTemporaryFile(dir=dir_path, prefix=f'.{file_name}.', suffix='.tmp', delete=False) as f:
+            f.write(data)
+            temp_path = f.name
+        try:
+            os.replace(temp_path, path)
+        except Exception:
+            os.unlink(temp_path)
+            raise
+
+    def make_dir(self, dir_uri):
+        os.makedirs(parse_file_uri(dir_uri), exist_ok=True)
+
+    def copy(self, source_uri, output_uri):
+        output_path = parse_file_uri(output_uri)
+        os.makedirs(os.path.dirname(output_path), exist_ok=True)
+        shutil.copyfile(parse_file_uri(source_uri), output_path)
+
+    def upload_file(self, output_uri, file_path):
+        output_path = parse_file_uri(output_uri)
+        os.makedirs(os.path.dirname(output_path), exist_ok=True)
+        shutil.copyfile(file_path, output_path)
+
+    def iter_text(self, uri, range_size=DEFAULT_READ_RANGE_SIZE):
+        decoder = codecs.getincrementaldecoder('utf-8')()
+        with open(parse_file_uri(uri), 'rb') as f:
+            while True:
+                data = f.read(range_size)
+                text = decoder.decode(data, final=not data)
+                if text:
+                    yield text
+                if not data:
+                    return
+
+
+class MemoryStorage(Storage):
+    '''
+    Process-wide in-memory storage addressed by memory:// URIs, listed with the same prefix semantics as S3.
+    '''
+
+    def __init__(self):
+        self._objects = {}
+        self._lock = threading.Lock()
+
+    def list_dir_page(self, dir_uri, continuation_token=None):
+        with self._lock:
+            items = sorted((uri, len(data)) for uri, data in self._objects.items() if uri.startswith(dir_uri))
+        objects = []
+        subdir_uris = []
+        for uri, size in items:
+            rest = uri[len(dir_uri):]
+            if '/' in rest:
+                subdir_uri = dir_uri + rest.split('/', 1)[0] + '/'
+                if not subdir_uris or subdir_uris[-1] != subdir_uri:
+                    subdir_uris.append(subdir_uri)
+            elif size > 0:
+                objects.append(ObjectInfo(uri=uri, key=uri[len(MEMORY_URI_PREFIX):], size=size, etag=''))
+        return objects, subdir_uris, None
+
+    def read_bytes(self, uri):
+        with self._lock:
+            if uri not in self._objects:
+                raise FileNotFoundError(f'No object at {uri}')
+            return self._objects[uri]
+
+    def write(self, uri, data):
+        if isinstance(data, str):
+            data = data.encode('utf-8')
+        with self._lock:
+            self._objects[uri] = bytes(data)
+
+    def clear(self):
+        with self._lock:
+            self._objects.clear()
+
+
+_s3_storage = S3Storage()
+_local_storage = LocalStorage()
+_memory_storage = MemoryStorage()
+
+
+def get_storage(uri):
+    '''
+    Returns the storage backend for a URI and the normalized form of the URI that backend expects.
+    '''
+    normalized_uri = normalize_uri(uri)
+    if normalized_uri is None:
+        raise ValueError(f'Unsupported storage URI: {uri}')
+    if is_valid_s3_uri(normalized_uri):
+        return _s3_storage, normalized_uri
+    if is_file_uri(normalized_uri):
+        return _local_storage, normalized_uri
+    if is_memory_uri(normalized_uri):
+        return _memory_storage, normalized_uri
+    raise ValueError(f'Unsupported storage URI: {uri}')
+
+
+def get_memory_storage():
+    '''
+    Returns the process-wide in-memory storage, e.g. for benchmarks to seed or clear.
+    '''
+    return _memory_storage
+
+
+def list_dir_page(dir_uri, continuation_token=None):
+    storage, dir_uri = get_storage(dir_uri)
+    return storage.list_dir_page(dir_uri, continuation_token=continuation_token)
+
+
+def _list_dir(dir_uri):
+    '''
+    List everything directly under a directory, following continuation tokens past any page limit.
+    '''
+    objects = []
+    subdir_uris = []
+    continuation_token = None
+    while True:
+        page_objects, page_subdirs, continuation_token = list_dir_page(dir_uri, continuation_token)
+        objects.extend(page_objects)
+        subdir_uris.extend(page_subdirs)
+        if not continuation_token:
+            return objects, subdir_uris
+
+
+def get_objects_at_uri(uri):
+    '''
+    Given a storage URI, return a list of the URIs of all objects under it (recursively).
+    '''
+    contents, subdir_uris = _list_dir(uri)
+    objects = [obj.uri for obj in contents]
+    for subdir_uri in subdir_uris:
+        objects.extend(get_objects_at_uri(subdir_uri))
+    return objects
+
+
+def read_file(uri):
+    '''
+    Read a file and return its name and contents, decoded as UTF-8 text unless it's a binary file.
+    '''
+    storage, uri = get_storage(uri)
+    file_name = os.path.basename(uri)
+    return file_name, decode_file_data(file_name, storage.read_bytes(uri))
+
+
+def read_bytes(uri):
+    storage, uri = get_storage(uri)
+    return storage.read_bytes(uri)
+
+
+def iter_text(uri, range_size=DEFAULT_READ_RANGE_SIZE):
+    '''
+    Read a UTF-8 text file in pieces, yielding decoded text as each piece arrives.
+    '''
+    storage, uri = get_storage(uri)
+    return storage.iter_text(uri, range_size=range_size)
+
+
+def write_file(output_uri, data):
+    storage, output_uri = get_storage(output_uri)
+    storage.write(output_uri, data)
+
+
+def copy_object(source_uri, output_uri):
+    '''
+    Copy an object, without downloading it when both URIs are in the same backend and it supports that.
+    '''
+    source_storage, source_uri = get_storage(source_uri)
+    storage, output_uri = get_storage(output_uri)
+    if source_storage is storage:
+        storage.copy(source_uri, output_uri)
+    else:
+        storage.write(output_uri, source_storage.read_bytes(source_uri))
+
+
+def upload_file(output_uri, file_path):
+    '''
+    Store a local file at a storage URI.
+    '''
+    storage, output_uri = get_storage(output_uri)
+    storage.upload_file(output_uri, file_path)
+
+
+def _create_output_dir(dir_uri, description, dry_run=False):
+    if dry_run:
+        log_msg(f'Would have created a subdirectory for {description} at {dir_uri}')
+        return dir_uri
+
+    log_msg(f'Creating a subdirectory for {description} at {dir_uri}')
+    storage, dir_uri = get_storage(dir_uri)
+    storage.make_dir(dir_uri)
+    return dir_uri
+
+
+def create_output_dir_for_job(data_source, output_uri, dry_run=False):
+    '''
+    Create a subdirectory for output of this job at the given location and return its URI.
+    '''
+    timestamp = datetime.now().strftime('%Y-%m-%d_%H-%M-%S')
+
+    dir_name, base_name = os.path.split(normalize_uri(data_source))
+    # If our data source is a directory, base_name will be empty and we need to split again to get the directory name
+    input_dir_name = base_name if base_name else os.path.basename(dir_name)
+
+    output_dir_uri = f'{normalize_uri(output_uri).rstrip("/")}/{timestamp}-{input_dir_name}-output/'
+    return _create_output_dir(output_dir_uri, 'job output', dry_run=dry_run)
+
+
+def create_output_dir_for_file(output_uri, file_name, dry_run=False):
+    '''
+    Create a subdirectory for output of a specific file and return its URI.
+    '''
+    output_dir_uri = f'{normalize_uri(output_uri).rstrip("/")}/{file_name.strip("/")}/'
+    return _create_output_dir(output_dir_uri, f'parse output of {file_name}', dry_run=dry_run)
+
+
+def create_new_batch_set_dir(base_dir_uri):
+    timestamp = datetime.now().strftime('%Y-%m-%d_%H-%M-%S')
+    output_dir_uri = f'{normalize_uri(base_dir_uri).rstrip("/")}/{timestamp}-web-search-upload/'
+    return _create_output_dir(output_dir_uri, 'job output')
@@ -98,3 +98,73 @@ def source_uri_to_s3_and_http(uri):
     s3_uri = http_to_s3_uri(uri)
     http_uri = s3_uri_to_http(uri)
     return s3_uri, http_uri
+
+
+FILE_URI_PREFIX = 'file://'
+MEMORY_URI_PREFIX = 'memory://'
+
+
+def parse_file_uri(uri):
+    '''
+    Given a file:// URI, returns the local path it points to. Returns None otherwise.
+    '''
+    if not uri or not uri.startswith(FILE_URI_PREFIX):
+        return None
+    # Paths are kept as-is rather than percent-encoded, so just strip the scheme
+    return uri[len(FILE_URI_PREFIX):] or '/'
+
+
+def local_path_to_uri(path):
+    '''
+    Returns the file:// URI for a local path, keeping a trailing slash if it has one.
+    '''
+    abs_path = os.path.abspath(path)
+    if path.endswith('/') and abs_path != '/':
+        abs_path += '/'
+    return f'{FILE_URI_PREFIX}{abs_path}'
+
+
+def is_file_uri(uri):
+    return bool(uri) and uri.startswith(FILE_URI_PREFIX)
+
+
+def is_memory_uri(uri):
+    return bool(uri) and uri.startswith(MEMORY_URI_PREFIX)
+
+
+def normalize_uri(uri):
+    '''
+    Given a storage location of any supported form, returns its canonical URI. Returns None if it isn't recognized.
+
+    S3 URIs and URLs become s3:// URIs, file:// URIs and bare local paths become absolute file:// URIs and memory://
+    URIs are kept as they are.
+    '''
+    if not uri:
+        return None
+    if is_valid_s3_uri(uri):
+        return http_to_s3_uri(uri)
+    if is_file_uri(uri):
+        return local_path_to_uri(parse_file_uri(uri))
+    if is_memory_uri(uri):
+        return uri
+    if urlparse(uri).scheme:
+        # Some other scheme we don't have storage for
+        return None
+    return local_path_to_uri(uri)
+
+
+def is_valid_source_uri(uri):
+    '''
+    Returns whether the URI can be recorded as the source of graph data: an S3 object or a local or in-memory file.
+    '''
+    return is_valid_s3_uri(uri) or is_file_uri(uri) or is_memory_uri(uri)
+
+
+def source_uri_for_graph(uri):
+    '''
+    Returns the form of a source URI saved to the graph: HTTPS URLs for S3 objects, since they're easy to follow from
+    Neo4j, and the URI as-is otherwise.
+    '''
+    if is_valid_s3_uri(uri):
+        return s3_uri_to_http(uri)
+    return normalize_uri(uri)
@@ -2,6 +2,8 @@
 Code for running batch jobs.
 '''
 
+from .bundle import *
 from .common import *
+from .convert_cache import *
 from .parse import *
 from .save import *
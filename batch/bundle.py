@@ -0,0 +1,45 @@
+'''
+Bundled parse output: one gzipped JSONL object per input file, in place of a .json and .source.txt object per chunk.
+
+Each line is a record for one successfully parsed chunk:
+    {"chunk_index": 0, "source_start": 0, "source_end": 1234, "text_sha256": "...", "parse": {...}}
+where the offsets are character offsets of the chunk in the file's source.txt (after line endings are normalized).
+'''
+import gzip
+import hashlib
+
+from utils import json_codec
+
+
+BUNDLE_FILE_NAME = 'parse_output.jsonl.gz'
+
+OUTPUT_FORMAT_FILES = 'files'
+OUTPUT_FORMAT_BUNDLE = 'bundle'
+OUTPUT_FORMATS = (OUTPUT_FORMAT_FILES, OUTPUT_FORMAT_BUNDLE)
+
+
+def make_bundle_record(chunk_index, source_start, source_end, chunk_text, parse_output):
+    return {
+        'chunk_index': chunk_index,
+        'source_start': source_start,
+        'source_end': source_end,
+        'text_sha256': hashlib.sha256(chunk_text.encode('utf-8')).hexdigest(),
+        'parse': parse_output,
+    }
+
+
+def encode_bundle(records):
+    '''
+    Serialize bundle records, ordered by chunk index, as gzipped JSONL bytes.
+    '''
+    records = sorted(records, key=lambda record: record['chunk_index'])
+    lines = ''.join(json_codec.dumps(record) + '\n' for record in records)
+    return gzip.compress(lines.encode('utf-8'))
+
+
+def decode_bundle(data):
+    '''
+    Read bundle records from gzipped JSONL bytes.
+    '''
+    lines = gzip.decompress(data).decode('utf-8').splitlines()
+    return [json_codec.loads(line) for line in lines if line.strip()]
@@ -3,11 +3,13 @@ import os
 import threading
 
 import gpt
+import neo
 import utils
-from utils import log_msg
+from utils import doc_convert, log_msg
 
 from . import parse
 from . import save
+from .bundle import OUTPUT_FORMAT_FILES
 
 
 STATUS_FILE = '/tmp/p2g/p2g_batch_job_status.txt'
@@ -49,6 +51,8 @@ class BatchJobThread(threading.Thread):
                 log_msg('Cancel requested. Stopping batch job.')
                 work_task.cancel()
                 self.cancel()
+                # Let the job's cleanup (finally blocks) run before the loop is closed
+                await asyncio.gather(work_task, return_exceptions=True)
                 break
 
             await asyncio.sleep(self.interval)
@@ -97,16 +101,30 @@ def make_and_run_parse_job(job_args):
     gpt_model = gpt.sanitize_gpt_model_choice(job_args.get('model', 'any'))
     dry_run = job_args.get('dry_run', False)
     prompt = job_args.get('prompt', None)
+    max_open_files = job_args.get('max_open_files', parse.DEFAULT_MAX_OPEN_FILES)
+    output_format = job_args.get('output_format', OUTPUT_FORMAT_FILES)
+    conversion_workers = job_args.get('conversion_workers', doc_convert.DEFAULT_CONVERSION_WORKERS)
+    conversion_timeout = job_args.get('conversion_timeout', doc_convert.DEFAULT_CONVERSION_TIMEOUT)
+    stream_completions = job_args.get('stream_completions', False)
     parse_job = parse.BatchParseJob(
         gpt_model=gpt_model,
         dry_run=dry_run,
         prompt_override=prompt,
-        log_file=LOG_FILE
+        log_file=LOG_FILE,
+        max_open_files=max_open_files,
+        output_format=output_format,
+        conversion_workers=conversion_workers,
+        conversion_timeout=conversion_timeout,
+        stream_completions=stream_completions,
     )
 
-    data_source = job_args['data_source']
-    output_uri = job_args.get('output_uri', 's3://paper2graph-parse-results')
-    def work_fn(): return parse_job.run(data_source, output_uri)
+    resume_uri = job_args.get('resume_uri', None)
+    if resume_uri:
+        def work_fn(): return parse_job.resume(resume_uri)
+    else:
+        data_source = job_args['data_source']
+        output_uri = job_args.get('output_uri', 's3://paper2graph-parse-results')
+        def work_fn(): return parse_job.run(data_source, output_uri)
 
     utils.setup_logger(name=thread_name, log_file=LOG_FILE)
 
@@ -118,6 +136,9 @@ def make_and_run_save_job(job_args, neo_config):
     thread_name = utils.BATCH_SAVE_THREAD_NAME
 
     data_source = job_args['data_source']
+    server_neo_config = neo_config
+    # Copy so per-job credential overrides don't leak into the server's config
+    neo_config = dict(neo_config)
     if 'neo_uri' in job_args:
         neo_config['uri'] = job_args['neo_uri']
     if 'neo_user' in job_args:
@@ -125,7 +146,17 @@ def make_and_run_save_job(job_args, neo_config):
     if 'neo_pass' in job_args:
         neo_config['password'] = job_args['neo_pass']
 
-    def work_fn(): return save.save_to_neo4j(data_source, neo_config)
+    bulk_write = job_args.get('bulk_write', False)
+    bulk_batch_size = job_args.get('bulk_batch_size', neo.DEFAULT_BULK_BATCH_SIZE)
+
+    async def work_fn():
+        try:
+            await save.save_to_neo4j(
+                data_source, neo_config, bulk_write=bulk_write, bulk_batch_size=bulk_batch_size)
+        finally:
+            # A driver for overridden credentials is only used by this job, so don't keep its pool open until shutdown
+            if neo_config != server_neo_config:
+                neo.close_shared_neo4j_driver(neo_config)
 
     utils.setup_logger(name=thread_name, log_file=LOG_FILE)
 
@@ -0,0 +1,62 @@
+'''
+Cache of text converted from PDFs and Office documents, so re-runs of a batch job skip both the download and the
+conversion of documents that haven't changed.
+
+Entries are keyed by the converter version plus the object's URI and ETag when the listing gave one, or otherwise a
+hash of the document's bytes. They're stored with the same local SQLite and S3 backends as the parse cache.
+'''
+import hashlib
+import os
+
+import aws
+import gpt
+from utils import doc_convert, log_msg
+
+
+_conversion_cache = None
+
+
+def make_conversion_cache_key(file_uri, etag=None, data=None):
+    '''
+    Returns the cache key for a document's converted text, from its ETag if known or otherwise its raw bytes.
+    '''
+    hasher = hashlib.sha256()
+    if etag:
+        parts = (doc_convert.get_converter_version(), 'etag', file_uri, etag)
+    else:
+        # The converter is picked by file extension, so the same bytes under another extension can convert differently
+        extension = os.path.splitext(file_uri)[1].lower()
+        parts = (doc_convert.get_converter_version(), 'sha256', extension, hashlib.sha256(data).hexdigest())
+    for part in parts:
+        encoded = part.encode('utf-8')
+        # Length-prefix each part so different splits of the same bytes can't collide
+        hasher.update(str(len(encoded)).encode('utf-8') + b':' + encoded)
+    return hasher.hexdigest()
+
+
+def init_conversion_cache(config):
+    '''
+    Set up the process-wide conversion cache from CONVERSION_CACHE_URI / CONVERSION_CACHE_MAX_BYTES, if configured.
+
+    CONVERSION_CACHE_URI can be an s3:// prefix or a local path to a SQLite file.
+    '''
+    global _conversion_cache
+    cache_uri = config.get('CONVERSION_CACHE_URI', None)
+    if not cache_uri:
+        _conversion_cache = None
+        return None
+
+    max_bytes = int(config.get('CONVERSION_CACHE_MAX_BYTES', None) or gpt.DEFAULT_PARSE_CACHE_MAX_BYTES)
+    if aws.is_valid_s3_uri(cache_uri):
+        _conversion_cache = gpt.S3ParseCache(cache_uri, max_bytes=max_bytes, name='conversion cache')
+    else:
+        _conversion_cache = gpt.SqliteParseCache(cache_uri, max_bytes=max_bytes, name='conversion cache')
+    log_msg(f'Using conversion cache at {cache_uri} (max {max_bytes:,} bytes)')
+    return _conversion_cache
+
+
+def get_conversion_cache():
+    '''
+    Returns the process-wide conversion cache, or None if caching isn't configured.
+    '''
+    return _conversion_cache
@@ -0,0 +1,123 @@
+import asyncio
+import json
+import time
+
+import aws
+from utils import log_msg
+
+
+MANIFEST_FILE_NAME = 'manifest.json'
+# Minimum number of seconds between manifest writes, other than forced ones
+MANIFEST_SAVE_INTERVAL = 15
+
+
+class ParseJobManifest:
+    '''
+    Record of which input files and chunks a batch parse job has finished, stored beside job_args.json.
+
+    Chunk numbers match the output_N.json files written for each chunk (starting at 1).
+    '''
+
+    def __init__(self, job_output_uri, files=None, dry_run=False):
+        self.manifest_uri = f'{job_output_uri.rstrip("/")}/{MANIFEST_FILE_NAME}'
+        self.files = files or {}
+        self.dry_run = dry_run
+        self._last_saved = 0.0
+        self._dirty = False
+        # Serializes writes so an older snapshot can never land after a newer one
+        self._save_lock = asyncio.Lock()
+
+    @staticmethod
+    async def load(job_output_uri, dry_run=False):
+        manifest = ParseJobManifest(job_output_uri, dry_run=dry_run)
+        try:
+            _, data = await aws.aread_file(manifest.manifest_uri)
+        except Exception as err:
+            log_msg(f'No existing manifest loaded from {manifest.manifest_uri} ({err}). Treating all files as pending.')
+            return manifest
+        manifest.files = json.loads(data).get('files', {})
+        completed = len([uri for uri in manifest.files if manifest.is_file_complete(uri)])
+        log_msg(f'Loaded manifest with {completed} of {len(manifest.files)} recorded files complete')
+        return manifest
+
+    def get_file_entry(self, file_uri):
+        return self.files.get(file_uri)
+
+    def is_file_complete(self, file_uri):
+        entry = self.files.get(file_uri)
+        if not entry or entry.get('total_chunks') is None:
+            return False
+        return len(entry['completed_chunks']) >= entry['total_chunks']
+
+    def start_file(self, file_uri, file_output_uri):
+        '''
+        Record that a file is being parsed, returning the set of its chunk numbers already parsed successfully.
+        '''
+        entry = self.files.get(file_uri)
+        if not entry:
+            entry = {'completed_chunks': [], 'failed_chunks': [], 'total_chunks': None}
+            self.files[file_uri] = entry
+        entry['output_uri'] = file_output_uri
+        entry.pop('error', None)
+        self._dirty = True
+        return set(entry['completed_chunks'])
+
+    def is_source_copied(self, file_uri):
+        entry = self.files.get(file_uri)
+        return bool(entry and entry.get('source_copied'))
+
+    def mark_source_copied(self, file_uri):
+        self.files[file_uri]['source_copied'] = True
+        self._dirty = True
+
+    def set_total_chunks(self, file_uri, total_chunks):
+        '''
+        Record how many chunks a file was split into, once all of them have been produced.
+        '''
+        entry = self.files[file_uri]
+        previous_total = entry.get('total_chunks')
+        if previous_total not in (None, total_chunks):
+            log_msg(
+                f'File {file_uri} previously split into {previous_total} chunks but now has {total_chunks}. '
+                'Chunk outputs from before may not line up with this run.')
+            entry['completed_chunks'] = [n for n in entry['completed_chunks'] if n <= total_chunks]
+            entry['failed_chunks'] = [n for n in entry['failed_chunks'] if n <= total_chunks]
+        entry['total_chunks'] = total_chunks
+        self._dirty = True
+
+    def mark_file_error(self, file_uri, error):
+        entry = self.files.setdefault(file_uri, {'completed_chunks': [], 'failed_chunks': []})
+        entry['error'] = str(error)
+        self._dirty = True
+
+    def mark_chunk(self, file_uri, chunk_num, succeeded):
+        entry = self.files[file_uri]
+        if succeeded:
+            if chunk_num not in entry['completed_chunks']:
+                entry['completed_chunks'].append(chunk_num)
+            if chunk_num in entry['failed_chunks']:
+                entry['failed_chunks'].remove(chunk_num)
+        elif chunk_num not in entry['failed_chunks']:
+            entry['failed_chunks'].append(chunk_num)
+        self._dirty = True
+
+    async def save(self, force=False):
+        if not self._dirty:
+            return
+        if not force and time.time() - self._last_saved < MANIFEST_SAVE_INTERVAL:
+            return
+        self._last_saved = time.time()
+        self._dirty = False
+        if self.dry_run:
+            log_msg(f'Would have written job manifest to {self.manifest_uri}')
+            return
+        # Snapshot now, before other chunks can update the manifest while the write is in flight
+        data = json.dumps({'files': self.files}, indent=2)
+        try:
+            async with self._save_lock:
+                await aws.awrite_file(self.manifest_uri, data)
+        except Exception:
+            # Keep the changes pending so the next save writes them, rather than waiting out the interval
+            self._dirty = True
+            self._last_saved = 0.0
+            raise
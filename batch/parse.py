@@ -1,7 +1,7 @@
 import asyncio
+from datetime import datetime
 import json
 import os
-import tempfile
 
 import aws
 import gpt
@@ -9,90 +9,308 @@ import parse
 import utils
 from utils import doc_convert, log_msg
 
+from .bundle import (
+    BUNDLE_FILE_NAME,
+    OUTPUT_FORMAT_BUNDLE,
+    OUTPUT_FORMAT_FILES,
+    OUTPUT_FORMATS,
+    decode_bundle,
+    encode_bundle,
+    make_bundle_record,
+)
+from .convert_cache import get_conversion_cache, make_conversion_cache_key
+from .manifest import ParseJobManifest
+
+
+DEFAULT_MAX_OPEN_FILES = 8
+
 
 class BatchParseJob:
     def __init__(
-        self, gpt_model=None, dry_run=False, prompt_override=None, log_file=None
+        self,
+        gpt_model=None,
+        dry_run=False,
+        prompt_override=None,
+        log_file=None,
+        max_open_files=DEFAULT_MAX_OPEN_FILES,
+        output_format=OUTPUT_FORMAT_FILES,
+        conversion_workers=doc_convert.DEFAULT_CONVERSION_WORKERS,
+        conversion_timeout=doc_convert.DEFAULT_CONVERSION_TIMEOUT,
+        stream_completions=False,
     ):
+        if output_format not in OUTPUT_FORMATS:
+            raise Exception(f"Unknown output format {output_format}; must be one of {OUTPUT_FORMATS}")
         self.gpt_model = gpt.sanitize_gpt_model_choice(gpt_model)
         self.dry_run = dry_run
         self.prompt_override = prompt_override
         self.log_file = log_file
+        # Max number of input files being fetched/parsed at the same time
+        self.max_open_files = max(1, int(max_open_files or DEFAULT_MAX_OPEN_FILES))
+        # 'files' writes an output_N.json and output_N.source.txt per chunk; 'bundle' writes one gzipped JSONL per file
+        self.output_format = output_format
+        # Worker processes for converting PDFs and Office documents to text, and how long each document may take
+        self.conversion_workers = max(1, int(conversion_workers or doc_convert.DEFAULT_CONVERSION_WORKERS))
+        self.conversion_timeout = conversion_timeout
+        # Stream GPT responses, so a chunk that times out or is cut off keeps the entities received before that
+        self.stream_completions = stream_completions
+        # Will be set while files are being processed; shut down when they're done
+        self.conversion_pool = None
+        # Will be set by run(); shared by all files so the job as a whole stays within the model's rate limits
+        self.request_slots = None
+        # Chunk size in tokens, fixed for the whole job (and kept for resumes) even as the chunk sizing profile learns
+        self.text_token_limit = None
         # Will be set by run() when output folder is created
         self.job_output_uri = None
-        # Will be filled with tasks writing output files to S3
+        # Will be set by run() or resume(); tracks which files/chunks are done
+        self.manifest = None
+        self.resumed = False
+        # Will be filled with tasks writing output files to storage
         self.output_tasks = set()
+        # ETags of input files from the listing, by URI, for looking up cached document conversions
+        self.input_etags = {}
+
+    @staticmethod
+    def __normalize_uri(uri):
+        normalized_uri = aws.normalize_uri(uri)
+        if not normalized_uri:
+            raise Exception(f"Unsupported storage URI: {uri}")
+        return normalized_uri
 
     async def __find_input_files(self, data_source):
-        files = aws.get_objects_at_s3_uri(data_source)
-        if not files:
+        """
+        Start listing input files, returning an async iterator of their URIs as soon as the first one is found.
+
+        The rest of the listing continues while files are processed.
+        """
+        listing = aws.aiter_objects_at_uri(data_source)
+        try:
+            first_file = await listing.__anext__()
+        except StopAsyncIteration:
             raise Exception(f"No files found at {data_source}")
 
-        log_msg(f"Found {len(files)} files to process")
-        log_msg(files)
-        return files
+        async def input_files():
+            file_count = 1
+            log_msg(f"Found file {first_file.uri}")
+            self.input_etags[first_file.uri] = first_file.etag
+            yield first_file.uri
+            async for input_file in listing:
+                file_count += 1
+                log_msg(f"Found file {input_file.uri}")
+                self.input_etags[input_file.uri] = input_file.etag
+                yield input_file.uri
+            log_msg(f"Finished listing input files. Found {file_count} files to process")
+
+        return input_files()
+
+    async def __fetch_document_as_text(self, file_uri):
+        conversion_cache = get_conversion_cache()
+        cache_key = None
+        etag = self.input_etags.get(file_uri)
+        if conversion_cache and etag:
+            # Unchanged documents are found by ETag without downloading them again
+            cache_key = make_conversion_cache_key(file_uri, etag=etag)
+            cached_text = await asyncio.to_thread(conversion_cache.get, cache_key)
+            if cached_text is not None:
+                log_msg(f"Using cached conversion of {file_uri} ({len(cached_text)} bytes of text)")
+                return cached_text
 
-    async def __fetch_input_file(self, file_uri):
         log_msg(f"Fetching file {file_uri}")
-        file_name, data = aws.read_file_from_s3(file_uri)
+        file_name, data = await aws.aread_file(file_uri)
         log_msg(f"Loaded {len(data)} bytes")
 
-        # If file is PDF or other document format, convert it to text
-        if isinstance(data, bytes) and file_name.lower().endswith(
-            (".pdf", ".doc", ".docx", ".xls", ".xlsx", ".ppt", ".pptx")
-        ):
-            with tempfile.NamedTemporaryFile(
-                suffix=os.path.splitext(file_name)[1], delete=False
-            ) as temp_file:
-                temp_file.write(data)  # Write raw bytes directly
-                temp_path = temp_file.name
-            try:
-                data = doc_convert.convert_to_text(temp_path)
-                log_msg(f"Converted document to {len(data)} bytes of text")
-            finally:
-                os.unlink(temp_path)  # Clean up temp file
+        if conversion_cache and cache_key is None:
+            cache_key = make_conversion_cache_key(file_uri, data=data)
+            cached_text = await asyncio.to_thread(conversion_cache.get, cache_key)
+            if cached_text is not None:
+                log_msg(f"Using cached conversion of {file_uri} ({len(cached_text)} bytes of text)")
+                return cached_text
 
-        return file_name, data
+        # File is PDF or other document format, so convert it to text in the conversion pool
+        text = await self.conversion_pool.aconvert(data, file_name)
+        log_msg(f"Converted document to {len(text)} bytes of text")
 
-    async def __process_file(self, file_uri):
-        try:
-            input_file_name, input_data = await self.__fetch_input_file(file_uri)
+        if conversion_cache and isinstance(text, str):
+            await asyncio.to_thread(conversion_cache.put, cache_key, text)
 
-            # At this point input_data should be text, either from a text file or converted from a document
-            if not isinstance(input_data, str):
-                log_msg(f"Could not convert file {file_uri} to text. Skipping.")
-                return
+        return text
+
+    @staticmethod
+    def __is_document(file_uri):
+        return os.path.basename(file_uri).lower().endswith(aws.DOCUMENT_FILE_EXTENSIONS)
+
+    async def __process_file(self, file_uri, conversion=None):
+        """
+        Parse one input file. conversion is a task already fetching and converting the file, if it's a document.
+        """
+        if self.manifest.is_file_complete(file_uri):
+            log_msg(f"All chunks of {file_uri} already parsed. Skipping.")
+            return
 
+        input_file_name = os.path.basename(file_uri)
+        # Text of converted documents, which we have to hold in full. Plain text files are streamed instead.
+        converted_text = None
+        try:
+            if self.__is_document(file_uri):
+                if conversion is None:
+                    conversion = self.__fetch_document_as_text(file_uri)
+                converted_text = await conversion
+                if not isinstance(converted_text, str):
+                    log_msg(f"Could not convert file {file_uri} to text. Skipping.")
+                    self.manifest.mark_file_error(file_uri, "could not convert to text")
+                    return
+                text_pieces = [converted_text]
+            else:
+                log_msg(f"Streaming file {file_uri}")
+                text_pieces = aws.iter_text(file_uri)
+
+            # Chunks are produced lazily as ranges of the file are read, in a worker thread to keep the loop free
+            text_chunks = parse.iter_chunks_with_offsets_for_parse(
+                text_pieces, model=self.gpt_model, token_limit=self.text_token_limit
+            )
+            # Getting the first chunk up front surfaces files that can't be read or decoded before any output is made
+            first_chunk = await asyncio.to_thread(next, text_chunks, None)
+        except UnicodeDecodeError:
+            log_msg(f"Could not decode file {file_uri} as UTF-8 text. Skipping.")
+            self.manifest.mark_file_error(file_uri, "could not decode as text")
+            return
         except Exception as e:
             log_msg(f"Error processing file {file_uri}: {e}")
+            self.manifest.mark_file_error(file_uri, e)
             return
 
-        file_output_uri = aws.create_output_dir_for_file(
+        file_output_uri = await aws.acreate_output_dir_for_file(
             self.job_output_uri, input_file_name, dry_run=self.dry_run
         )
 
-        await self.__copy_input_file_to_output_folder(
-            input_file_name, input_data, file_output_uri
-        )
+        completed_chunks = self.manifest.start_file(file_uri, file_output_uri)
+        if not self.manifest.is_source_copied(file_uri):
+            await self.__copy_input_file_to_output_folder(
+                file_uri, input_file_name, converted_text, file_output_uri
+            )
+            self.manifest.mark_source_copied(file_uri)
 
-        log_msg(f"Beginning parse of file: {input_file_name}")
-        parse_multitask = parse.parse_with_gpt_multitask(
-            input_data, model=self.gpt_model, prompt_override=self.prompt_override
+        if completed_chunks:
+            log_msg(
+                f"Resuming parse of file: {input_file_name} "
+                f"({len(completed_chunks)} chunks already parsed)"
+            )
+        else:
+            log_msg(f"Beginning parse of file: {input_file_name}")
+
+        bundle_records = None
+        if self.output_format == OUTPUT_FORMAT_BUNDLE:
+            bundle_records = {}
+            if completed_chunks:
+                bundle_records = await self.__load_bundle_records(file_output_uri)
+
+        # Source offsets of chunks sent for parsing, by chunk index
+        chunk_offsets = {}
+
+        async def pending_chunks():
+            chunk_index = 0
+            chunk_with_offsets = first_chunk
+            while chunk_with_offsets is not None:
+                chunk, start, end = chunk_with_offsets
+                # Chunk numbers in the manifest and output files start at 1
+                if chunk_index + 1 not in completed_chunks:
+                    chunk_offsets[chunk_index] = (start, end)
+                    yield chunk_index, chunk
+                chunk_index += 1
+                chunk_with_offsets = await asyncio.to_thread(next, text_chunks, None)
+            self.manifest.set_total_chunks(file_uri, chunk_index)
+
+        parse_multitask = parse.parse_chunk_stream_with_gpt(
+            pending_chunks(),
+            model=self.gpt_model,
+            prompt_override=self.prompt_override,
+            request_slots=self.request_slots,
+            stream=self.stream_completions,
         )
-        output_num = 0
-        async for parse_input, parse_result in parse_multitask:
-            output_num += 1
-            # Create a task for each output chunk so that we can write them in parallel
-            task = asyncio.create_task(
-                self.__write_output_for_file_chunk(
-                    parse_input, parse_result, file_output_uri, output_num
+        try:
+            async for chunk_index, parse_input, parse_result in parse_multitask:
+                # Number outputs by chunk position so a resumed job writes each chunk to the same place
+                output_num = chunk_index + 1
+                source_start, source_end = chunk_offsets.pop(chunk_index)
+                if bundle_records is not None:
+                    self.__add_bundle_record(
+                        file_uri,
+                        bundle_records,
+                        chunk_index,
+                        parse_input,
+                        parse_result,
+                        source_start,
+                        source_end,
+                    )
+                    continue
+                # Create a task for each output chunk so that we can write them in parallel
+                task = asyncio.create_task(
+                    self.__write_output_for_file_chunk(
+                        file_uri, parse_input, parse_result, file_output_uri, output_num
+                    )
                 )
-            )
-            self.output_tasks.add(task)
-            task.add_done_callback(self.output_tasks.discard)
+                self.output_tasks.add(task)
+                task.add_done_callback(self.output_tasks.discard)
+        except Exception as e:
+            # e.g. the file stopped decoding as text partway through; chunks parsed so far are kept
+            self.manifest.mark_file_error(file_uri, e)
+            raise
+        finally:
+            if bundle_records is not None:
+                # Also runs if the job is cancelled, so chunks parsed so far aren't lost
+                await self.__write_bundle(file_uri, file_output_uri, bundle_records)
+
+    async def __load_bundle_records(self, file_output_uri):
+        bundle_uri = f"{file_output_uri.rstrip('/')}/{BUNDLE_FILE_NAME}"
+        try:
+            records = decode_bundle(await aws.aread_bytes(bundle_uri))
+        except Exception as e:
+            log_msg(f"Could not load existing output bundle {bundle_uri} ({e}). Starting a new one.")
+            return {}
+        log_msg(f"Loaded {len(records)} previously parsed chunks from {bundle_uri}")
+        return {record["chunk_index"]: record for record in records}
+
+    def __add_bundle_record(
+        self,
+        file_uri,
+        bundle_records,
+        chunk_index,
+        chunk_text,
+        parse_result,
+        source_start,
+        source_end,
+    ):
+        if not parse_result:
+            # Skipped after an error (or had no entities), so retry it on resume
+            self.manifest.mark_chunk(file_uri, chunk_index + 1, succeeded=False)
+            return
+        record = make_bundle_record(
+            chunk_index, source_start, source_end, chunk_text, parse_result
+        )
+        # Not marked complete in the manifest until the bundle containing it is written
+        record["pending"] = True
+        bundle_records[chunk_index] = record
+
+    async def __write_bundle(self, file_uri, file_output_uri, bundle_records):
+        new_records = [r for r in bundle_records.values() if r.pop("pending", False)]
+        if not new_records:
+            return
+
+        bundle_uri = f"{file_output_uri.rstrip('/')}/{BUNDLE_FILE_NAME}"
+        data = encode_bundle(bundle_records.values())
+        log_msg(
+            f"Writing output bundle with {len(bundle_records)} chunks to {bundle_uri}"
+        )
+        if self.dry_run:
+            log_msg(f"Would have written {len(data)} bytes")
+        else:
+            await aws.awrite_file(bundle_uri, data)
+
+        for record in new_records:
+            self.manifest.mark_chunk(file_uri, record["chunk_index"] + 1, succeeded=True)
+        await self.manifest.save()
 
     async def __write_output_for_file_chunk(
-        self, input_chunk, output_data, file_output_uri, output_num
+        self, file_uri, input_chunk, parse_result, file_output_uri, output_num
     ):
         input_chunk_uri = (
             f"{file_output_uri.rstrip('/')}/output_{output_num}.source.txt"
@@ -101,27 +319,40 @@ class BatchParseJob:
         if self.dry_run:
             log_msg(f"Would have written {len(input_chunk)} bytes")
         else:
-            aws.write_to_s3_file(input_chunk_uri, input_chunk)
+            await aws.awrite_file(input_chunk_uri, input_chunk)
 
         output_chunk_uri = f"{file_output_uri.rstrip('/')}/output_{output_num}.json"
         log_msg(f"Writing output chunk {output_num} to {output_chunk_uri}")
+        # Parse results are only encoded here, on their way out
+        output_data = parse_result.to_json() if parse_result else ""
         if self.dry_run:
             log_msg(f"Would have written {len(output_data)} bytes")
         else:
-            aws.write_to_s3_file(output_chunk_uri, output_data)
+            await aws.awrite_file(output_chunk_uri, output_data)
+
+        # Empty output means the chunk was skipped after an error (or had no entities), so retry it on resume
+        self.manifest.mark_chunk(file_uri, output_num, succeeded=bool(output_data))
+        await self.manifest.save()
 
     async def __copy_input_file_to_output_folder(
-        self, input_name, input_data, output_folder_uri
+        self, file_uri, input_name, converted_text, output_folder_uri
     ):
         log_msg(
             f"Writing copy of input file {input_name} to output folder {output_folder_uri}"
         )
-        if self.dry_run:
-            log_msg(f"Would have written {len(input_data)} bytes")
+        copied_file_uri = f"{output_folder_uri.rstrip('/')}/source.txt"
+        if converted_text is None:
+            # Plain text input can be copied as-is without downloading it
+            if self.dry_run:
+                log_msg(f"Would have copied {file_uri} to {copied_file_uri}")
+                return
+            await aws.acopy_object(file_uri, copied_file_uri)
             return
 
-        copied_file_uri = f"{output_folder_uri.rstrip('/')}/source.txt"
-        aws.write_to_s3_file(copied_file_uri, input_data)
+        if self.dry_run:
+            log_msg(f"Would have written {len(converted_text)} bytes")
+            return
+        await aws.awrite_file(copied_file_uri, converted_text)
 
     async def __write_job_args_to_output_folder(self, data_source, output_uri_arg):
         job_args_uri = f"{self.job_output_uri}/job_args.json"
@@ -139,26 +370,140 @@ class BatchParseJob:
             "output_uri": output_uri_arg,
             "gpt_model": self.gpt_model,
             "parse_prompt": parse_prompt,
+            "output_format": self.output_format,
+            "text_token_limit": self.text_token_limit,
         }
         job_args = json.dumps(job_args, indent=2)
-        aws.write_to_s3_file(job_args_uri, job_args)
+        await aws.awrite_file(job_args_uri, job_args)
 
     async def __upload_log_file(self):
         if not self.log_file:
             return
 
-        log_file_uri = f"{self.job_output_uri}/job_log.txt"
+        if self.resumed:
+            # Don't overwrite the log from the original run
+            timestamp = datetime.now().strftime("%Y-%m-%d_%H-%M-%S")
+            log_file_uri = f"{self.job_output_uri}/job_log.resume-{timestamp}.txt"
+        else:
+            log_file_uri = f"{self.job_output_uri}/job_log.txt"
 
         if self.dry_run:
             log_msg(f"Would have uploaded job log file to {log_file_uri}")
         else:
             log_msg(f"Uploading job log file to {log_file_uri}")
-            aws.upload_to_s3(log_file_uri, self.log_file)
+            await aws.aupload_file(log_file_uri, self.log_file)
+
+    async def __process_files(self, input_files):
+        """
+        Process input files with a pool of workers so that GPT requests for several files can be in flight at once.
+
+        input_files is an async iterator, so workers start on the first files while the rest are still being listed.
+        Documents are fetched and converted to text as they're listed, a bounded number ahead of the workers, so
+        converting upcoming files overlaps with parsing current ones.
+        """
+        self.request_slots = asyncio.Semaphore(
+            gpt.get_max_concurrent_requests(self.gpt_model)
+        )
+        file_queue = asyncio.Queue()
+        num_workers = self.max_open_files
+        # Documents converted (or converting) but not yet done parsing, so converted text can't pile up in memory
+        conversion_slots = asyncio.Semaphore(num_workers + self.conversion_workers)
+        conversions = set()
+
+        async def list_files():
+            try:
+                file_num = 0
+                async for input_file in input_files:
+                    file_num += 1
+                    conversion = None
+                    if self.__is_document(input_file) and not self.manifest.is_file_complete(input_file):
+                        await conversion_slots.acquire()
+                        conversion = asyncio.create_task(self.__fetch_document_as_text(input_file))
+                        conversions.add(conversion)
+                    file_queue.put_nowait((file_num, input_file, conversion))
+            finally:
+                # One stop marker per worker, so they all exit once the queue drains
+                for _ in range(num_workers):
+                    file_queue.put_nowait(None)
+
+        async def file_worker():
+            while True:
+                queued = await file_queue.get()
+                if queued is None:
+                    return
+                file_num, input_file, conversion = queued
+                log_msg(f"********* Processing file {input_file} (file {file_num})")
+                try:
+                    await self.__process_file(input_file, conversion=conversion)
+                except Exception as e:
+                    log_msg(f"Error processing file {input_file}: {e}")
+                finally:
+                    if conversion is not None:
+                        conversions.discard(conversion)
+                        conversion_slots.release()
+
+        log_msg(
+            f"Processing up to {num_workers} files at a time, "
+            f"converting documents with {self.conversion_workers} worker processes"
+        )
+        self.conversion_pool = doc_convert.DocumentConversionPool(
+            max_workers=self.conversion_workers, timeout=self.conversion_timeout
+        )
+        try:
+            listing_result, *_ = await asyncio.gather(
+                list_files(),
+                *[file_worker() for _ in range(num_workers)],
+                return_exceptions=True,
+            )
+        finally:
+            # Conversions of files no worker got to, e.g. if the job was cancelled
+            for conversion in conversions:
+                conversion.cancel()
+            self.conversion_pool.shutdown()
+        if isinstance(listing_result, Exception):
+            raise listing_result
+
+    async def __run_job(self, input_files):
+        parse_cache = gpt.get_parse_cache()
+        if parse_cache:
+            parse_cache.reset_stats()
+        conversion_cache = get_conversion_cache()
+        if conversion_cache:
+            conversion_cache.reset_stats()
+        gpt.get_json_repair_stats().reset_stats()
+
+        try:
+            await self.__process_files(input_files)
+
+            # Wait for all output tasks to complete before exiting.
+            await asyncio.gather(*self.output_tasks)
+            log_msg("All output tasks complete.")
+
+            log_msg(f"All parsing complete.")
+            log_msg(f"Output URI: {self.job_output_uri}")
+        finally:
+            if parse_cache:
+                parse_cache.log_stats()
+            if conversion_cache:
+                conversion_cache.log_stats()
+            gpt.get_json_repair_stats().log_stats()
+            chunk_sizing_profile = gpt.get_chunk_sizing_profile()
+            chunk_sizing_profile.log_stats(
+                self.gpt_model, self.prompt_override or gpt.get_default_parse_prompt()
+            )
+            await asyncio.to_thread(chunk_sizing_profile.save)
+            # Record progress even if the job was cancelled or hit an exception, so it can be resumed.
+            try:
+                await self.manifest.save(force=True)
+            except Exception as err:
+                log_msg(f"Error saving job manifest: {err}")
+            # Make sure we upload the log file even if there's an exception during processing.
+            await self.__upload_log_file()
 
     async def run(self, data_source, output_uri):
-        # Standardize on s3:// URIs within batch code.
-        data_source = aws.http_to_s3_uri(data_source)
-        output_uri = aws.http_to_s3_uri(output_uri)
+        # Standardize on s3:// and file:// URIs within batch code.
+        data_source = self.__normalize_uri(data_source)
+        output_uri = self.__normalize_uri(output_uri)
 
         log_msg(
             f"Beginning parse job for {data_source} using GPT model {self.gpt_model}"
@@ -167,26 +512,59 @@ class BatchParseJob:
         # Gather input files first so that we can fail fast if there are any issues doing so.
         input_files = await self.__find_input_files(data_source)
 
-        self.job_output_uri = aws.create_output_dir_for_job(
-            data_source, output_uri, dry_run=self.dry_run
+        self.text_token_limit = gpt.parse.get_text_token_limit(
+            self.gpt_model, prompt_override=self.prompt_override
+        )
+        log_msg(f"Splitting input files into chunks of {self.text_token_limit} tokens")
+
+        self.job_output_uri = (
+            await aws.acreate_output_dir_for_job(
+                data_source, output_uri, dry_run=self.dry_run
+            )
         ).rstrip("/")
 
         # Preserve this job's args in the output folder for any future investigations.
         await self.__write_job_args_to_output_folder(data_source, output_uri)
 
-        try:
-            for i, input_file in enumerate(input_files):
-                log_msg(
-                    f"********* Processing file {input_file} ({i + 1} out of {len(input_files)})"
-                )
-                await self.__process_file(input_file)
+        self.manifest = ParseJobManifest(self.job_output_uri, dry_run=self.dry_run)
 
-            # Wait for all output tasks to complete before exiting.
-            await asyncio.gather(*self.output_tasks)
-            log_msg("All output tasks complete.")
+        await self.__run_job(input_files)
 
-            log_msg(f"All parsing complete.")
-            log_msg(f"Output URI: {self.job_output_uri}")
-        finally:
-            # Make sure we upload the log file even if there's an exception during processing.
-            await self.__upload_log_file()
+    async def resume(self, job_output_uri):
+        """
+        Continue a previous job in its existing output folder, parsing only the files and chunks its manifest doesn't
+        record as complete.
+        """
+        self.job_output_uri = self.__normalize_uri(job_output_uri).rstrip("/")
+        self.resumed = True
+
+        _, job_args = await aws.aread_file(
+            f"{self.job_output_uri}/job_args.json"
+        )
+        job_args = json.loads(job_args)
+        data_source = job_args["data_source"]
+
+        # Chunking and prompts must match the original run for chunk numbers and outputs to line up.
+        self.gpt_model = gpt.sanitize_gpt_model_choice(job_args["gpt_model"])
+        # Jobs from before bundles existed wrote per-chunk files
+        self.output_format = job_args.get("output_format", OUTPUT_FORMAT_FILES)
+        parse_prompt = job_args.get("parse_prompt")
+        if parse_prompt and parse_prompt != gpt.get_default_parse_prompt():
+            self.prompt_override = parse_prompt
+        else:
+            self.prompt_override = None
+        # Jobs from before adaptive chunk sizing always used the fixed size for their model and prompt
+        self.text_token_limit = job_args.get("text_token_limit") or gpt.parse.get_text_token_limit(
+            self.gpt_model, prompt_override=self.prompt_override
+        )
+
+        log_msg(
+            f"Resuming parse job in {self.job_output_uri} for {data_source} using GPT model {self.gpt_model}"
+        )
+
+        input_files = await self.__find_input_files(data_source)
+        self.manifest = await ParseJobManifest.load(
+            self.job_output_uri, dry_run=self.dry_run
+        )
+
+        await self.__run_job(input_files)
@@ -2,24 +2,36 @@ import json
 import os
 
 import aws
+import neo
+import resolve
 import save
-from utils import log_msg
+from utils import json_codec, log_msg
+
+from .bundle import BUNDLE_FILE_NAME, decode_bundle
 
 
 async def _find_input_files(data_source):
+    """
+    Async iterator of (folder name, file URIs) for each folder under data_source, yielded as soon as each folder has
+    been listed.
+    """
     log_msg(f'Finding input files at {data_source}')
-    files = aws.get_objects_by_folder_at_s3_uri(data_source)
-    if not files:
+    folder_count = 0
+    file_count = 0
+    async for folder_name, folder_files in aws.aiter_folders_at_uri(data_source):
+        folder_count += 1
+        file_count += len(folder_files)
+        log_msg(f'Found {len(folder_files)} files in directory {folder_name}')
+        yield folder_name, folder_files
+    if not file_count:
         raise Exception(f'No files found at {data_source}')
 
-    log_msg(f'Found {len(files)} directories to process')
-    log_msg(files)
-    return files
+    log_msg(f'Finished listing input files. Found {file_count} files in {folder_count} directories')
 
 
 async def __fetch_input_file(file_uri):
     log_msg(f'Fetching file {file_uri}')
-    file_name, data = aws.read_file_from_s3(file_uri)
+    file_name, data = await aws.aread_file(file_uri)
     log_msg(f'Loaded {len(data)} bytes')
     return file_name, data
 
@@ -38,7 +50,40 @@ def _source_matches_output(source_uri, output_uri):
     return source_basename == output_basename.rstrip('.json') + '.source.txt'
 
 
-async def _process_folder(folder_files, neo_config):
+async def _process_bundle(bundle_uri, neo_config, save_args, source_text_uri=None):
+    log_msg(f'Processing output bundle {bundle_uri}')
+
+    try:
+        records = decode_bundle(await aws.aread_bytes(bundle_uri))
+    except Exception as err:
+        log_msg(f'Exception raised when fetching output bundle. Swallowing to proceed with rest of job.')
+        log_msg(f'Exception: {err}')
+        return
+    log_msg(f'Loaded {len(records)} parsed chunks')
+
+    input_uri = source_text_uri if source_text_uri else bundle_uri
+    log_msg(f'Specifying input source as {input_uri}')
+    for record in records:
+        parsed_data = record.get('parse')
+        if not isinstance(parsed_data, dict):
+            log_msg(f'Chunk {record.get("chunk_index")} in {bundle_uri} not valid JSON. Skipping.')
+            continue
+        try:
+            save.save_data_to_neo4j(parsed_data, source_uri=input_uri, neo_config=neo_config, **save_args)
+        except Exception as err:
+            log_msg('Exception raised when saving data. Swallowing to proceed with rest of job.')
+            log_msg(f'Exception: {err}')
+
+
+async def _process_folder(folder_files, neo_config, save_args):
+    bundle_uris = [uri for uri in folder_files if os.path.basename(uri) == BUNDLE_FILE_NAME]
+    if bundle_uris:
+        # Bundled output holds every chunk of the file, so it's read in one request instead of one per chunk
+        master_source_uris = [uri for uri in folder_files if os.path.basename(uri) == 'source.txt']
+        master_source_uri = master_source_uris[0] if master_source_uris else None
+        await _process_bundle(bundle_uris[0], neo_config, save_args, source_text_uri=master_source_uri)
+        return
+
     parse_output_uris = list(filter(_is_parse_output_uri, folder_files))
     source_text_uris = list(filter(lambda uri: uri.endswith('source.txt'), folder_files))
 
@@ -49,14 +94,14 @@ async def _process_folder(folder_files, neo_config):
     if len(source_text_uris) == 0:
         log_msg(f'No source text files found for output folder. Will default to output chunk URIs being saved as entity/relationship sources.')
         for file_uri in folder_files:
-            await _process_file(file_uri, neo_config, source_text_uri=source_text_uri)
+            await _process_file(file_uri, neo_config, save_args, source_text_uri=source_text_uri)
     elif len(source_text_uris) == 1:
         source_text_uri = source_text_uris[0]
         log_msg(
             f'Found single source text file {source_text_uri} for output folder. Using as input source for all chunks here.')
         folder_files.remove(source_text_uri)
         for file_uri in folder_files:
-            await _process_file(file_uri, neo_config, source_text_uri=source_text_uri)
+            await _process_file(file_uri, neo_config, save_args, source_text_uri=source_text_uri)
     else:
         log_msg(f'Found multiple source text files for output folder. Assuming one source text for each parse chunk + one master file for folder.')
         master_source_uri = list(filter(lambda uri: os.path.basename(uri) == 'source.txt', folder_files))[0]
@@ -64,10 +109,10 @@ async def _process_folder(folder_files, neo_config):
         for output_uri in parse_output_uris:
             source_candidates = list(filter(lambda uri: _source_matches_output(uri, output_uri), source_text_uris))
             source_uri = source_candidates[0] if len(source_candidates) == 1 else master_source_uri
-            await _process_file(output_uri, neo_config, source_text_uri=source_uri)
+            await _process_file(output_uri, neo_config, save_args, source_text_uri=source_uri)
 
 
-async def _process_file(file_uri, neo_config, source_text_uri=None):
+async def _process_file(file_uri, neo_config, save_args, source_text_uri=None):
     log_msg(f'Processing file {file_uri}')
 
     try:
@@ -78,7 +123,7 @@ async def _process_file(file_uri, neo_config, source_text_uri=None):
         return
 
     try:
-        parsed_data = json.loads(input_data)
+        parsed_data = json_codec.loads(input_data)
     except json.decoder.JSONDecodeError:
         log_msg(f'File contents at {file_uri} not valid JSON. Skipping.')
         return
@@ -87,20 +132,30 @@ async def _process_file(file_uri, neo_config, source_text_uri=None):
     input_uri = source_text_uri if source_text_uri else file_uri
     log_msg(f'Specifying input source as {input_uri}')
     try:
-        save.save_data_to_neo4j(parsed_data, source_uri=input_uri, neo_config=neo_config)
+        save.save_data_to_neo4j(parsed_data, source_uri=input_uri, neo_config=neo_config, **save_args)
     except Exception as err:
         log_msg('Exception raised when saving data. Swallowing to proceed with rest of job.')
         log_msg(f'Exception: {err}')
 
 
-async def save_to_neo4j(data_source, neo_config):
-    # Standardize on s3:// URIs within batch code.
-    data_source = aws.http_to_s3_uri(data_source)
+async def save_to_neo4j(data_source, neo_config, bulk_write=False, bulk_batch_size=neo.DEFAULT_BULK_BATCH_SIZE):
+    # Standardize on s3:// and file:// URIs within batch code.
+    normalized_source = aws.normalize_uri(data_source)
+    if not normalized_source:
+        raise Exception(f'Unsupported storage URI: {data_source}')
+    data_source = normalized_source
 
     log_msg(f'Running batch save job for {data_source}')
-    input_files_by_folder = await _find_input_files(data_source)
-
-    for folder_key in input_files_by_folder:
-        folder_files = input_files_by_folder[folder_key]
-        log_msg(f'Processing {len(folder_files)} files from folder {folder_key}')
-        await _process_folder(folder_files, neo_config)
+    if bulk_write:
+        log_msg(f'Using bulk Neo4j writes with batch size {bulk_batch_size}')
+    save_args = {'bulk': bulk_write, 'bulk_batch_size': bulk_batch_size}
+    resolver = resolve.get_entity_resolver()
+    if resolver is not None:
+        resolver.reset_stats()
+    try:
+        async for folder_key, folder_files in _find_input_files(data_source):
+            log_msg(f'Processing {len(folder_files)} files from folder {folder_key}')
+            await _process_folder(folder_files, neo_config, save_args)
+    finally:
+        if resolver is not None:
+            resolver.log_stats()
@@ -4,7 +4,11 @@ Code specific to interacting with OpenAI APIs.
 
 from .common import *
 from .text import *
+from .json_stream import *
+from .json_repair import *
 
+from .parse_cache import *
+from .chunk_sizing import *
 from .parse import *
 from .data_prep import *
 from .ent_types import *
@@ -0,0 +1,150 @@
+"""
+Adaptive parse chunk sizing, learned from how many output tokens parse responses use per input token.
+
+Each (model, system prompt) pair gets a profile of recent output/input token ratios. Once there are enough of them,
+chunks are sized so that a high quantile of that ratio (1 - the target truncation rate) just fits in the room left
+for output, instead of always reserving the fixed per-model output allowance.
+"""
+
+import hashlib
+import json
+import math
+import os
+import tempfile
+import threading
+
+from utils import log_msg
+
+
+# Fraction of parse responses we're willing to have cut off at max_tokens (they get split and retried)
+DEFAULT_TARGET_TRUNCATION_RATE = 0.02
+# Observations needed for a profile before it's used instead of the fixed per-model sizes
+MIN_PROFILE_SAMPLES = 20
+# Most recent observations kept per profile, so it follows changes in the kind of text being parsed
+MAX_PROFILE_SAMPLES = 500
+# Truncated responses only tell us the ratio was at least what we saw, so count them as this much higher
+TRUNCATED_RATIO_FACTOR = 2.0
+# How often (in observations) the profile is written back to disk
+SAVE_EVERY_OBSERVATIONS = 50
+DEFAULT_PROFILE_FILE = "/tmp/p2g/chunk_sizing_profile.json"
+
+
+def _profile_key(model, prompt):
+    prompt_hash = hashlib.sha256(prompt.encode("utf-8")).hexdigest()[:16]
+    return f"{model}:{prompt_hash}"
+
+
+class ChunkSizingProfile:
+    """
+    Observed output/input token ratios of parse requests by model and prompt, optionally persisted to a JSON file.
+    """
+
+    def __init__(self, file_path=None, target_truncation_rate=DEFAULT_TARGET_TRUNCATION_RATE):
+        self.file_path = file_path
+        self.target_truncation_rate = float(target_truncation_rate)
+        self._profiles = {}
+        self._unsaved = 0
+        self._lock = threading.Lock()
+        if file_path:
+            self._load()
+
+    def _load(self):
+        try:
+            with open(self.file_path, "r") as f:
+                self._profiles = json.load(f).get("profiles", {})
+        except FileNotFoundError:
+            return
+        except Exception as err:
+            log_msg(f"Could not load chunk sizing profile from {self.file_path} ({err}). Starting a new one.")
+            self._profiles = {}
+            return
+        log_msg(f"Loaded chunk sizing profiles for {len(self._profiles)} model/prompt pairs from {self.file_path}")
+
+    def save(self):
+        if not self.file_path:
+            return
+        with self._lock:
+            data = json.dumps({"profiles": self._profiles})
+            self._unsaved = 0
+        try:
+            dir_path = os.path.dirname(self.file_path) or "."
+            os.makedirs(dir_path, exist_ok=True)
+            # Write to a temp file and rename, so an interrupted save can't leave a corrupt profile behind
+            with tempfile.NamedTemporaryFile("w", dir=dir_path, delete=False) as f:
+                f.write(data)
+                temp_path = f.name
+            os.replace(temp_path, self.file_path)
+        except Exception as err:
+            log_msg(f"Error saving chunk sizing profile to {self.file_path}: {err}")
+
+    def record(self, model, prompt, input_tokens, output_tokens, truncated=False):
+        """
+        Record the token usage of one parse response for input_tokens of text.
+        """
+        if input_tokens <= 0:
+            return
+        ratio = output_tokens / input_tokens
+        if truncated:
+            ratio *= TRUNCATED_RATIO_FACTOR
+        with self._lock:
+            profile = self._profiles.setdefault(
+                _profile_key(model, prompt), {"ratios": [], "requests": 0, "truncations": 0}
+            )
+            profile["ratios"].append(round(ratio, 4))
+            del profile["ratios"][:-MAX_PROFILE_SAMPLES]
+            profile["requests"] += 1
+            if truncated:
+                profile["truncations"] += 1
+            self._unsaved += 1
+            should_save = self._unsaved >= SAVE_EVERY_OBSERVATIONS
+        if should_save:
+            self.save()
+
+    def get_output_ratio(self, model, prompt):
+        """
+        Returns the output/input token ratio that all but the target truncation rate of responses stay under, or None
+        if there aren't enough observations yet.
+        """
+        with self._lock:
+            profile = self._profiles.get(_profile_key(model, prompt))
+            ratios = sorted(profile["ratios"]) if profile else []
+        if len(ratios) < MIN_PROFILE_SAMPLES:
+            return None
+        index = min(len(ratios) - 1, math.ceil(len(ratios) * (1 - self.target_truncation_rate)) - 1)
+        return max(ratios[index], 1e-3)
+
+    def log_stats(self, model, prompt):
+        with self._lock:
+            profile = self._profiles.get(_profile_key(model, prompt))
+            if not profile:
+                return
+            requests, truncations = profile["requests"], profile["truncations"]
+        ratio = self.get_output_ratio(model, prompt)
+        ratio_str = f"{ratio:.3f}" if ratio is not None else "not enough data"
+        log_msg(
+            f"Chunk sizing profile for {model}: {requests} responses, {truncations} truncated, "
+            f"output/input ratio used for sizing: {ratio_str}"
+        )
+
+
+_profile = ChunkSizingProfile()
+
+
+def init_chunk_sizing(config):
+    """
+    Set up the process-wide chunk sizing profile, stored at CHUNK_SIZING_PROFILE_FILE so it carries over between runs.
+
+    CHUNK_SIZING_TARGET_TRUNCATION_RATE sets the fraction of responses allowed to be cut off.
+    """
+    global _profile
+    file_path = config.get("CHUNK_SIZING_PROFILE_FILE", None) or DEFAULT_PROFILE_FILE
+    target_rate = config.get("CHUNK_SIZING_TARGET_TRUNCATION_RATE", None) or DEFAULT_TARGET_TRUNCATION_RATE
+    _profile = ChunkSizingProfile(file_path=file_path, target_truncation_rate=target_rate)
+    return _profile
+
+
+def get_chunk_sizing_profile():
+    """
+    Returns the process-wide chunk sizing profile.
+    """
+    return _profile
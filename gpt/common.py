@@ -6,12 +6,18 @@ import asyncio
 import json
 import math
 import random
+import threading
 
 import openai
-import tiktoken
 
 import utils
-from utils import log_msg, log_debug
+from utils import json_codec, log_msg, log_debug
+
+from .chunk_sizing import init_chunk_sizing
+from .json_repair import get_json_repair_stats, repair_json
+from .parse_cache import init_parse_cache
+from .rate_limit import RateLimiter
+from .text import get_token_length, get_token_lengths
 
 
 VALID_GPT_MODELS = [
@@ -28,6 +34,8 @@ DEFAULT_GPT_MODEL = "gpt-3.5-turbo"
 def init_module(config):
     openai.api_key = config.get("OPENAI_API_KEY", None)
     log_msg(f"Using OpenAI API key: {utils.secret_to_log_str(openai.api_key)}")
+    init_parse_cache(config)
+    init_chunk_sizing(config)
 
 
 def sanitize_gpt_model_choice(model):
@@ -36,45 +44,73 @@ def sanitize_gpt_model_choice(model):
     return model
 
 
-def clean_json(response):
+def clean_json_value(key, value):
+    """
+    Returns a top-level value of a JSON response with empty or unhelpful parts trimmed, or None if it should be
+    skipped entirely.
+    """
+    # We want to skip the empty values to avoid overloading GPT in subsequent queries.
+    if not value:
+        return None
+    if isinstance(value, dict):
+        cleaned_value = {}
+        # Sometimes a dict will have a bunch of key => empty dict pairs inside of it for some reason?
+        # Trim those too.
+        for subkey, subvalue in value.items():
+            if subvalue:
+                cleaned_value[subkey] = subvalue
+        # Check that the cleaned up value dict actually has anything in it; if not, skip
+        if not cleaned_value:
+            return None
+        return cleaned_value
+    elif isinstance(value, list):
+        # Do nothing to clean list values for now
+        return value
+    elif isinstance(value, str):
+        # Sometimes we get really long string pairs that are more trouble than they are informative
+        if len(key) + len(value) > 200:
+            return None
+        return value
+    # We don't know how to handle other kinds of values, so skip them
+    log_debug(f'Unexpected value type for key "{key}": {type(value)}')
+    return None
+
+
+def clean_json(response, as_dict=False):
+    """
+    Returns (cleaned JSON string, is_valid) for a JSON response, repairing it locally if it isn't quite valid JSON.
+
+    If as_dict is set, the cleaned response is returned decoded instead, or None if it isn't valid.
+    """
     cleaned = {}
     try:
         if response.startswith("Output:"):
             # Remove extraneous "Output:" signifier that shows up sometimes.
             response = response[len("Output:") :].strip()
-        response_dict = json.loads(response)
+        try:
+            response_dict = json_codec.loads(response)
+            get_json_repair_stats().record("valid")
+        except json.decoder.JSONDecodeError:
+            # Near misses (missing or trailing commas, a cut off final entity, etc.) are cheaper to fix than re-request
+            response_dict = repair_json(response)
+            if response_dict is None:
+                raise
+            log_msg("Response not valid JSON; repaired it locally.")
+            get_json_repair_stats().record("repaired")
         for key, value in response_dict.items():
-            # We want to skip the empty values to avoid overloading GPT in subsequent queries.
-            if not value:
-                continue
-            if isinstance(value, dict):
-                cleaned_value = {}
-                # Sometimes a dict will have a bunch of key => empty dict pairs inside of it for some reason?
-                # Trim those too.
-                for subkey, subvalue in value.items():
-                    if subvalue:
-                        cleaned_value[subkey] = subvalue
-                # Check that the cleaned up value dict actually has anything in it; if not, skip
-                if not cleaned_value:
-                    continue
-                value = cleaned_value
-            elif isinstance(value, list):
-                # Do nothing to clean list values for now
-                pass
-            elif isinstance(value, str):
-                # Sometimes we get really long string pairs that are more trouble than they are informative
-                if len(key) + len(value) > 200:
-                    continue
-            else:
-                # We don't know how to handle other kinds of values, so skip them
-                log_debug(f'Unexpected value type for key "{key}": {type(value)}')
+            value = clean_json_value(key, value)
+            if value is None:
                 continue
             cleaned[key] = value
-        cleaned = json.dumps(cleaned, indent=2)
+        if as_dict:
+            return cleaned, True
+        cleaned = json_codec.dumps(cleaned, indent=True)
         # log_msg(f'Cleaned up response JSON: \n{cleaned}')
         return cleaned, True
     except json.decoder.JSONDecodeError:
-        log_msg("Response not valid JSON!")
+        log_msg("Response not valid JSON, and couldn't be repaired!")
+        if as_dict:
+            return None, False
         if "{" in response:
             # Response isn't valid JSON but may be close enough that it can still be used, so we'll just return it as-is
             return response, False
@@ -82,22 +118,20 @@ def clean_json(response):
     except Exception as err:
         log_msg(f"Error while attempting to clean response JSON: {err}")
         log_msg(f"Response was valid JSON, though, so returning it unchanged.")
+        if as_dict:
+            return response_dict, True
         return response, True
 
 
-def get_token_length(text, model="gpt-3.5-turbo"):
-    encoding = tiktoken.encoding_for_model(model)
-    text_as_tokens = encoding.encode(text)
-    return len(text_as_tokens)
-
-
 def split_input_list_to_chunks(input_list, max_chunk_tokens, model="gpt-3.5-turbo"):
     input_chunks = []
     cur_chunk = []
     cur_chunk_token_count = 0
-    for input in input_list:
+    # Tokenize all inputs in one batch rather than one at a time
+    input_token_counts = get_token_lengths(input_list, model=model)
+    for input, input_token_count in zip(input_list, input_token_counts):
         # Add 1 to account for the newline that will be added between each input
-        input_token_count = get_token_length(input, model=model) + 1
+        input_token_count += 1
         if (
             cur_chunk_token_count + input_token_count > max_chunk_tokens
             or len(cur_chunk) > 300
@@ -129,7 +163,10 @@ def get_context_window_size(model):
     return max_context_tokens
 
 
-def get_max_requests_per_minute(model):
+def get_rate_limits(model):
+    """
+    Returns (requests per minute, tokens per minute) limits for a given model.
+    """
     # All rate limits can be found at https://platform.openai.com/docs/guides/rate-limits/what-are-the-rate-limits-for-our-api
     if model == "gpt-4o":
         # 500 RPM
@@ -164,6 +201,12 @@ def get_max_requests_per_minute(model):
         # 60k TPM
         tokens_per_minute_limit = 60000.0
 
+    return requests_per_minute_limit, tokens_per_minute_limit
+
+
+def get_max_requests_per_minute(model):
+    requests_per_minute_limit, tokens_per_minute_limit = get_rate_limits(model)
+
     # Assume we're using full context window tokens in every request
     tokens_per_request = get_context_window_size(model)
     # Round down to be extra conservative
@@ -175,6 +218,70 @@ def get_max_requests_per_minute(model):
     return min(requests_per_minute_limit, requests_per_minute_by_tpm)
 
 
+# Upper bound on requests kept in flight at once for a single model.
+MAX_CONCURRENT_REQUESTS = 50
+
+
+def get_max_concurrent_requests(model):
+    """
+    Returns how many requests to a model can usefully be in flight at once.
+
+    Actual pacing is done by the shared rate limiter in async_fetch_from_openai, so this only needs to be high enough
+    to keep the model's request/token budget busy; it no longer assumes every request fills the context window.
+    """
+    requests_per_minute_limit, _ = get_rate_limits(model)
+    return int(min(requests_per_minute_limit, MAX_CONCURRENT_REQUESTS))
+
+
+_rate_limiters = {}
+_rate_limiters_lock = threading.Lock()
+
+
+def get_rate_limiter(model):
+    """
+    Returns the process-wide rate limiter for a model, shared by every caller of async_fetch_from_openai.
+    """
+    with _rate_limiters_lock:
+        limiter = _rate_limiters.get(model)
+        if limiter is None:
+            limiter = RateLimiter(*get_rate_limits(model))
+            _rate_limiters[model] = limiter
+        return limiter
+
+
+def estimate_request_tokens(messages, max_tokens=None, model="gpt-3.5-turbo"):
+    """
+    Estimate how many tokens a chat completion request will count against the TPM limit.
+    """
+    # Each message carries a few tokens of formatting overhead, plus a few to prime the reply.
+    prompt_tokens = 3
+    for message in messages:
+        prompt_tokens += 4 + get_token_length(message["content"], model=model)
+
+    if max_tokens:
+        completion_tokens = max_tokens
+    else:
+        # Without an explicit limit the response can use whatever's left of the context window
+        completion_tokens = max(get_context_window_size(model) - prompt_tokens, 0)
+
+    return prompt_tokens + completion_tokens
+
+
+class ChunkTooLargeError(Exception):
+    """
+    Raised instead of skipping or retrying a request whose input overflowed the context window ("context") or whose
+    response was cut off at max_tokens ("length"), so the caller can split the input and try the pieces.
+    """
+
+    def __init__(self, reason, message=None):
+        super().__init__(message or f"Request too large for model ({reason})")
+        self.reason = reason
+
+
+def is_context_length_error(err):
+    return getattr(err, "code", None) == "context_length_exceeded" or "maximum context length" in str(err)
+
+
 def get_rl_backoff_time(model):
     """
     Returns the number of seconds to wait before retrying a request for a given model.
@@ -202,9 +309,23 @@ async def async_fetch_from_openai(
     expect_json_result=False,
     response_format=None,
     retries_remaining=2,
+    rate_limit_errors=0,
+    raise_on_overflow=False,
+    usage_callback=None,
+    decode_json_result=False,
 ):
     """
     Fetch a response from OpenAI's API with error handling and retries.
+
+    Requests are paced by the model's shared rate limiter, which is charged the prompt tokens plus max_tokens up front
+    and then reconciled against the usage reported in the response.
+
+    If raise_on_overflow is set, ChunkTooLargeError is raised when the input doesn't fit the context window or the
+    response is truncated, rather than skipping or retrying a request that would only overflow again.
+    If usage_callback is provided, it's called with the usage and finish reason of every response received.
+    If decode_json_result is set along with expect_json_result, the cleaned response is returned decoded rather than
+    as a JSON string, so callers don't have to parse it again; any empty or unusable result is returned as a falsy
+    value.
     """
     # Wrap all parameters into a dictionary so we can pass them around easily
     params = {
@@ -218,9 +339,16 @@ async def async_fetch_from_openai(
         "retries_remaining": retries_remaining,
         "expect_json_result": expect_json_result,
         "response_format": response_format,
+        "rate_limit_errors": rate_limit_errors,
+        "raise_on_overflow": raise_on_overflow,
+        "usage_callback": usage_callback,
+        "decode_json_result": decode_json_result,
     }
 
-    rate_limit_errors = 0
+    rate_limiter = get_rate_limiter(model)
+    charged_tokens = await rate_limiter.acquire(
+        estimate_request_tokens(messages, max_tokens=max_tokens, model=model)
+    )
 
     try:
         log_msg(f"[{log_label}] Sending request to OpenAI...")
@@ -258,6 +386,8 @@ async def async_fetch_from_openai(
         backoff_time = get_rl_backoff_time(model)
         # Every time we get a rate limit error, we double the backoff time.
         backoff_time = backoff_time * (2**rate_limit_errors)
+        # Hold back every other request to this model too, since they'd hit the same limit.
+        rate_limiter.pause(backoff_time)
         await asyncio.sleep(backoff_time)
 
         # We track rate limit errors separately from other retries because they should always be fixable by waiting.
@@ -265,9 +395,9 @@ async def async_fetch_from_openai(
         return await async_fetch_from_openai(**params)
     except openai.error.InvalidRequestError as err:
         log_msg(f"Invalid request error from OpenAI: {err}")
-        # This is probably an issue with context size, which we're not handling yet, so we'll just skip this chunk because
-        # retrying won't help.
-        # In the future we'll let this bubble up so calling code can split the request into smaller chunks and try again.
+        if raise_on_overflow and is_context_length_error(err):
+            raise ChunkTooLargeError("context", str(err))
+        # Retrying the same request won't help, so skip this chunk.
         log_msg("Skipping this chunk.")
         return ""
     except TimeoutError as err:
@@ -289,11 +419,20 @@ async def async_fetch_from_openai(
             return ""
         raise err
 
+    usage = result.get("usage")
+    if usage and "total_tokens" in usage:
+        rate_limiter.reconcile(charged_tokens, usage["total_tokens"])
+
     result = result["choices"][0]
+    if usage_callback:
+        usage_callback(usage, result["finish_reason"])
     if result["finish_reason"] != "stop":
         # "stop" is the standard finish reason; if we get something else, we might want to investigate.
         # See: https://platform.openai.com/docs/guides/gpt/chat-completions-response-format
         log_msg(f'OpenAI finish reason: "{result["finish_reason"]}".')
+        if result["finish_reason"] == "length" and raise_on_overflow:
+            # Output was cut off at max_tokens; a retry of the same request would be cut off too
+            raise ChunkTooLargeError("length")
 
     result = result["message"]["content"].strip()
     log_msg(f"Received response from OpenAI")
@@ -307,13 +446,15 @@ async def async_fetch_from_openai(
     if not expect_json_result:
         return result
 
-    result, is_valid = clean_json(result)
+    result, is_valid = clean_json(result, as_dict=decode_json_result)
     log_debug(f"Cleaned response data: \n{result}")
     if not is_valid:
         if retries_remaining > 0:
             log_msg("Doesn't look like GPT gave us JSON. Trying again...")
+            get_json_repair_stats().record("retried")
             params["retries_remaining"] = retries_remaining - 1
             return await async_fetch_from_openai(**params)
+        get_json_repair_stats().record("failed")
         if skip_on_error:
             log_msg(
                 "Doesn't look like GPT gave us JSON. "
@@ -321,3 +462,114 @@ async def async_fetch_from_openai(
             )
             return ""
     return result
+
+
+async def async_stream_from_openai(
+    messages,
+    log_label="GPT",
+    model="gpt-3.5-turbo",
+    max_tokens=None,
+    timeout=60,
+    response_format=None,
+    rate_limit_errors=0,
+    raise_on_overflow=False,
+    usage_callback=None,
+):
+    """
+    Stream a response from OpenAI's API, yielding pieces of its content as they're generated.
+
+    Requests are paced by the same shared rate limiter as async_fetch_from_openai. Rate limit errors are retried, but
+    nothing else is, since part of the response may already have been used: a timeout (for the whole response, like
+    async_fetch_from_openai's) or any other error is raised to the caller, which can keep what it's received so far.
+    If raise_on_overflow is set, ChunkTooLargeError is raised when the input doesn't fit the context window, or after
+    the last piece of a response that was cut off at max_tokens.
+    """
+    rate_limiter = get_rate_limiter(model)
+    charged_tokens = await rate_limiter.acquire(
+        estimate_request_tokens(messages, max_tokens=max_tokens, model=model)
+    )
+
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + timeout
+    try:
+        log_msg(f"[{log_label}] Sending streaming request to OpenAI...")
+        completion_args = {
+            "model": model,
+            "messages": messages,
+            "temperature": 0.4,
+            "stream": True,
+            # Have the final event report token usage, which streamed responses otherwise leave out
+            "stream_options": {"include_usage": True},
+        }
+        if max_tokens:
+            completion_args["max_tokens"] = max_tokens
+        if response_format:
+            completion_args["response_format"] = response_format
+
+        stream = await asyncio.wait_for(
+            openai.ChatCompletion.acreate(**completion_args),
+            timeout=timeout,
+        )
+    except openai.error.RateLimitError as err:
+        if "exceeded your current quota" in err.__str__() or rate_limit_errors > 4:
+            log_msg("Rate limit or quota error from OpenAI; abandoning this request and letting error bubble up.")
+            raise err
+
+        log_msg("Rate limit error from OpenAI")
+        backoff_time = get_rl_backoff_time(model) * (2**rate_limit_errors)
+        rate_limiter.pause(backoff_time)
+        await asyncio.sleep(backoff_time)
+        async for content in async_stream_from_openai(
+            messages,
+            log_label=log_label,
+            model=model,
+            max_tokens=max_tokens,
+            timeout=timeout,
+            response_format=response_format,
+            rate_limit_errors=rate_limit_errors + 1,
+            raise_on_overflow=raise_on_overflow,
+            usage_callback=usage_callback,
+        ):
+            yield content
+        return
+    except openai.error.InvalidRequestError as err:
+        log_msg(f"Invalid request error from OpenAI: {err}")
+        if raise_on_overflow and is_context_length_error(err):
+            raise ChunkTooLargeError("context", str(err))
+        raise err
+
+    usage = None
+    finish_reason = None
+    received = []
+    stream = stream.__aiter__()
+    while True:
+        try:
+            event = await asyncio.wait_for(stream.__anext__(), timeout=max(deadline - loop.time(), 0))
+        except StopAsyncIteration:
+            break
+        except asyncio.TimeoutError:
+            log_msg(f"OpenAI streaming request timeout after receiving {len(received)} pieces of response.")
+            raise TimeoutError(f"Streamed response not finished within {timeout} seconds")
+        if event.get("usage"):
+            usage = event["usage"]
+        if not event.get("choices"):
+            continue
+        choice = event["choices"][0]
+        content = choice.get("delta", {}).get("content")
+        if content:
+            received.append(content)
+            yield content
+        if choice.get("finish_reason"):
+            finish_reason = choice["finish_reason"]
+
+    if usage and "total_tokens" in usage:
+        rate_limiter.reconcile(charged_tokens, usage["total_tokens"])
+    elif not usage:
+        usage = {"completion_tokens": get_token_length("".join(received), model=model)}
+    log_msg(f"Received streamed response from OpenAI")
+    if usage_callback:
+        usage_callback(usage, finish_reason)
+    if finish_reason != "stop":
+        log_msg(f'OpenAI finish reason: "{finish_reason}".')
+        if finish_reason == "length" and raise_on_overflow:
+            raise ChunkTooLargeError("length")
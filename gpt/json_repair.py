@@ -0,0 +1,173 @@
+"""
+Local repair of almost-valid JSON from GPT responses, so near misses don't cost a full retry of the request.
+"""
+
+import json
+import re
+import threading
+
+from utils import log_msg
+
+
+_TOKEN_PATTERN = re.compile(
+    r"""
+    (?P<string>"(?:[^"\\]|\\.)*")
+    | (?P<partial_string>"(?:[^"\\]|\\.)*\\?$)
+    | (?P<number>-?\d+(?:\.\d+)?(?:[eE][+-]?\d+)?)
+    | (?P<literal>true|false|null|True|False|None)
+    | (?P<punct>[{}\[\]:,])
+    | (?P<space>\s+)
+    | (?P<other>.)
+    """,
+    re.VERBOSE | re.DOTALL,
+)
+_LITERALS = {"true": True, "false": False, "null": None, "True": True, "False": False, "None": None}
+
+
+def _tokenize(text):
+    tokens = []
+    for match in _TOKEN_PATTERN.finditer(text):
+        kind = match.lastgroup
+        if kind == "space" or kind == "other":
+            continue
+        if kind == "partial_string":
+            # An unterminated string can only be the end of a truncated response
+            break
+        tokens.append((kind, match.group()))
+    return tokens
+
+
+class _TolerantParser:
+    """
+    Recursive descent over JSON tokens that skips stray commas and garbage, supplies missing commas and colons, and
+    closes off every open object and array wherever the tokens run out.
+    """
+
+    def __init__(self, tokens):
+        self.tokens = tokens
+        self.pos = 0
+        self.truncated = False
+
+    def _peek(self):
+        if self.pos >= len(self.tokens):
+            self.truncated = True
+            return None, None
+        return self.tokens[self.pos]
+
+    def parse_value(self):
+        """
+        Returns the next value, or raises ValueError (after skipping the token) if there isn't one.
+        """
+        kind, token = self._peek()
+        if kind is None:
+            raise ValueError("Out of tokens")
+        self.pos += 1
+        if kind == "string":
+            return json.loads(token, strict=False)
+        if kind == "number":
+            return json.loads(token)
+        if kind == "literal":
+            return _LITERALS[token]
+        if token == "{":
+            return self.parse_object()
+        if token == "[":
+            return self.parse_array()
+        raise ValueError(f"Unexpected token {token}")
+
+    def parse_object(self):
+        obj = {}
+        while True:
+            kind, token = self._peek()
+            if kind is None:
+                return obj
+            self.pos += 1
+            if token == "}":
+                return obj
+            if kind != "string":
+                # Trailing/doubled commas, stray colons and brackets, and unquoted keys are skipped
+                continue
+            key = json.loads(token, strict=False)
+            if self._peek()[1] == ":":
+                self.pos += 1
+            if self._peek()[1] in ("}", "]", ","):
+                # The value is missing; drop the key but leave the token, which may close this object
+                continue
+            try:
+                value = self.parse_value()
+            except ValueError:
+                continue
+            obj[key] = value
+
+    def parse_array(self):
+        array = []
+        while True:
+            kind, token = self._peek()
+            if kind is None:
+                return array
+            if token == "]":
+                self.pos += 1
+                return array
+            if token in (",", ":", "}"):
+                self.pos += 1
+                continue
+            try:
+                array.append(self.parse_value())
+            except ValueError:
+                continue
+
+
+def repair_json(text):
+    """
+    Returns the JSON object in text, repairing common defects: missing or trailing commas, missing colons, Python-style
+    literals, control characters in strings, and truncation (open objects and arrays are closed off where the text
+    ends, and a key left without a value is dropped).
+
+    Returns None if no object with any members can be recovered.
+    """
+    start = text.find("{")
+    if start < 0:
+        return None
+    parser = _TolerantParser(_tokenize(text[start + 1 :]))
+    result = parser.parse_object()
+    if parser.truncated:
+        log_msg(f"Repaired JSON was truncated; kept {len(result)} top-level members.")
+    return result or None
+
+
+class JSONRepairStats:
+    """
+    Counts how JSON responses were handled: valid as received, repaired locally, retried, or given up on.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset_stats()
+
+    def reset_stats(self):
+        self.valid = 0
+        self.repaired = 0
+        self.retried = 0
+        self.failed = 0
+
+    def record(self, outcome):
+        with self._lock:
+            setattr(self, outcome, getattr(self, outcome) + 1)
+
+    def log_stats(self):
+        malformed = self.repaired + self.retried + self.failed
+        total = self.valid + malformed
+        repair_rate = (self.repaired / malformed * 100) if malformed else 0.0
+        log_msg(
+            f"JSON response stats: {total} responses, {self.valid} valid, {self.repaired} repaired locally, "
+            f"{self.retried} retried, {self.failed} unusable ({repair_rate:.1f}% of malformed responses repaired)"
+        )
+
+
+_json_repair_stats = JSONRepairStats()
+
+
+def get_json_repair_stats():
+    """
+    Returns the process-wide counts of valid, repaired and retried JSON responses.
+    """
+    return _json_repair_stats
@@ -0,0 +1,112 @@
+"""
+Incremental parsing of a JSON object as it's streamed in, one top-level member at a time.
+"""
+
+import json
+
+from utils import log_msg
+
+from .json_repair import repair_json
+
+
+class IncrementalJSONObjectParser:
+    """
+    Pulls the members of a top-level JSON object out of text fed in piece by piece, e.g. from a streamed completion.
+
+    Each (key, value) pair is returned by feed() as soon as its value is complete, so for parse output (entity name =>
+    relationships object) entities can be used while the rest of the response is still being generated. Anything
+    before the opening brace, like an "Output:" prefix, is ignored, and a member that isn't valid JSON is repaired if
+    possible (see gpt.json_repair) or else skipped, without affecting the ones after it.
+    """
+
+    def __init__(self):
+        self._buffer = ""
+        # Position in the buffer up to which text has been scanned
+        self._pos = 0
+        self._started = False
+        self._depth = 0
+        self._in_string = False
+        self._escaped = False
+        # Where the member currently being read starts, and whether it's already been returned
+        self._member_start = 0
+        self._member_done = False
+        self.complete = False
+        self.members_parsed = 0
+        self.members_skipped = 0
+
+    def feed(self, text):
+        """
+        Add the next piece of text, returning a list of the (key, value) pairs completed by it.
+        """
+        members = []
+        if self.complete or not text:
+            return members
+        self._buffer += text
+
+        buffer = self._buffer
+        pos = self._pos
+        while pos < len(buffer):
+            char = buffer[pos]
+            if not self._started:
+                if char == "{":
+                    self._started = True
+                    self._depth = 1
+                    self._member_start = pos + 1
+            elif self._in_string:
+                if self._escaped:
+                    self._escaped = False
+                elif char == "\\":
+                    self._escaped = True
+                elif char == '"':
+                    self._in_string = False
+            elif char == '"':
+                self._in_string = True
+                if self._depth == 1 and self._member_done:
+                    # A key right after a completed member means the comma between them was left out
+                    self._member_start = pos
+                    self._member_done = False
+            elif char in "{[":
+                self._depth += 1
+            elif char in "}]":
+                self._depth -= 1
+                if self._depth == 1 and not self._member_done:
+                    # An object or array value just closed, so the member is complete without waiting for a comma
+                    self._add_member(buffer[self._member_start : pos + 1], members)
+                    self._member_done = True
+                elif self._depth <= 0:
+                    if not self._member_done:
+                        self._add_member(buffer[self._member_start : pos], members)
+                    self.complete = True
+                    pos += 1
+                    break
+            elif char == "," and self._depth == 1:
+                if not self._member_done:
+                    self._add_member(buffer[self._member_start : pos], members)
+                self._member_start = pos + 1
+                self._member_done = False
+            pos += 1
+
+        # Drop text that's already been dealt with so the buffer only holds the member being read
+        reading_member = self._started and not self.complete and not self._member_done
+        trim_to = self._member_start if reading_member else pos
+        self._buffer = buffer[trim_to:]
+        self._pos = pos - trim_to
+        self._member_start = max(0, self._member_start - trim_to)
+        return members
+
+    def _add_member(self, member_text, members):
+        member_text = member_text.strip()
+        if not member_text:
+            return
+        try:
+            member = json.loads("{" + member_text + "}")
+        except json.decoder.JSONDecodeError:
+            member = repair_json("{" + member_text + "}")
+            if member is None:
+                log_msg(f"Skipping streamed JSON member that isn't valid: {member_text[:100]}")
+                self.members_skipped += 1
+                return
+        for key, value in member.items():
+            self.members_parsed += 1
+            members.append((key, value))
+
@@ -2,14 +2,26 @@
 All GPT-specific code used for parsing entities and relationships out of text.
 """
 
+import asyncio
+import json
+import math
 import time
 
 import openai
 
-from utils import log_msg
+from utils import json_codec, log_msg
 
-from .common import async_fetch_from_openai, get_context_window_size
-from .text import get_token_length
+from .chunk_sizing import get_chunk_sizing_profile
+from .common import (
+    ChunkTooLargeError,
+    async_fetch_from_openai,
+    async_stream_from_openai,
+    clean_json_value,
+    get_context_window_size,
+)
+from .json_stream import IncrementalJSONObjectParser
+from .parse_cache import get_parse_cache, make_parse_cache_key
+from .text import get_token_length, split_to_token_size
 
 
 PARSE_SM_TEMPLATE = (
@@ -60,22 +72,31 @@ SAMPLE_PARSE_OUTPUT = (
     "{"
     '\n"Tom Currier": {'
     '\n  "studied at": ["Stanford University", "Harvard"],'
-    '\n  "winner of": "Thiel Fellowship"'
+    '\n  "winner of": "Thiel Fellowship",'
     '\n  "_ENTITY_TYPE": "Other"'
     "\n},"
     '\n"Stanford University": {'
     '\n  "students": ["Tom Currier"],'
-    '\n  "abbreviation": "SU"'
+    '\n  "abbreviation": "SU",'
     '\n  "_ENTITY_TYPE": "Other"'
     "\n},"
     '\n"SU": {'
     '\n  "abbreviation of": "Stanford University",'
     '\n  "_ENTITY_TYPE": "Other"'
-    "\n},"
+    "\n}"
     "\n}"
 )
 NO_ENTITIES_MARKER = "NO_ENTITIES_FOUND"
 
+# Chunks shorter than this (in tokens) aren't split any further when they overflow the context or output limit
+MIN_SPLIT_TOKENS = 100
+# Tokens left free in each request to account for structural overhead + just to be safe
+PARSE_MARGIN_OF_ERROR = 200
+# Least room for output a chunk sized from an output token profile may leave
+MIN_OUTPUT_TOKENS = 256
+# max_tokens is set this much above the profile's expected output, when there's room
+MAX_TOKENS_HEADROOM = 1.5
+
 
 PARSE_SYSTEM_MESSAGE = {
     "role": "system",
@@ -113,9 +134,27 @@ def get_output_reservation(model):
         return 1600
 
 
-def get_text_token_limit(model):
+def get_max_completion_tokens(model):
+    """
+    Return the most tokens a given model will generate in one response, regardless of room in the context window.
+    """
+    if model == "gpt-4o" or model == "gpt-4o-mini":
+        # Max completion tokens: 16,384
+        return 16000  # Leave a small buffer
+    else:
+        return 4096
+
+
+def _get_parse_prompt(prompt_override=None):
+    return prompt_override or PARSE_SYSTEM_MESSAGE["content"]
+
+
+def get_text_token_limit(model, prompt_override=None):
     """
     Returns desired length of text to be parsed, in number of tokens, based on model to be used.
+
+    Once enough responses to the model and prompt have been seen, chunks are sized from the observed ratio of output
+    to input tokens (see gpt.chunk_sizing) rather than the fixed output reservation.
     """
     # Different models have different max context sizes, where "context size" is the total number of tokens
     # used in the completion request, inclduding all of: the prompt in the system message, the text to be parsed,
@@ -123,7 +162,8 @@ def get_text_token_limit(model):
     # Can check token length using https://platform.openai.com/tokenizer
 
     # The number of tokens in the system message prompt.
-    parse_prompt_tokens = get_token_length(PARSE_SYSTEM_MESSAGE["content"], model=model)
+    parse_prompt = _get_parse_prompt(prompt_override)
+    parse_prompt_tokens = get_token_length(parse_prompt, model=model)
 
     # The maximum number of tokens in this model's context window.
     max_context_tokens = get_context_window_size(model)
@@ -132,20 +172,53 @@ def get_text_token_limit(model):
     output_reservation = get_output_reservation(model)
 
     # Leave ourselves a margin of error to account for structural overhead + just to be safe.
-    margin_of_error = 200
+    margin_of_error = PARSE_MARGIN_OF_ERROR
 
     tokens_for_input = (
         max_context_tokens - parse_prompt_tokens - output_reservation - margin_of_error
     )
 
-    return tokens_for_input
+    output_ratio = get_chunk_sizing_profile().get_output_ratio(model, parse_prompt)
+    if output_ratio is None:
+        return tokens_for_input
+
+    # Largest chunk whose expected output still fits both the rest of the context window and the completion limit
+    tokens_for_request = max_context_tokens - parse_prompt_tokens - margin_of_error
+    adaptive_tokens_for_input = min(
+        tokens_for_request / (1 + output_ratio),
+        get_max_completion_tokens(model) / output_ratio,
+        tokens_for_request - MIN_OUTPUT_TOKENS,
+    )
+    # Don't let a profile skewed by a few odd responses shrink chunks to almost nothing
+    return int(max(adaptive_tokens_for_input, tokens_for_input // 4))
 
 
-def get_text_size_limit(model):
+def get_parse_max_tokens(model, text_tokens, prompt_override=None):
+    """
+    Returns max_tokens for a parse request with text_tokens of text to parse.
+    """
+    parse_prompt = _get_parse_prompt(prompt_override)
+    output_ratio = get_chunk_sizing_profile().get_output_ratio(model, parse_prompt)
+    if output_ratio is None:
+        return get_output_reservation(model)
+
+    parse_prompt_tokens = get_token_length(parse_prompt, model=model)
+    room_for_output = (
+        get_context_window_size(model) - parse_prompt_tokens - text_tokens - PARSE_MARGIN_OF_ERROR
+    )
+    expected_output = math.ceil(output_ratio * text_tokens * MAX_TOKENS_HEADROOM)
+    max_tokens = min(
+        get_max_completion_tokens(model), room_for_output, max(expected_output, MIN_OUTPUT_TOKENS)
+    )
+    # An overfull chunk gets a context length error and is split, whatever max_tokens is
+    return max(max_tokens, 1)
+
+
+def get_text_size_limit(model, prompt_override=None):
     """
     Returns desired length of text to be parsed, in number of characters, based on model to be used.
     """
-    tokens_for_input = get_text_token_limit(model)
+    tokens_for_input = get_text_token_limit(model, prompt_override=prompt_override)
 
     # Each token is about 3-4 characters for freeform text (e.g. the text to be parsed, which is what we're sizing here).
     chars_per_token = 3.5
@@ -168,6 +241,242 @@ def get_timeout_limit(model):
         return 60
 
 
+class ParseResult(dict):
+    """
+    Entities parsed from a piece of text: entity name => dict of relationship name => target(s), plus "_ENTITY_TYPE".
+
+    Parse results stay decoded from the GPT response on, and are only encoded as JSON where they're written out
+    (cache, output files, HTTP responses). An empty result means no entities were found or the parse was skipped.
+    """
+
+    @classmethod
+    def from_json(cls, data):
+        """
+        Decode a parse result from JSON, returning an empty result if it isn't a valid JSON object.
+        """
+        try:
+            entities = json_codec.loads(data)
+        except json.decoder.JSONDecodeError:
+            log_msg("Parse result not valid JSON; treating it as empty.")
+            return cls()
+        if not isinstance(entities, dict):
+            return cls()
+        return cls(entities)
+
+    def to_json(self, indent=True):
+        return json_codec.dumps(self, indent=indent)
+
+
+def make_parse_result_merger():
+    """
+    Returns a new merge.ParseResultMerger, the one policy parse results from different pieces of text are merged by.
+    """
+    # The merge module imports gpt, so it can only be imported once gpt is loaded
+    import merge
+
+    return merge.ParseResultMerger()
+
+
+def merge_parse_results(parse_results):
+    """
+    Merge parse results for consecutive pieces of text into one, in order (see merge.ParseResultMerger).
+
+    Results that are empty or not dicts are left out, and the results passed in aren't modified.
+    """
+    return make_parse_result_merger().add_all(parse_results).result()
+
+
+async def _fetch_parse_splitting_on_overflow(
+    text: str, system_message, model, timeout, skip_on_error
+):
+    """
+    Fetch a parse of text as a ParseResult, bisecting it and parsing the pieces whenever it's too large for the context
+    window or its output gets cut off, then merging their results back together in order. Pieces are parsed one at a
+    time, so callers holding a request slot never have more than one request in flight.
+
+    Token usage of each response is recorded in the chunk sizing profile for the model and prompt.
+    """
+    prompt = system_message["content"]
+    token_count = get_token_length(text, model=model)
+
+    def record_usage(usage, finish_reason):
+        if usage and "completion_tokens" in usage:
+            get_chunk_sizing_profile().record(
+                model, prompt, token_count, usage["completion_tokens"], truncated=finish_reason == "length"
+            )
+
+    try:
+        entities = await async_fetch_from_openai(
+            [system_message, {"role": "user", "content": text}],
+            log_label="Parse",
+            model=model,
+            max_tokens=get_parse_max_tokens(model, token_count, prompt_override=prompt),
+            timeout=timeout,
+            skip_on_error=skip_on_error,
+            skip_msg=NO_ENTITIES_MARKER,
+            expect_json_result=True,
+            response_format={"type": "json_object"},  # Enable JSON mode
+            raise_on_overflow=True,
+            usage_callback=record_usage,
+            decode_json_result=True,
+        )
+        return ParseResult(entities) if isinstance(entities, dict) else ParseResult()
+    except ChunkTooLargeError as err:
+        pieces = []
+        if token_count >= MIN_SPLIT_TOKENS:
+            pieces = split_to_token_size(text, token_limit=(token_count + 1) // 2, model=model)
+        if len(pieces) < 2:
+            log_msg(f"Chunk of {token_count} tokens too large for {model} ({err.reason}) and can't be split further.")
+            if skip_on_error:
+                return ParseResult()
+            raise
+        log_msg(f"Chunk of {token_count} tokens too large for {model} ({err.reason}); splitting into {len(pieces)}.")
+
+    # One after another, so a split chunk still makes only one request at a time against its caller's request slot
+    piece_results = []
+    for piece in pieces:
+        piece_results.append(
+            await _fetch_parse_splitting_on_overflow(
+                piece, system_message, model, timeout, skip_on_error
+            )
+        )
+    return merge_parse_results(piece_results)
+
+
+async def _stream_parse_splitting_on_overflow(
+    text: str, system_message, model, timeout, skip_on_error, stream_state, retries_remaining=2
+):
+    """
+    Stream a parse of text, yielding (entity name, entity data) pairs as each entity in the response is complete.
+
+    Input too large for the context window, or whose response is cut off at max_tokens, is bisected and the pieces
+    streamed one after another, as for non-streamed parses. Entities yielded before a response was cut off can be
+    yielded again by the pieces, so callers should merge rather than replace them. If the response times out or fails
+    partway through, or is cut off and can't be split further, the entities already yielded are kept and
+    stream_state["complete"] is set to False.
+    """
+    prompt = system_message["content"]
+    token_count = get_token_length(text, model=model)
+
+    def record_usage(usage, finish_reason):
+        if usage and "completion_tokens" in usage:
+            get_chunk_sizing_profile().record(
+                model, prompt, token_count, usage["completion_tokens"], truncated=finish_reason == "length"
+            )
+
+    json_parser = IncrementalJSONObjectParser()
+    entities_yielded = 0
+    try:
+        async for content in async_stream_from_openai(
+            [system_message, {"role": "user", "content": text}],
+            log_label="Parse",
+            model=model,
+            max_tokens=get_parse_max_tokens(model, token_count, prompt_override=prompt),
+            timeout=timeout,
+            response_format={"type": "json_object"},  # Enable JSON mode
+            raise_on_overflow=True,
+            usage_callback=record_usage,
+        ):
+            for ent_name, ent_data in json_parser.feed(content):
+                ent_data = clean_json_value(ent_name, ent_data)
+                if ent_data is None:
+                    continue
+                entities_yielded += 1
+                yield ent_name, ent_data
+        if json_parser.members_skipped:
+            stream_state["complete"] = False
+        return
+    except ChunkTooLargeError as err:
+        pieces = []
+        if token_count >= MIN_SPLIT_TOKENS:
+            pieces = split_to_token_size(text, token_limit=(token_count + 1) // 2, model=model)
+        if len(pieces) < 2:
+            log_msg(f"Chunk of {token_count} tokens too large for {model} ({err.reason}) and can't be split further.")
+            stream_state["complete"] = False
+            if entities_yielded:
+                log_msg(f"Keeping the {entities_yielded} entities received.")
+                return
+            if skip_on_error:
+                return
+            raise
+        # Entities already yielded from a cut-off response will generally be yielded again by the pieces
+        log_msg(f"Chunk of {token_count} tokens too large for {model} ({err.reason}); splitting into {len(pieces)}.")
+    except Exception as err:
+        if entities_yielded:
+            # Retrying would repeat entities already passed along, so settle for what we have
+            log_msg(f"Streamed parse failed partway through ({err}); keeping the {entities_yielded} entities received.")
+            stream_state["complete"] = False
+            return
+        if retries_remaining > 0:
+            log_msg(f"Streamed parse failed ({err}). Trying again...")
+            async for entity in _stream_parse_splitting_on_overflow(
+                text, system_message, model, timeout, skip_on_error, stream_state, retries_remaining - 1
+            ):
+                yield entity
+            return
+        stream_state["complete"] = False
+        if skip_on_error:
+            log_msg(f"Streamed parse failed ({err}). Out of retries, skipping this chunk.")
+            return
+        raise
+
+    for piece in pieces:
+        async for entity in _stream_parse_splitting_on_overflow(
+            piece, system_message, model, timeout, skip_on_error, stream_state
+        ):
+            yield entity
+
+
+async def async_stream_parse(
+    text: str,
+    model="gpt-3.5-turbo",
+    skip_on_error=False,
+    prompt_override=None,
+):
+    """
+    Stream a parse of text from GPT, yielding (entity name, entity data) pairs as soon as each entity is complete.
+
+    Chunks whose response is cut off are re-parsed in pieces, so the same entity can be yielded more than once, each
+    time with the relationships found in another piece; merge them with merge_parse_results or
+    make_parse_result_merger. A parse that times out partway through still yields the entities received before that.
+    If a parse cache is configured, cached entities are yielded straight from it, and parses that completed normally
+    are stored in it.
+    """
+    timeout = get_timeout_limit(model)
+
+    if prompt_override:
+        system_message = {"role": "system", "content": prompt_override}
+    else:
+        system_message = PARSE_SYSTEM_MESSAGE
+
+    parse_cache = get_parse_cache()
+    if parse_cache:
+        cache_key = make_parse_cache_key(text, model, system_message["content"])
+        cached_result = await asyncio.to_thread(parse_cache.get, cache_key)
+        if cached_result is not None:
+            log_msg("Parse cache hit; skipping OpenAI request.")
+            for ent_name, ent_data in ParseResult.from_json(cached_result).items():
+                yield ent_name, ent_data
+            return
+        log_msg("Parse cache miss.")
+
+    start_time = time.time()
+    stream_state = {"complete": True}
+    merger = make_parse_result_merger()
+    async for ent_name, ent_data in _stream_parse_splitting_on_overflow(
+        text, system_message, model, timeout, skip_on_error, stream_state
+    ):
+        merger.add({ent_name: ent_data})
+        yield ent_name, ent_data
+    entities = merger.result()
+    time_spent = time.time() - start_time
+    log_msg(f"Streamed parse of {len(entities)} entities finished in {time_spent:.2f} seconds.")
+
+    # Partial results are better than nothing for this request, but shouldn't be reused for later ones
+    if parse_cache and entities and stream_state["complete"]:
+        await asyncio.to_thread(parse_cache.put, cache_key, entities.to_json())
+
+
 def get_default_parse_prompt():
     """
     Returns default prompt for parse query.
@@ -181,11 +490,29 @@ async def async_fetch_parse(
     skip_on_error=False,
     prompt_override=None,
     return_source=False,
+    stream=False,
+    on_entity=None,
 ):
     """
-    Retrieve parse response from GPT for given block of text.
+    Retrieve parse response from GPT for given block of text, as a ParseResult.
+
+    If a parse cache is configured, it's checked first and successful results are stored in it.
+    If stream is set, the response is streamed (see async_stream_parse) and on_entity, if provided, is called with
+    each entity's name and data as soon as it's received.
     """
-    max_tokens = get_output_reservation(model)
+    if stream:
+        merger = make_parse_result_merger()
+        async for ent_name, ent_data in async_stream_parse(
+            text, model=model, skip_on_error=skip_on_error, prompt_override=prompt_override
+        ):
+            merger.add({ent_name: ent_data})
+            if on_entity:
+                on_entity(ent_name, ent_data)
+        parse_result = merger.result()
+        if return_source:
+            return text, parse_result
+        return parse_result
+
     timeout = get_timeout_limit(model)
 
     if prompt_override:
@@ -193,27 +520,32 @@ async def async_fetch_parse(
     else:
         system_message = PARSE_SYSTEM_MESSAGE
 
-    messages = [system_message, {"role": "user", "content": text}]
+    parse_cache = get_parse_cache()
+    if parse_cache:
+        cache_key = make_parse_cache_key(text, model, system_message["content"])
+        cached_result = await asyncio.to_thread(parse_cache.get, cache_key)
+        if cached_result is not None:
+            log_msg("Parse cache hit; skipping OpenAI request.")
+            cached_result = ParseResult.from_json(cached_result)
+            if return_source:
+                return text, cached_result
+            return cached_result
+        log_msg("Parse cache miss.")
 
     start_time = time.time()
-    parse_result = await async_fetch_from_openai(
-        messages,
-        log_label="Parse",
-        model=model,
-        max_tokens=max_tokens,
-        timeout=timeout,
-        skip_on_error=skip_on_error,
-        skip_msg=NO_ENTITIES_MARKER,
-        expect_json_result=True,
-        response_format={"type": "json_object"},  # Enable JSON mode
+    # Chunks too large for the context window or output limit are split and their results merged
+    parse_result = await _fetch_parse_splitting_on_overflow(
+        text, system_message, model, timeout, skip_on_error
     )
     end_time = time.time()
     time_spent = end_time - start_time
     log_msg(f"Parse results fetched in {time_spent:.2f} seconds.")
 
-    log_msg(
-        f"Parse result length (in tokens): {get_token_length(parse_result, model=model)}"
-    )
+    log_msg(f"Parse result has {len(parse_result)} entities.")
+
+    # Empty results can mean a skipped error as well as "no entities", so only cache real output
+    if parse_cache and parse_result:
+        await asyncio.to_thread(parse_cache.put, cache_key, parse_result.to_json())
 
     if return_source:
         return text, parse_result
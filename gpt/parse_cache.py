@@ -0,0 +1,271 @@
+"""
+Persistent cache of parse results, keyed by a hash of the chunk text, model and system prompt.
+"""
+
+import datetime
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+
+import aws
+from utils import log_msg
+
+
+DEFAULT_PARSE_CACHE_MAX_BYTES = 1024 * 1024 * 1024
+# When over the size limit, evict down to this fraction of it so we don't evict on every write
+EVICTION_TARGET_RATIO = 0.9
+# S3 cache hits only refresh an object's access time once it's this many seconds old, so most hits are a single read
+S3_TOUCH_MIN_AGE = 24 * 60 * 60
+
+
+def make_parse_cache_key(text, model, system_prompt):
+    """
+    Returns the cache key for parsing text with a given model and system prompt.
+    """
+    hasher = hashlib.sha256()
+    for part in (model, system_prompt, text):
+        encoded = part.encode("utf-8")
+        # Length-prefix each part so different splits of the same bytes can't collide
+        hasher.update(str(len(encoded)).encode("utf-8") + b":" + encoded)
+    return hasher.hexdigest()
+
+
+class ParseCache:
+    """
+    Base class for parse cache backends. Keeps hit/miss counters for reporting in job logs.
+
+    The backends store any text values, so other caches (like batch.convert_cache) reuse them under their own name.
+    """
+
+    def __init__(self, max_bytes=DEFAULT_PARSE_CACHE_MAX_BYTES, name="parse cache"):
+        self.max_bytes = int(max_bytes)
+        self.name = name
+        # Caches are read and written from asyncio.to_thread workers, so counters are updated under a lock
+        self._stats_lock = threading.Lock()
+        self.reset_stats()
+
+    def _count(self, stat, amount=1):
+        with self._stats_lock:
+            setattr(self, stat, getattr(self, stat) + amount)
+
+    def get(self, key):
+        try:
+            value = self._get(key)
+        except Exception as err:
+            log_msg(f"Error reading from {self.name}: {err}")
+            value = None
+        self._count("misses" if value is None else "hits")
+        return value
+
+    def put(self, key, value):
+        try:
+            self._put(key, value)
+            self._count("writes")
+        except Exception as err:
+            log_msg(f"Error writing to {self.name}: {err}")
+
+    def reset_stats(self):
+        self.hits = 0
+        self.misses = 0
+        self.writes = 0
+        self.evictions = 0
+
+    def log_stats(self):
+        lookups = self.hits + self.misses
+        hit_rate = (self.hits / lookups * 100) if lookups else 0.0
+        log_msg(
+            f"{self.name.capitalize()} stats: {self.hits} hits, {self.misses} misses ({hit_rate:.1f}% hit rate), "
+            f"{self.writes} writes, {self.evictions} evictions"
+        )
+
+    def _get(self, key):
+        raise NotImplementedError
+
+    def _put(self, key, value):
+        raise NotImplementedError
+
+
+class SqliteParseCache(ParseCache):
+    """
+    Parse cache stored in a local SQLite file, evicting least recently used entries once over max_bytes.
+    """
+
+    def __init__(self, db_path, max_bytes=DEFAULT_PARSE_CACHE_MAX_BYTES, name="parse cache"):
+        super().__init__(max_bytes=max_bytes, name=name)
+        if os.path.dirname(db_path):
+            os.makedirs(os.path.dirname(db_path), exist_ok=True)
+        self.db_path = db_path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(db_path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS parse_cache ("
+            "  key TEXT PRIMARY KEY,"
+            "  value TEXT NOT NULL,"
+            "  size INTEGER NOT NULL,"
+            "  last_access REAL NOT NULL"
+            ")"
+        )
+        self._conn.execute(
+            "CREATE INDEX IF NOT EXISTS parse_cache_last_access ON parse_cache (last_access)"
+        )
+        self._conn.commit()
+        self._total_bytes = self._conn.execute(
+            "SELECT COALESCE(SUM(size), 0) FROM parse_cache"
+        ).fetchone()[0]
+
+    def _get(self, key):
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT value FROM parse_cache WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None:
+                return None
+            self._conn.execute(
+                "UPDATE parse_cache SET last_access = ? WHERE key = ?", (time.time(), key)
+            )
+            self._conn.commit()
+            return row[0]
+
+    def _put(self, key, value):
+        size = len(value.encode("utf-8"))
+        with self._lock:
+            existing = self._conn.execute(
+                "SELECT size FROM parse_cache WHERE key = ?", (key,)
+            ).fetchone()
+            self._conn.execute(
+                "INSERT OR REPLACE INTO parse_cache (key, value, size, last_access) VALUES (?, ?, ?, ?)",
+                (key, value, size, time.time()),
+            )
+            self._total_bytes += size - (existing[0] if existing else 0)
+            if self._total_bytes > self.max_bytes:
+                self._evict()
+            self._conn.commit()
+
+    def _evict(self):
+        target_bytes = self.max_bytes * EVICTION_TARGET_RATIO
+        to_delete = []
+        for key, size in self._conn.execute(
+            "SELECT key, size FROM parse_cache ORDER BY last_access ASC"
+        ):
+            if self._total_bytes <= target_bytes:
+                break
+            to_delete.append((key,))
+            self._total_bytes -= size
+        self._conn.executemany("DELETE FROM parse_cache WHERE key = ?", to_delete)
+        self._count("evictions", len(to_delete))
+
+
+class S3ParseCache(ParseCache):
+    """
+    Parse cache stored as one object per entry under an S3 prefix.
+
+    Hits on objects older than S3_TOUCH_MIN_AGE refresh their LastModified time, so recency is kept to within a day
+    without turning every read into a write. Once roughly a tenth of max_bytes has been written since the last
+    check the prefix is listed and the least recently used objects are deleted until it's back under the limit.
+    """
+
+    def __init__(self, prefix_uri, max_bytes=DEFAULT_PARSE_CACHE_MAX_BYTES, name="parse cache"):
+        super().__init__(max_bytes=max_bytes, name=name)
+        self.bucket, prefix = aws.parse_s3_uri(prefix_uri)
+        if not self.bucket:
+            raise ValueError(f"Invalid S3 URI for {name}: {prefix_uri}")
+        self.prefix = prefix.strip("/")
+        self._lock = threading.Lock()
+        self._bytes_since_check = 0
+
+    def _object_key(self, key):
+        return f"{self.prefix}/{key[:2]}/{key}.json".lstrip("/")
+
+    def _get(self, key):
+        s3_client = aws.get_s3_client()
+        object_key = self._object_key(key)
+        try:
+            response = s3_client.get_object(Bucket=self.bucket, Key=object_key)
+        except s3_client.exceptions.NoSuchKey:
+            return None
+        value = response["Body"].read().decode("utf-8")
+        age = datetime.datetime.now(datetime.timezone.utc) - response["LastModified"]
+        if age.total_seconds() < S3_TOUCH_MIN_AGE:
+            return value
+        # Copy the object onto itself to bump LastModified, which eviction uses as the access time
+        s3_client.copy_object(
+            Bucket=self.bucket,
+            Key=object_key,
+            CopySource={"Bucket": self.bucket, "Key": object_key},
+            MetadataDirective="REPLACE",
+        )
+        return value
+
+    def _put(self, key, value):
+        data = value.encode("utf-8")
+        aws.get_s3_client().put_object(
+            Bucket=self.bucket, Key=self._object_key(key), Body=data
+        )
+        with self._lock:
+            self._bytes_since_check += len(data)
+            should_check = self._bytes_since_check > self.max_bytes * (1 - EVICTION_TARGET_RATIO)
+            if should_check:
+                self._bytes_since_check = 0
+        if should_check:
+            self._evict()
+
+    def _evict(self):
+        s3_client = aws.get_s3_client()
+        paginator = s3_client.get_paginator("list_objects_v2")
+        objects = []
+        for page in paginator.paginate(Bucket=self.bucket, Prefix=f"{self.prefix}/".lstrip("/")):
+            objects.extend(page.get("Contents", []))
+
+        total_bytes = sum(obj["Size"] for obj in objects)
+        if total_bytes <= self.max_bytes:
+            return
+
+        target_bytes = self.max_bytes * EVICTION_TARGET_RATIO
+        to_delete = []
+        for obj in sorted(objects, key=lambda obj: obj["LastModified"]):
+            if total_bytes <= target_bytes:
+                break
+            to_delete.append({"Key": obj["Key"]})
+            total_bytes -= obj["Size"]
+
+        # delete_objects accepts at most 1000 keys per call
+        for i in range(0, len(to_delete), 1000):
+            s3_client.delete_objects(
+                Bucket=self.bucket, Delete={"Objects": to_delete[i:i + 1000], "Quiet": True}
+            )
+        self._count("evictions", len(to_delete))
+        log_msg(f"Evicted {len(to_delete)} entries from {self.name} at s3://{self.bucket}/{self.prefix}")
+
+
+_parse_cache = None
+
+
+def init_parse_cache(config):
+    """
+    Set up the process-wide parse cache from PARSE_CACHE_URI / PARSE_CACHE_MAX_BYTES, if configured.
+
+    PARSE_CACHE_URI can be an s3:// prefix or a local path to a SQLite file.
+    """
+    global _parse_cache
+    cache_uri = config.get("PARSE_CACHE_URI", None)
+    if not cache_uri:
+        _parse_cache = None
+        return None
+
+    max_bytes = int(config.get("PARSE_CACHE_MAX_BYTES", None) or DEFAULT_PARSE_CACHE_MAX_BYTES)
+    if aws.is_valid_s3_uri(cache_uri):
+        _parse_cache = S3ParseCache(cache_uri, max_bytes=max_bytes)
+    else:
+        _parse_cache = SqliteParseCache(cache_uri, max_bytes=max_bytes)
+    log_msg(f"Using parse cache at {cache_uri} (max {max_bytes:,} bytes)")
+    return _parse_cache
+
+
+def get_parse_cache():
+    """
+    Returns the process-wide parse cache, or None if caching isn't configured.
+    """
+    return _parse_cache
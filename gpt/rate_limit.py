@@ -0,0 +1,93 @@
+"""
+Token-bucket rate limiting for OpenAI requests.
+"""
+
+import asyncio
+import threading
+import time
+
+
+class TokenBucket:
+    """
+    Bucket that refills continuously up to its capacity. The level can go negative when a charge is reconciled upward.
+    """
+
+    def __init__(self, capacity, refill_per_second):
+        self.capacity = float(capacity)
+        self.refill_per_second = float(refill_per_second)
+        self.level = self.capacity
+        self.updated_at = time.monotonic()
+
+    def refill(self, now):
+        elapsed = now - self.updated_at
+        self.level = min(self.capacity, self.level + elapsed * self.refill_per_second)
+        self.updated_at = now
+
+    def time_until(self, amount):
+        """
+        Seconds until the bucket holds at least amount (0 if it already does). Assumes refill() was just called.
+        """
+        if self.level >= amount:
+            return 0.0
+        return (amount - self.level) / self.refill_per_second
+
+
+class RateLimiter:
+    """
+    Paces requests against both a requests-per-minute and a tokens-per-minute budget.
+
+    Callers charge an estimate up front with acquire() and settle the difference with reconcile() once the real usage
+    is known. State is guarded by a threading lock and waiting is done with asyncio.sleep, so one limiter can be shared
+    by coroutines running on different event loops (e.g. the web server and a batch job thread).
+    """
+
+    def __init__(self, requests_per_minute, tokens_per_minute):
+        self._requests = TokenBucket(requests_per_minute, requests_per_minute / 60.0)
+        self._tokens = TokenBucket(tokens_per_minute, tokens_per_minute / 60.0)
+        self._blocked_until = 0.0
+        self._lock = threading.Lock()
+
+    def _try_acquire(self, tokens):
+        now = time.monotonic()
+        if now < self._blocked_until:
+            return self._blocked_until - now
+        self._requests.refill(now)
+        self._tokens.refill(now)
+        wait = max(self._requests.time_until(1), self._tokens.time_until(tokens))
+        if wait > 0:
+            return wait
+        self._requests.level -= 1
+        self._tokens.level -= tokens
+        return 0.0
+
+    async def acquire(self, tokens):
+        """
+        Wait until one request and the given number of tokens are available, then take them.
+
+        Returns the number of tokens actually charged, which should be passed back to reconcile().
+        """
+        # A single request can never need more than a full bucket
+        tokens = min(int(tokens), int(self._tokens.capacity))
+        while True:
+            with self._lock:
+                wait = self._try_acquire(tokens)
+            if wait <= 0:
+                return tokens
+            await asyncio.sleep(wait)
+
+    def reconcile(self, charged_tokens, actual_tokens):
+        """
+        Adjust the token bucket once the real token usage of a request is known.
+        """
+        with self._lock:
+            self._tokens.refill(time.monotonic())
+            self._tokens.level = min(
+                self._tokens.capacity, self._tokens.level + charged_tokens - actual_tokens
+            )
+
+    def pause(self, seconds):
+        """
+        Hold back all requests for the given number of seconds, e.g. after the API reports a rate limit error.
+        """
+        with self._lock:
+            self._blocked_until = max(self._blocked_until, time.monotonic() + seconds)
@@ -2,6 +2,8 @@
 Utilities for interacting with input text.
 """
 
+import functools
+
 import tiktoken
 
 
@@ -60,79 +62,217 @@ def split_to_size(text: str, limit=TEXT_BLOCK_SIZE_LIMIT):
     return rechunked_text
 
 
-def get_token_length(text, model="gpt-3.5-turbo"):
+@functools.lru_cache(maxsize=None)
+def get_encoding(model="gpt-3.5-turbo"):
     """
-    Returns the number of tokens in the given text for the specified model.
+    Returns the (cached) tiktoken encoding for the specified model.
     """
     # Map new model names to their base tokenizer
     if model.startswith("gpt-4o"):
-        encoding = tiktoken.get_encoding(
-            "cl100k_base"
-        )  # GPT-4 and ChatGPT use cl100k_base
-    else:
-        encoding = tiktoken.encoding_for_model(model)
-    text_as_tokens = encoding.encode(text)
-    return len(text_as_tokens)
-
-
-def __split_paragraph_to_token_size(
-    paragraph: str, token_limit: int, model="gpt-3.5-turbo"
-):
-    encoding = tiktoken.encoding_for_model(model)
-    text_as_tokens = encoding.encode(paragraph)
-    text_chunks = []
+        # GPT-4 and ChatGPT use cl100k_base
+        return tiktoken.get_encoding("cl100k_base")
+    return tiktoken.encoding_for_model(model)
+
+
+def get_token_length(text, model="gpt-3.5-turbo"):
+    """
+    Returns the number of tokens in the given text for the specified model.
+    """
+    return len(get_encoding(model).encode_ordinary(text))
+
+
+def get_token_lengths(texts, model="gpt-3.5-turbo"):
+    """
+    Returns the number of tokens in each of the given texts, tokenizing them as a single batch.
+    """
+    if not texts:
+        return []
+    encoded = get_encoding(model).encode_ordinary_batch(list(texts))
+    return [len(tokens) for tokens in encoded]
+
+
+def __split_tokens_to_size(encoding, text_as_tokens, token_limit):
+    """
+    Split an already tokenized paragraph into (text, token count) pieces that each fit within token_limit.
+    """
+    pieces = []
     # Make each chunk 10 tokens smaller than the limit, to leave some room for error
     chunk_size = token_limit - 10
     while len(text_as_tokens) > token_limit:
         token_chunk = text_as_tokens[:chunk_size]
-        text_chunks.append(encoding.decode(token_chunk))
+        pieces.append((encoding.decode(token_chunk), len(token_chunk)))
         text_as_tokens = text_as_tokens[chunk_size:]
-    text_chunks.append(encoding.decode(text_as_tokens))
-    return text_chunks
+    pieces.append((encoding.decode(text_as_tokens), len(text_as_tokens)))
+    return pieces
 
 
-def split_to_token_size(text: str, token_limit: int, model="gpt-3.5-turbo"):
-    text = normalize_line_endings(text)
+# A paragraph longer than this many characters per token of the chunk limit is cut (at whitespace) before being split
+# by tokens, so text with no paragraph breaks never has to be held in memory all at once
+MAX_PARAGRAPH_CHARS_PER_LIMIT_TOKEN = 16
+# Paragraphs are tokenized in batches of roughly this many characters
+PARAGRAPH_BATCH_CHARS = 1024 * 1024
 
-    # Convenience function to make sure we're always passing model argument to get_token_length
-    def token_length(t):
-        return get_token_length(t, model=model)
 
-    # Split by paragraphs first
-    paragraph_chunks = list(filter(lambda x: x != "", text.split("\n\n")))
+def __iter_normalized_line_endings(text_pieces):
+    """
+    Normalize line endings across a stream of text pieces, including a \r\n split between two pieces.
+    """
+    held_cr = False
+    for piece in text_pieces:
+        if held_cr:
+            piece = "\r" + piece
+        held_cr = piece.endswith("\r")
+        if held_cr:
+            piece = piece[:-1]
+        yield normalize_line_endings(piece)
+    if held_cr:
+        yield "\n"
 
-    text_chunks = []
-    for chunk in paragraph_chunks:
-        if token_length(chunk) < token_limit:
-            # If paragraph is small enough, just add it to the list
+
+def __find_paragraph_cut(text, max_chars):
+    # Cut just before whitespace so the tokens on either side of the cut stay the same
+    cut = max(text.rfind(" ", 0, max_chars), text.rfind("\n", 0, max_chars))
+    return cut if cut > 0 else max_chars
+
+
+def __iter_paragraphs(text_pieces, max_paragraph_chars):
+    """
+    Yield (paragraph, start offset, was cut) for each non-empty paragraph in a stream of text pieces.
+
+    Paragraphs are separated by blank lines, same as text.split("\n\n"), except that any paragraph longer than
+    max_paragraph_chars is yielded in cut pieces as it streams in.
+    """
+    buffered = ""
+    buffered_start = 0
+    for piece in __iter_normalized_line_endings(text_pieces):
+        buffered += piece
+        paragraphs = buffered.split("\n\n")
+        # The last paragraph may continue in the next piece
+        buffered = paragraphs.pop()
+        for paragraph in paragraphs:
+            if paragraph != "":
+                yield paragraph, buffered_start, False
+            buffered_start += len(paragraph) + 2
+        while len(buffered) > max_paragraph_chars:
+            cut = __find_paragraph_cut(buffered, max_paragraph_chars)
+            yield buffered[:cut], buffered_start, True
+            buffered_start += cut
+            buffered = buffered[cut:]
+    if buffered != "":
+        yield buffered, buffered_start, False
+
+
+def __iter_batches(items, max_batch_chars):
+    batch = []
+    batch_chars = 0
+    for item in items:
+        batch.append(item)
+        batch_chars += len(item[0])
+        if batch_chars >= max_batch_chars:
+            yield batch
+            batch = []
+            batch_chars = 0
+    if batch:
+        yield batch
+
+
+def iter_token_chunks_with_offsets(text_pieces, token_limit: int, model="gpt-3.5-turbo"):
+    """
+    Split a stream of text pieces into chunks of fewer than token_limit tokens, keeping paragraphs together where
+    possible. Yields (chunk, start, end) tuples as soon as each chunk is complete, where start/end are character
+    offsets of the chunk's content in the full text after line endings are normalized.
+
+    Only the current paragraph batch and chunk are held in memory, so text_pieces can be a lazy stream (e.g. ranged
+    reads of a large file). Paragraphs are tokenized once, in batches, and chunks are built up with running token
+    totals rather than re-tokenizing a growing chunk every time another paragraph is considered for merging.
+
+    Each paragraph's count includes its trailing "\n\n", and a sum of counts can differ by a token or so from the count
+    of the joined text, so a chunk that lands right at token_limit may be cut one paragraph earlier or later than when
+    joined chunks were re-tokenized. scripts/benchmark_token_chunking.py reports whether the two agree on a given input.
+    """
+    encoding = get_encoding(model)
+    paragraphs = __iter_paragraphs(
+        text_pieces, max_paragraph_chars=token_limit * MAX_PARAGRAPH_CHARS_PER_LIMIT_TOKEN
+    )
+
+    def iter_text_pieces():
+        """
+        Yields (text, token count, can be merged with following text, start offset, end offset) tuples.
+        """
+        for batch in __iter_batches(paragraphs, PARAGRAPH_BATCH_CHARS):
             # Add back the double newline that was removed by the split for use in rechunking logic below
-            text_chunks.append(chunk + "\n\n")
-        else:
-            # Further split any paragraph that is too long into chunks using token boundaries
-            chunks_for_paragraph = __split_paragraph_to_token_size(
-                chunk, token_limit, model=model
-            )
-            text_chunks.extend(chunks_for_paragraph)
+            batch_texts = [paragraph + "\n\n" for paragraph, _, _ in batch]
+            token_lengths = get_token_lengths(batch_texts, model=model)
+            for (paragraph, start, was_cut), text, token_count in zip(
+                batch, batch_texts, token_lengths
+            ):
+                paragraph_end = start + len(paragraph)
+                if token_count < token_limit and not was_cut:
+                    # If paragraph is small enough, just add it to the list
+                    yield text, token_count, True, start, paragraph_end
+                    continue
+                # Further split any paragraph that is too long into chunks using token boundaries.
+                # Pieces of a split paragraph are never merged with whatever follows them.
+                paragraph_tokens = encoding.encode_ordinary(paragraph)
+                for piece, piece_tokens in __split_tokens_to_size(
+                    encoding, paragraph_tokens, token_limit
+                ):
+                    # Decoded lengths can drift slightly if a piece boundary splits a multi-byte character
+                    piece_end = min(start + len(piece), paragraph_end)
+                    yield piece, piece_tokens, False, start, piece_end
+                    start = piece_end
 
-    # Try to recombine chunks that are smaller than they need to be
-    rechunked_text = [text_chunks[0]]
-    i = 0
-    j = 1
-    while j < len(text_chunks):
-        if not rechunked_text[i].endswith("\n\n"):
-            # Don't try to recombine any chunk that wasn't its own paragraph
-            rechunked_text.append(text_chunks[j])
-            i += 1
-            j += 1
-            continue
-        if token_length(rechunked_text[i]) + token_length(text_chunks[j]) < token_limit:
-            rechunked_text[i] = rechunked_text[i] + text_chunks[j]
-            j += 1
+    # Recombine pieces that are smaller than they need to be
+    chunk_count = 0
+    cur_parts = []
+    cur_tokens = 0
+    cur_mergeable = False
+    cur_start = cur_end = 0
+    for piece, piece_tokens, mergeable, start, end in iter_text_pieces():
+        if cur_parts and cur_mergeable and cur_tokens + piece_tokens < token_limit:
+            cur_parts.append(piece)
+            cur_tokens += piece_tokens
         else:
-            rechunked_text.append(text_chunks[j])
-            i += 1
-            j += 1
+            if cur_parts:
+                chunk_count += 1
+                yield "".join(cur_parts), cur_start, cur_end
+            cur_parts = [piece]
+            cur_tokens = piece_tokens
+            cur_start = start
+        cur_mergeable = mergeable
+        cur_end = end
+    if cur_parts:
+        chunk_count += 1
+        yield "".join(cur_parts), cur_start, cur_end
 
-    log_msg(f"Split into {len(rechunked_text)} blocks of text")
+    log_msg(f"Split into {chunk_count} blocks of text")
 
-    return rechunked_text
+
+def iter_token_chunks(text_pieces, token_limit: int, model="gpt-3.5-turbo"):
+    """
+    Split a stream of text pieces into chunks of fewer than token_limit tokens, yielding each chunk once complete.
+    """
+    for chunk, _, _ in iter_token_chunks_with_offsets(text_pieces, token_limit, model=model):
+        yield chunk
+
+
+def split_to_token_size_with_offsets(text: str, token_limit: int, model="gpt-3.5-turbo"):
+    """
+    Split text into chunks of fewer than token_limit tokens, keeping paragraphs together where possible.
+
+    Returns a list of (chunk, start, end) tuples, where start/end are character offsets of the chunk's content in the
+    text after line endings are normalized.
+    """
+    return list(iter_token_chunks_with_offsets([text], token_limit, model=model))
+
+
+def split_to_token_size(text: str, token_limit: int, model="gpt-3.5-turbo"):
+    """
+    Split text into chunks of fewer than token_limit tokens, keeping paragraphs together where possible.
+    """
+    return [
+        chunk
+        for chunk, _, _ in split_to_token_size_with_offsets(
+            text, token_limit, model=model
+        )
+    ]
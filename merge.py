@@ -1,17 +1,136 @@
 '''
-Code for merging parse results using GPT.
+Code for merging parse results.
 
-This turned out to not work very well (GPT has issues with merging) and so is currently unused by any active code paths.
-The gap might be addressable through some prompt engineering; we can revisit at a future point.
+ParseResultMerger merges them locally and deterministically, and is what active code paths use.
+
+The rest of this module merges using GPT. This turned out to not work very well (GPT has issues with merging) and so is
+currently unused by any active code paths. The gap might be addressable through some prompt engineering; we can
+revisit at a future point.
 '''
 
 import asyncio
+from collections import Counter
 import json
 
 import gpt
+import neo
 from tasks import create_task_of_tasks
 
-from utils import log_msg
+from utils import log_msg, log_warn
+
+
+ENTITY_TYPE_KEY = '_ENTITY_TYPE'
+
+
+class _MergedEntity:
+    __slots__ = ('name', 'type_votes', 'relationships')
+
+    def __init__(self, name):
+        self.name = name
+        self.type_votes = Counter()
+        # Sanitized relationship name => (first name seen for it, {normalized target name => first name seen for it})
+        self.relationships = {}
+
+
+class ParseResultMerger:
+    '''
+    Merges parse results (entity name => relationships dicts) from any number of chunks into one, one chunk at a time.
+
+    Entities are unioned by normalized name, relationships by sanitized name, and relationship targets by normalized
+    name, each keeping the first spelling seen. An entity's type is whichever type it was given most often (the first
+    one given, on a tie). Each chunk is folded in as it's added and not kept, so memory grows with the merged result
+    rather than the number of chunks, and merging takes time linear in the total size of the results.
+    '''
+
+    def __init__(self):
+        self._entities = {}
+        self.chunks_merged = 0
+
+    def add(self, parse_result):
+        '''
+        Fold one chunk's parse result into the merge. Empty results and malformed entries are skipped.
+        '''
+        if not parse_result:
+            return
+        if not isinstance(parse_result, dict):
+            log_warn(f'Expected parse result to be a dict of entities, got: {type(parse_result)}. Skipping it.')
+            return
+        self.chunks_merged += 1
+        for ent_name, ent_data in parse_result.items():
+            if not isinstance(ent_name, str) or not isinstance(ent_data, dict):
+                continue
+            normalized_name = neo.normalize_entity_name(ent_name)
+            entity = self._entities.get(normalized_name)
+            if entity is None:
+                entity = _MergedEntity(ent_name)
+                self._entities[normalized_name] = entity
+            for key, value in ent_data.items():
+                if key == ENTITY_TYPE_KEY:
+                    if isinstance(value, str) and value:
+                        entity.type_votes[value] += 1
+                    continue
+                if isinstance(key, str):
+                    self.__add_relationship(entity, key, value)
+
+    def __add_relationship(self, entity, relationship_name, targets):
+        if isinstance(targets, str):
+            targets = [targets]
+        elif not isinstance(targets, list):
+            return
+        sanitized_name = neo.sanitize_relationship_name(relationship_name)
+        if not sanitized_name:
+            return
+        relationship = entity.relationships.get(sanitized_name)
+        if relationship is None:
+            relationship = (relationship_name, {})
+            entity.relationships[sanitized_name] = relationship
+        merged_targets = relationship[1]
+        for target in targets:
+            if isinstance(target, str) and target:
+                merged_targets.setdefault(neo.normalize_entity_name(target), target)
+
+    def add_all(self, parse_results):
+        for parse_result in parse_results:
+            self.add(parse_result)
+        return self
+
+    def __len__(self):
+        return len(self._entities)
+
+    def result(self):
+        '''
+        Returns the merged parse result so far, in the order entities and relationships were first seen.
+        '''
+        merged = gpt.ParseResult()
+        for entity in self._entities.values():
+            ent_data = {
+                relationship_name: list(targets.values())
+                for relationship_name, targets in entity.relationships.values()
+                if targets
+            }
+            if entity.type_votes:
+                ent_data[ENTITY_TYPE_KEY] = entity.type_votes.most_common(1)[0][0]
+            if ent_data:
+                merged[entity.name] = ent_data
+        return merged
+
+
+def merge_parse_results_locally(parse_results):
+    '''
+    Merge an iterable of parse results into one with ParseResultMerger.
+    '''
+    return ParseResultMerger().add_all(parse_results).result()
+
+
+async def amerge_parse_results_locally(parse_results):
+    '''
+    Merge parse results from an async iterator with ParseResultMerger, folding each in as it arrives.
+    '''
+    merger = ParseResultMerger()
+    async for parse_result in parse_results:
+        merger.add(parse_result)
+    log_msg(f'Merged {merger.chunks_merged} parse results into {len(merger)} entities')
+    return merger.result()
 
 
 def __group_parse_results(parse_results):
@@ -2,3 +2,4 @@
 from .common import *
 from .ent_data import *
 from .write import *
+from .bulk import *
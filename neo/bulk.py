@@ -0,0 +1,150 @@
+'''
+Batched writer for saving many entities and relationships to Neo4j in a few round trips.
+
+Instead of running one MERGE per entity/target/relationship, rows are collected in memory and written with
+parameterized UNWIND queries, one transaction per batch of rows.
+'''
+
+import time
+
+from utils import log_msg
+
+from .common import normalize_entity_name
+
+
+DEFAULT_BULK_BATCH_SIZE = 1000
+
+
+BULK_MERGE_ENTS_QUERY = (
+    "UNWIND $rows AS row "
+    "MERGE (ent:Entity {normalized_name: row.normalized_name}) "
+    "ON CREATE SET "
+    "   ent.name = row.name, "
+    "   ent.created_at = datetime(row.timestamp), "
+    "   ent.last_modified = datetime(row.timestamp), "
+    "   ent.sources = [row.source], "
+    "   ent.type = row.type "
+    "ON MATCH SET "
+    "   ent.sources = CASE "
+    "      WHEN ent.sources IS NULL THEN [row.source] "
+    "      ELSE CASE "
+    "          WHEN NOT row.source IN ent.sources THEN ent.sources + [row.source] "
+    "          ELSE ent.sources "
+    "      END "
+    "   END, "
+    "   ent.type = COALESCE(ent.type, row.type), "
+    "   ent.last_modified = datetime(row.timestamp)"
+)
+
+# Relationship types can't be parameterized in Cypher, so this is formatted once per relationship type.
+BULK_MERGE_RELS_QUERY_TEMPLATE = (
+    "UNWIND $rows AS row "
+    "MATCH (e1:Entity {normalized_name: row.ent1_name}) "
+    "MATCH (e2:Entity {normalized_name: row.ent2_name}) "
+    "MERGE (e1)-[r:%s]->(e2) "
+    "ON CREATE SET "
+    "   r.created_at = datetime(row.timestamp), "
+    "   r.last_modified = datetime(row.timestamp), "
+    "   r.sources = [row.source] "
+    "ON MATCH SET "
+    "   r.sources = CASE "
+    "      WHEN r.sources IS NULL THEN [row.source] "
+    "      ELSE CASE "
+    "          WHEN NOT row.source IN r.sources THEN r.sources + [row.source] "
+    "          ELSE r.sources "
+    "      END "
+    "   END, "
+    "   r.last_modified = datetime(row.timestamp)"
+)
+
+
+def _run_rows_in_tx(tx, query, rows):
+    tx.run(query, rows=rows).consume()
+
+
+def _batched(rows, batch_size):
+    for i in range(0, len(rows), batch_size):
+        yield rows[i:i + batch_size]
+
+
+class BulkGraphWriter:
+    '''
+    Collects entity records and writes them to Neo4j with batched UNWIND queries when flushed.
+    '''
+
+    def __init__(self, neo_driver, batch_size=DEFAULT_BULK_BATCH_SIZE):
+        self.driver = neo_driver
+        self.batch_size = max(1, int(batch_size))
+        # normalized entity name -> row
+        self._ent_rows = {}
+        # relationship name -> {(source entity, target entity, source uri) -> row}
+        self._rel_rows = {}
+
+    def __len__(self):
+        return len(self._ent_rows) + sum(len(rows) for rows in self._rel_rows.values())
+
+    def _add_entity_row(self, name, source, timestamp, ent_type=None):
+        normalized_name = normalize_entity_name(name)
+        row = self._ent_rows.get(normalized_name)
+        if row is None:
+            self._ent_rows[normalized_name] = {
+                'normalized_name': normalized_name,
+                'name': name,
+                'source': source,
+                'timestamp': timestamp,
+                'type': ent_type,
+            }
+        elif ent_type and not row['type']:
+            # Entity first seen as a relationship target; keep the type from its own entry
+            row['type'] = ent_type
+        return normalized_name
+
+    def add_entity(self, ent):
+        '''
+        Queue an EntityRecord, its relationship targets and its relationships to be written on the next flush.
+        '''
+        ent_name = self._add_entity_row(ent.name, ent.source, ent.timestamp, ent_type=ent.type)
+        for relationship_name, target_list in ent.relationships.items():
+            rel_rows = self._rel_rows.setdefault(relationship_name, {})
+            for target in target_list:
+                target_name = self._add_entity_row(target, ent.source, ent.timestamp)
+                rel_key = (ent_name, target_name, ent.source)
+                if rel_key not in rel_rows:
+                    rel_rows[rel_key] = {
+                        'ent1_name': ent_name,
+                        'ent2_name': target_name,
+                        'source': ent.source,
+                        'timestamp': ent.timestamp,
+                    }
+
+    def flush(self):
+        '''
+        Write all queued rows to Neo4j and clear the queue. Returns the number of rows written.
+        '''
+        ent_rows = list(self._ent_rows.values())
+        rel_rows_by_name = {name: list(rows.values()) for name, rows in self._rel_rows.items()}
+        self._ent_rows = {}
+        self._rel_rows = {}
+
+        rel_count = sum(len(rows) for rows in rel_rows_by_name.values())
+        total_rows = len(ent_rows) + rel_count
+        if not total_rows:
+            return 0
+
+        start_time = time.time()
+        with self.driver.session() as session:
+            # Entities must all exist before relationships between them can be matched
+            for batch in _batched(ent_rows, self.batch_size):
+                session.execute_write(_run_rows_in_tx, BULK_MERGE_ENTS_QUERY, batch)
+            for relationship_name, rel_rows in rel_rows_by_name.items():
+                query = BULK_MERGE_RELS_QUERY_TEMPLATE % relationship_name
+                for batch in _batched(rel_rows, self.batch_size):
+                    session.execute_write(_run_rows_in_tx, query, batch)
+        time_spent = time.time() - start_time
+
+        rows_per_sec = total_rows / time_spent if time_spent > 0 else float(total_rows)
+        log_msg(
+            f'Bulk wrote {len(ent_rows)} entities and {rel_count} relationships '
+            f'({len(rel_rows_by_name)} relationship types) in {time_spent:.2f} seconds '
+            f'({rows_per_sec:.1f} rows/sec)')
+        return total_rows
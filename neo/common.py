@@ -3,6 +3,8 @@ Shared utility functions frequently used when working with Neo4j.
 '''
 
 import json
+import threading
+import time
 from re import sub
 
 from neo4j import GraphDatabase
@@ -32,10 +34,19 @@ def make_timestamp():
     return DateTime.now()
 
 
+DEFAULT_NEO_MAX_POOL_SIZE = 50
+# How long a shared driver can go unused before we re-check connectivity on the next checkout
+DRIVER_LIVENESS_CHECK_INTERVAL = 60
+
+_shared_drivers = {}
+_shared_drivers_lock = threading.Lock()
+
+
 def get_neo4j_driver(neo_config):
     uri = neo_config['uri']
     user = neo_config['user']
     password = neo_config['password']
+    max_pool_size = neo_config.get('max_pool_size') or DEFAULT_NEO_MAX_POOL_SIZE
 
     def mask_password(pwd):
         if not pwd:
@@ -48,9 +59,78 @@ def get_neo4j_driver(neo_config):
         'uri': uri,
         'user': user,
         'password': mask_password(password),
-        'password_length': len(password) if password else 0
+        'password_length': len(password) if password else 0,
+        'max_pool_size': max_pool_size,
     }
     log_msg(f'Connecting to Neo4j database with parameters:\n{json.dumps(params_for_log, indent=2)}')
 
     # Create a Neo4j driver instance
-    return GraphDatabase.driver(uri, auth=(user, password))
+    return GraphDatabase.driver(
+        uri,
+        auth=(user, password),
+        max_connection_pool_size=int(max_pool_size),
+    )
+
+
+def _driver_key(neo_config):
+    return (neo_config['uri'], neo_config['user'], neo_config['password'], neo_config.get('max_pool_size'))
+
+
+def get_shared_neo4j_driver(neo_config):
+    '''
+    Return a process-wide Neo4j driver for the given config, creating it on first use.
+
+    Drivers are cached by connection config so repeated saves reuse the same connection pool instead of redoing the
+    TLS and auth handshake every time. Callers must not close the returned driver; use close_shared_neo4j_drivers().
+    '''
+    key = _driver_key(neo_config)
+    with _shared_drivers_lock:
+        entry = _shared_drivers.get(key)
+        if entry is None:
+            entry = {'driver': get_neo4j_driver(neo_config), 'last_checked': time.monotonic()}
+            _shared_drivers[key] = entry
+            return entry['driver']
+
+        if time.monotonic() - entry['last_checked'] > DRIVER_LIVENESS_CHECK_INTERVAL:
+            try:
+                entry['driver'].verify_connectivity()
+            except Exception as err:
+                log_msg(f'Shared Neo4j driver failed liveness check ({err}). Reconnecting.')
+                try:
+                    entry['driver'].close()
+                except Exception:
+                    pass
+                entry['driver'] = get_neo4j_driver(neo_config)
+        entry['last_checked'] = time.monotonic()
+        return entry['driver']
+
+
+def close_shared_neo4j_driver(neo_config):
+    '''
+    Close and forget the driver get_shared_neo4j_driver() created for neo_config, if there is one, e.g. once a job with
+    its own credentials is done with it.
+    '''
+    with _shared_drivers_lock:
+        entry = _shared_drivers.pop(_driver_key(neo_config), None)
+    if entry is None:
+        return
+    try:
+        entry['driver'].close()
+    except Exception as err:
+        log_msg(f'Error closing Neo4j driver: {err}')
+
+
+def close_shared_neo4j_drivers():
+    '''
+    Close every driver created by get_shared_neo4j_driver().
+    '''
+    with _shared_drivers_lock:
+        entries = list(_shared_drivers.values())
+        _shared_drivers.clear()
+    for entry in entries:
+        try:
+            entry['driver'].close()
+        except Exception as err:
+            log_msg(f'Error closing Neo4j driver: {err}')
+    if entries:
+        log_msg(f'Closed {len(entries)} shared Neo4j driver(s)')
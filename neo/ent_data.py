@@ -18,12 +18,11 @@ class EntityRecord:
 
         if not source:
             raise ValueError('Entity source must be supplied')
-        if not aws.is_valid_s3_uri(source):
+        if not aws.is_valid_source_uri(source):
             raise ValueError(f'Invalid entity source URI: {source}')
-        self._source_s3, self._source_http = (
-            aws.source_uri_to_s3_and_http(source))
-        # Use HTTP format for source because that's what we're always saving to the database
-        self.source = self._source_http
+        self._source_uri = aws.normalize_uri(source)
+        # Use HTTP format for S3 sources because that's what we're always saving to the database
+        self.source = aws.source_uri_for_graph(source)
 
         self.type = ent_type
 
@@ -34,8 +33,8 @@ class EntityRecord:
             self.__sanitize_relationships()
 
     def __str__(self):
-        # Use S3 format of source here because this is only for logging/debugging and S3 URI is easier to read
-        return f'Entity(name="{self.name}", source="{self._source_s3}", timestamp="{self.timestamp}")'
+        # Use s3:// format of S3 sources here because this is only for logging/debugging and S3 URI is easier to read
+        return f'Entity(name="{self.name}", source="{self._source_uri}", timestamp="{self.timestamp}")'
 
     def __sanitize_relationships(self):
         sanitized_relationships = {}
@@ -2,14 +2,21 @@
 Functions for parsing text into maps of entities and relationships.
 """
 
+import asyncio
+import functools
+
 import gpt
 from gpt import (
     is_text_oversized,
+    iter_token_chunks,
+    iter_token_chunks_with_offsets,
     split_to_size,
     split_to_token_size,
-    get_max_requests_per_minute,
+    split_to_token_size_with_offsets,
+    get_max_concurrent_requests,
 )
-from utils import log_msg
+import merge
+from utils import json_codec, log_msg
 import tasks
 
 
@@ -27,7 +34,7 @@ async def parse_with_gpt(text: str, model="gpt-3.5-turbo"):
     def parse_work_fn(chunk):
         return gpt.async_fetch_parse(chunk, model=model, skip_on_error=True)
 
-    max_tasks = get_max_requests_per_minute(model)
+    max_tasks = get_max_concurrent_requests(model)
 
     master_parse_task = tasks.create_task_of_tasks(
         task_inputs=text_chunks,
@@ -38,42 +45,187 @@ async def parse_with_gpt(text: str, model="gpt-3.5-turbo"):
     return await master_parse_task
 
 
-async def parse_with_gpt_multitask(
-    text: str, model="gpt-3.5-turbo", prompt_override=None
+def iter_chunks_with_offsets_for_parse(
+    text_pieces, model="gpt-3.5-turbo", prompt_override=None, token_limit=None
 ):
     """
-    Splits provided text into smaller pieces and parses each piece in parallel using GPT, yielding results as they come in.
+    Lazily splits a stream of text pieces into the chunks that will each be sent to GPT in a single parse request,
+    yielding (chunk, start, end) tuples with each chunk's character offsets in the text.
+
+    token_limit overrides the chunk size, e.g. to split the same way as an earlier run.
     """
-    text_token_limit = gpt.parse.get_text_token_limit(model)
+    text_token_limit = token_limit or gpt.parse.get_text_token_limit(
+        model, prompt_override=prompt_override
+    )
     log_msg(f"Splitting input text into chunks of {text_token_limit} tokens.")
-    text_chunks = split_to_token_size(text, token_limit=text_token_limit, model=model)
+    return iter_token_chunks_with_offsets(
+        text_pieces, token_limit=text_token_limit, model=model
+    )
+
+
+def iter_chunks_for_parse(text_pieces, model="gpt-3.5-turbo", prompt_override=None):
+    """
+    Lazily splits a stream of text pieces into the chunks that will each be sent to GPT in a single parse request.
+    """
+    text_token_limit = gpt.parse.get_text_token_limit(
+        model, prompt_override=prompt_override
+    )
+    log_msg(f"Splitting input text into chunks of {text_token_limit} tokens.")
+    return iter_token_chunks(text_pieces, token_limit=text_token_limit, model=model)
+
+
+def split_text_for_parse(text: str, model="gpt-3.5-turbo", prompt_override=None):
+    """
+    Splits text into the chunks that will each be sent to GPT in a single parse request.
+    """
+    return list(
+        iter_chunks_for_parse([text], model=model, prompt_override=prompt_override)
+    )
+
 
+async def parse_chunk_stream_with_gpt(
+    chunks,
+    model="gpt-3.5-turbo",
+    prompt_override=None,
+    request_slots=None,
+    stream=False,
+    on_entity=None,
+):
+    """
+    Parses (chunk index, chunk) pairs from an async iterator in parallel using GPT, yielding (chunk index, chunk,
+    result) tuples as they come in.
+
+    New chunks are only pulled from the iterator while fewer than the model's max concurrent requests are in flight,
+    so a lazily produced stream of chunks is never read far ahead of parsing.
+    If request_slots (an asyncio.Semaphore) is provided, every GPT request must hold a slot, which lets several
+    concurrent calls share one budget of in-flight requests.
+    If stream is set, GPT responses are streamed, so a chunk whose response times out still gets the entities received
+    before that. on_entity, if provided, implies stream and is called with (chunk index, entity name, entity data) as
+    soon as each entity is received; an entity can be passed again, with more relationships, when a chunk whose
+    response was cut off is re-parsed in pieces.
+    """
     if prompt_override:
         log_msg(f"Using custom parse prompt specified as override:\n{prompt_override}")
 
     # Note: an error will make any given chunk be skipped. Because of the large number of parse jobs/chunks looked at,
     # this is hopefully acceptable behavior.
     # The benefit is that the total parsing is much more resilient with some fault tolerance.
-    def parse_work_fn(chunk):
-        return gpt.async_fetch_parse(
+    async def parse_work_fn(chunk_index, chunk):
+        fetch = gpt.async_fetch_parse(
             chunk,
             model=model,
             skip_on_error=True,
             prompt_override=prompt_override,
-            return_source=True,
+            stream=stream or on_entity is not None,
+            on_entity=functools.partial(on_entity, chunk_index) if on_entity else None,
         )
+        if request_slots is None:
+            return chunk_index, chunk, await fetch
+        async with request_slots:
+            return chunk_index, chunk, await fetch
 
-    max_tasks = get_max_requests_per_minute(model)
+    max_tasks = get_max_concurrent_requests(model)
+    chunks = chunks.__aiter__()
+    running = set()
+    chunks_remaining = True
+    tasks_completed = 0
+    try:
+        while True:
+            while chunks_remaining and len(running) < max_tasks:
+                try:
+                    chunk_index, chunk = await chunks.__anext__()
+                except StopAsyncIteration:
+                    chunks_remaining = False
+                    break
+                running.add(asyncio.create_task(parse_work_fn(chunk_index, chunk)))
+            if not running:
+                break
 
-    async for result in tasks.create_and_run_tasks(
-        task_inputs=text_chunks,
-        work_fn=parse_work_fn,
-        task_label="Parse",
-        max_simul_tasks=max_tasks,
+            completed, running = await asyncio.wait(
+                running, return_when=asyncio.FIRST_COMPLETED
+            )
+            for task in completed:
+                tasks_completed += 1
+                yield task.result()
+            log_msg(
+                f"Parse: {tasks_completed} tasks completed ({len(running)} currently running)"
+            )
+    finally:
+        for task in running:
+            task.cancel()
+
+
+async def parse_chunks_with_gpt_multitask(
+    text_chunks,
+    model="gpt-3.5-turbo",
+    prompt_override=None,
+    request_slots=None,
+    chunk_indices=None,
+    stream=False,
+    on_entity=None,
+):
+    """
+    Parses already split chunks in parallel using GPT, yielding (chunk index, chunk, result) tuples as they come in.
+
+    If chunk_indices is provided, only the chunks at those indices are parsed. See parse_chunk_stream_with_gpt for
+    stream and on_entity.
+    """
+    if chunk_indices is None:
+        chunk_indices = range(len(text_chunks))
+
+    async def indexed_chunks():
+        for chunk_index in chunk_indices:
+            yield chunk_index, text_chunks[chunk_index]
+
+    async for result in parse_chunk_stream_with_gpt(
+        indexed_chunks(),
+        model=model,
+        prompt_override=prompt_override,
+        request_slots=request_slots,
+        stream=stream,
+        on_entity=on_entity,
     ):
         yield result
 
 
+async def parse_with_gpt_multitask(
+    text: str, model="gpt-3.5-turbo", prompt_override=None, request_slots=None
+):
+    """
+    Splits provided text into smaller pieces and parses each piece in parallel using GPT, yielding results as they come in.
+    """
+    text_chunks = split_text_for_parse(
+        text, model=model, prompt_override=prompt_override
+    )
+    async for _, chunk, parse_result in parse_chunks_with_gpt_multitask(
+        text_chunks,
+        model=model,
+        prompt_override=prompt_override,
+        request_slots=request_slots,
+    ):
+        yield chunk, parse_result
+
+
+async def async_parse_and_merge(
+    text: str, model="gpt-3.5-turbo", prompt_override=None, request_slots=None
+):
+    """
+    Splits provided text into smaller pieces, parses each piece in parallel using GPT, and merges the results into one
+    as they come in (see merge.ParseResultMerger).
+    """
+
+    async def parse_results():
+        async for _, parse_result in parse_with_gpt_multitask(
+            text,
+            model=model,
+            prompt_override=prompt_override,
+            request_slots=request_slots,
+        ):
+            yield parse_result
+
+    return await merge.amerge_parse_results_locally(parse_results())
+
+
 async def async_parse_with_heartbeat(
     text: str, model="gpt-3.5-turbo", prompt_override=None
 ):
@@ -83,7 +235,9 @@ async def async_parse_with_heartbeat(
     log_msg(f"Parsing text using GPT model {model}")
     log_msg("Sending connection heartbeat")
     yield " "
-    text_token_limit = gpt.parse.get_text_token_limit(model)
+    text_token_limit = gpt.parse.get_text_token_limit(
+        model, prompt_override=prompt_override
+    )
     log_msg(f"Splitting input text into chunks of {text_token_limit} tokens.")
     text_chunks = split_to_token_size(text, token_limit=text_token_limit, model=model)
 
@@ -101,6 +255,135 @@ async def async_parse_with_heartbeat(
         yield chunk
 
 
+STREAM_FORMATS = ("ndjson", "sse")
+
+
+def _format_stream_event(event, data, stream_format):
+    if stream_format == "sse":
+        return f"event: {event}\ndata: {json_codec.dumps(data)}\n\n"
+    # NDJSON has no event names of its own, so each record carries one
+    return json_codec.dumps({"event": event, **data}) + "\n"
+
+
+def _format_stream_heartbeat(stream_format):
+    # Blank NDJSON lines and SSE comment lines are both ignored by clients
+    if stream_format == "sse":
+        return ": heartbeat\n\n"
+    return "\n"
+
+
+async def async_parse_streaming(
+    text: str,
+    model="gpt-3.5-turbo",
+    prompt_override=None,
+    stream_format="ndjson",
+    heartbeat_interval=10,
+    stream_entities=False,
+    merge_results=False,
+):
+    """
+    Parse text, yielding each chunk's result as an NDJSON line or SSE event as soon as it's ready.
+
+    Each result carries the chunk index and the chunk's start/end character offsets in the input text (after line
+    endings are normalized). Heartbeats are sent while waiting so the connection stays open. In NDJSON, each record's
+    "event" field holds what would be the SSE event name ("chunk", "entity", "merged" or "done").
+    If stream_entities is set, GPT responses are streamed and each entity is also sent as an "entity" event as soon as
+    it's received, ahead of the "chunk" event with its chunk's full result. The same entity can be sent more than once
+    for a chunk whose response was cut off and re-parsed in pieces.
+    If merge_results is set, chunk results are also merged as they come in (see merge.ParseResultMerger) and the
+    merged result is sent as a "merged" event before the "done" event.
+    """
+    log_msg(f"Streaming parse of text using GPT model {model} as {stream_format}")
+    yield _format_stream_heartbeat(stream_format)
+
+    text_token_limit = gpt.parse.get_text_token_limit(
+        model, prompt_override=prompt_override
+    )
+    log_msg(f"Splitting input text into chunks of {text_token_limit} tokens.")
+    chunks_with_offsets = split_to_token_size_with_offsets(
+        text, token_limit=text_token_limit, model=model
+    )
+    text_chunks = [chunk for chunk, _, _ in chunks_with_offsets]
+
+    entity_queue = asyncio.Queue()
+
+    def on_entity(chunk_index, ent_name, ent_data):
+        entity_queue.put_nowait((chunk_index, ent_name, ent_data))
+
+    def format_entity_event(entity):
+        chunk_index, ent_name, ent_data = entity
+        return _format_stream_event(
+            "entity",
+            {"chunk_index": chunk_index, "name": ent_name, "data": ent_data},
+            stream_format,
+        )
+
+    parse_multitask = parse_chunks_with_gpt_multitask(
+        text_chunks,
+        model=model,
+        prompt_override=prompt_override,
+        on_entity=on_entity if stream_entities else None,
+    )
+    merger = merge.ParseResultMerger() if merge_results else None
+    next_result = asyncio.ensure_future(parse_multitask.__anext__())
+    next_entity = asyncio.ensure_future(entity_queue.get())
+    try:
+        while True:
+            done, _ = await asyncio.wait(
+                [next_result, next_entity],
+                timeout=heartbeat_interval,
+                return_when=asyncio.FIRST_COMPLETED,
+            )
+            # Entities go out in the order they were received, before the result of the chunk they came from
+            if next_entity in done:
+                yield format_entity_event(next_entity.result())
+                next_entity = asyncio.ensure_future(entity_queue.get())
+            while not entity_queue.empty():
+                yield format_entity_event(entity_queue.get_nowait())
+            if not done:
+                log_msg("Sending connection heartbeat")
+                yield _format_stream_heartbeat(stream_format)
+                continue
+            if next_result not in done:
+                continue
+            try:
+                chunk_index, _, parse_result = next_result.result()
+            except StopAsyncIteration:
+                break
+            next_result = asyncio.ensure_future(parse_multitask.__anext__())
+
+            if merger is not None:
+                merger.add(parse_result)
+            # Chunks skipped after an error or with no entities are reported with no result
+            result = parse_result or None
+            _, start, end = chunks_with_offsets[chunk_index]
+            yield _format_stream_event(
+                "chunk",
+                {
+                    "chunk_index": chunk_index,
+                    "source_start": start,
+                    "source_end": end,
+                    "result": result,
+                },
+                stream_format,
+            )
+    finally:
+        # Client disconnected or something failed; stop any in-flight parsing
+        next_result.cancel()
+        next_entity.cancel()
+        # aclose() fails while __anext__() is still running the generator, so let the cancelled tasks finish first
+        await asyncio.gather(next_result, next_entity, return_exceptions=True)
+        await parse_multitask.aclose()
+
+    log_msg("All parsing complete")
+    if merger is not None:
+        log_msg(f"Merged {merger.chunks_merged} chunk results into {len(merger)} entities")
+        yield _format_stream_event("merged", {"result": merger.result()}, stream_format)
+    yield _format_stream_event(
+        "done", {"done": True, "chunk_count": len(text_chunks)}, stream_format
+    )
+
+
 # ***********
 # Legacy code
 # ***********
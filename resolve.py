@@ -0,0 +1,352 @@
+'''
+Entity resolution: mapping the different names parse results give the same entity onto one canonical name before
+they're saved to Neo4j.
+
+Names are matched by:
+- a canonical key (case, punctuation and word order ignored), so "Alkaline phosphatase, tissue-nonspecific" and
+  "tissue-nonspecific alkaline phosphatase" are the same entity;
+- "abbreviation of" / "abbreviation" relationships from the parser, which make an abbreviation an alias of its full
+  name;
+- similarity of character trigrams, with candidates found through MinHash-LSH blocks rather than by comparing against
+  every known name.
+
+Known entities, their blocks and all aliases are kept in a SQLite file so every save resolves against everything seen
+before.
+'''
+
+import os
+import random
+import re
+import sqlite3
+import threading
+import time
+import unicodedata
+import zlib
+
+import merge
+import neo
+from utils import log_msg
+
+
+DEFAULT_SIMILARITY_THRESHOLD = 0.8
+# MinHash signature length, split into bands of rows for LSH; names sharing any band are compared
+MINHASH_PERMUTATIONS = 32
+LSH_BANDS = 8
+# Keys shorter than this only match exactly (or through an alias): trigrams of short names are too few to compare
+MIN_SIMILARITY_KEY_LENGTH = 8
+# Most candidates from the blocks that are compared against a name
+MAX_CANDIDATES = 50
+# Resolved names remembered in memory before the memo is cleared
+MAX_MEMO_ENTRIES = 100000
+# Longest chain of aliases followed to an entity
+MAX_ALIAS_HOPS = 5
+
+ABBREVIATION_OF_RELATIONSHIP = 'abbreviation_of'
+ABBREVIATION_RELATIONSHIP = 'abbreviation'
+
+ALIAS_REASON_ABBREVIATION = 'abbreviation'
+ALIAS_REASON_SIMILAR = 'similar'
+ALIAS_REASON_MANUAL = 'manual'
+
+_NON_ALPHANUMERIC = re.compile(r'[\W_]+')
+_MERSENNE_PRIME = (1 << 61) - 1
+_rng = random.Random(20240601)
+_MINHASH_PARAMS = [
+    (_rng.randrange(1, _MERSENNE_PRIME), _rng.randrange(0, _MERSENNE_PRIME)) for _ in range(MINHASH_PERMUTATIONS)
+]
+
+
+def canonical_key(name):
+    '''
+    Returns the key two names must share to be treated as the same entity outright: lowercased words with punctuation
+    dropped, in sorted order.
+    '''
+    name = unicodedata.normalize('NFKC', name).lower()
+    words = _NON_ALPHANUMERIC.sub(' ', name).split()
+    if not words:
+        return neo.normalize_entity_name(name)
+    return ' '.join(sorted(words))
+
+
+def _trigrams(key):
+    padded = f' {key} '
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+def _numbers(key):
+    # Names differing only by a number (e.g. "interleukin 6" and "interleukin 8") are different entities
+    return {word for word in key.split() if any(char.isdigit() for char in word)}
+
+
+def _lsh_blocks(trigrams):
+    hashes = [zlib.crc32(trigram.encode('utf-8')) for trigram in trigrams]
+    signature = [min((a * h + b) % _MERSENNE_PRIME for h in hashes) for a, b in _MINHASH_PARAMS]
+    rows = MINHASH_PERMUTATIONS // LSH_BANDS
+    return [
+        f'lsh{band}:{zlib.crc32(repr(signature[band * rows:(band + 1) * rows]).encode("utf-8")):08x}'
+        for band in range(LSH_BANDS)
+    ]
+
+
+def _jaccard(a, b):
+    if not a or not b:
+        return 0.0
+    return len(a & b) / len(a | b)
+
+
+class EntityResolver:
+    '''
+    Resolves entity names to canonical ones, backed by a SQLite alias table at db_path.
+    '''
+
+    def __init__(self, db_path, similarity_threshold=DEFAULT_SIMILARITY_THRESHOLD):
+        if os.path.dirname(db_path):
+            os.makedirs(os.path.dirname(db_path), exist_ok=True)
+        self.db_path = db_path
+        self.similarity_threshold = float(similarity_threshold)
+        self._lock = threading.Lock()
+        self._memo = {}
+        self._conn = sqlite3.connect(db_path, check_same_thread=False)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute(
+            'CREATE TABLE IF NOT EXISTS entities ('
+            '  key TEXT PRIMARY KEY,'
+            '  name TEXT NOT NULL'
+            ')'
+        )
+        self._conn.execute(
+            'CREATE TABLE IF NOT EXISTS aliases ('
+            '  alias_key TEXT PRIMARY KEY,'
+            '  canonical_key TEXT NOT NULL,'
+            '  reason TEXT NOT NULL,'
+            '  created REAL NOT NULL'
+            ')'
+        )
+        self._conn.execute(
+            'CREATE TABLE IF NOT EXISTS blocks ('
+            '  block TEXT NOT NULL,'
+            '  key TEXT NOT NULL'
+            ')'
+        )
+        self._conn.execute('CREATE INDEX IF NOT EXISTS blocks_block ON blocks (block)')
+        self._conn.commit()
+        self.reset_stats()
+
+    def reset_stats(self):
+        self.names_resolved = 0
+        self.new_entities = 0
+        self.alias_hits = 0
+        self.similar_matches = 0
+        self.abbreviation_links = 0
+
+    def log_stats(self):
+        log_msg(
+            f'Entity resolution stats: {self.names_resolved} names resolved, {self.new_entities} new entities, '
+            f'{self.alias_hits} resolved through aliases, {self.similar_matches} new similar-name aliases, '
+            f'{self.abbreviation_links} new abbreviation aliases'
+        )
+
+    def __entity_name(self, key):
+        row = self._conn.execute('SELECT name FROM entities WHERE key = ?', (key,)).fetchone()
+        return row[0] if row else None
+
+    def __follow_aliases(self, key):
+        # Aliases normally point straight at an entity, but a name registered as an entity can become an alias later
+        for _ in range(MAX_ALIAS_HOPS):
+            row = self._conn.execute('SELECT canonical_key FROM aliases WHERE alias_key = ?', (key,)).fetchone()
+            if row is None:
+                break
+            key = row[0]
+        return key
+
+    def __add_alias(self, alias_key, canonical_key, reason):
+        '''
+        Record alias_key as another name for canonical_key, unless it's already an alias of something. Returns whether
+        the alias was added.
+        '''
+        if alias_key == canonical_key:
+            return False
+        cursor = self._conn.execute(
+            'INSERT OR IGNORE INTO aliases (alias_key, canonical_key, reason, created) VALUES (?, ?, ?, ?)',
+            (alias_key, canonical_key, reason, time.time()),
+        )
+        if cursor.rowcount:
+            if self.__entity_name(alias_key) is None:
+                self._memo.pop(alias_key, None)
+            else:
+                # Other names may be memoized as resolving to alias_key, which now resolves somewhere else
+                self._memo.clear()
+        return bool(cursor.rowcount)
+
+    def __find_similar(self, key, trigrams, blocks):
+        placeholders = ','.join('?' * len(blocks))
+        candidates = [
+            row[0]
+            for row in self._conn.execute(
+                f'SELECT DISTINCT key FROM blocks WHERE block IN ({placeholders}) LIMIT {MAX_CANDIDATES}',
+                blocks,
+            )
+        ]
+        numbers = _numbers(key)
+        best_key, best_score = None, self.similarity_threshold
+        for candidate in candidates:
+            if _numbers(candidate) != numbers:
+                continue
+            score = _jaccard(trigrams, _trigrams(candidate))
+            if score >= best_score:
+                best_key, best_score = candidate, score
+        return best_key
+
+    def __resolve(self, name):
+        '''
+        Returns (canonical key, canonical name) for name, registering it as a new entity if it doesn't match a known
+        one.
+        '''
+        key = canonical_key(name)
+        resolved = self._memo.get(key)
+        if resolved is not None:
+            return resolved
+
+        resolved_key = self.__follow_aliases(key)
+        if resolved_key != key:
+            self.alias_hits += 1
+        elif self.__entity_name(key) is None:
+            resolved_key = self.__match_or_register(key, name)
+        resolved = (resolved_key, self.__entity_name(resolved_key) or name)
+
+        if len(self._memo) >= MAX_MEMO_ENTRIES:
+            self._memo.clear()
+        self._memo[key] = resolved
+        return resolved
+
+    def __match_or_register(self, key, name):
+        blocks = []
+        if len(key) >= MIN_SIMILARITY_KEY_LENGTH:
+            trigrams = _trigrams(key)
+            blocks = _lsh_blocks(trigrams)
+            similar_key = self.__find_similar(key, trigrams, blocks)
+            if similar_key is not None:
+                similar_key = self.__follow_aliases(similar_key)
+                self.__add_alias(key, similar_key, ALIAS_REASON_SIMILAR)
+                self.similar_matches += 1
+                return similar_key
+
+        self._conn.execute('INSERT OR IGNORE INTO entities (key, name) VALUES (?, ?)', (key, name))
+        self._conn.executemany('INSERT INTO blocks (block, key) VALUES (?, ?)', [(block, key) for block in blocks])
+        self.new_entities += 1
+        return key
+
+    @staticmethod
+    def __iter_targets(targets):
+        if isinstance(targets, str):
+            targets = [targets]
+        elif not isinstance(targets, list):
+            return
+        for target in targets:
+            if isinstance(target, str) and target:
+                yield target
+
+    def __iter_abbreviation_links(self, parse_result):
+        # Yields (abbreviation, full name) pairs
+        for ent_name, ent_data in parse_result.items():
+            if not isinstance(ent_name, str) or not isinstance(ent_data, dict):
+                continue
+            for relationship_name, targets in ent_data.items():
+                if not isinstance(relationship_name, str):
+                    continue
+                relationship = neo.sanitize_relationship_name(relationship_name)
+                if relationship == ABBREVIATION_OF_RELATIONSHIP:
+                    for target in self.__iter_targets(targets):
+                        yield ent_name, target
+                elif relationship == ABBREVIATION_RELATIONSHIP:
+                    for target in self.__iter_targets(targets):
+                        yield target, ent_name
+
+    def resolve(self, parse_result):
+        '''
+        Returns parse_result with every entity and relationship target renamed to its canonical name, entities that
+        resolve to the same name merged (see merge.ParseResultMerger), and relationships from an entity to itself
+        (like an abbreviation relationship once the abbreviation is resolved to its full name) dropped.
+        '''
+        if not isinstance(parse_result, dict):
+            return parse_result
+
+        merger = merge.ParseResultMerger()
+        with self._lock:
+            names = {}
+            # Abbreviations always resolve to the full name they're given in this result, even if they're already
+            # recorded as an alias of something else
+            for abbreviation, full_name in self.__iter_abbreviation_links(parse_result):
+                resolved_full_name = self.__resolve(full_name)
+                if self.__add_alias(canonical_key(abbreviation), resolved_full_name[0], ALIAS_REASON_ABBREVIATION):
+                    self.abbreviation_links += 1
+                names[abbreviation] = resolved_full_name
+
+            def resolve_name(name):
+                self.names_resolved += 1
+                resolved = names.get(name)
+                if resolved is None:
+                    resolved = names[name] = self.__resolve(name)
+                return resolved
+
+            for ent_name, ent_data in parse_result.items():
+                if not isinstance(ent_name, str) or not isinstance(ent_data, dict):
+                    continue
+                ent_key, resolved_ent_name = resolve_name(ent_name)
+                resolved_data = {}
+                for relationship_name, targets in ent_data.items():
+                    if relationship_name == merge.ENTITY_TYPE_KEY:
+                        resolved_data[relationship_name] = targets
+                        continue
+                    resolved_targets = []
+                    for target in self.__iter_targets(targets):
+                        target_key, resolved_target = resolve_name(target)
+                        if target_key != ent_key:
+                            resolved_targets.append(resolved_target)
+                    if resolved_targets:
+                        resolved_data[relationship_name] = resolved_targets
+                # Distinct canonical keys never share a lowercased name, so the merger unions exactly by resolved entity
+                merger.add({resolved_ent_name: resolved_data})
+            self._conn.commit()
+
+        return merger.result()
+
+    def add_alias(self, alias_name, canonical_name):
+        '''
+        Record alias_name as another name for canonical_name, e.g. to fix up a pair resolution missed. Returns whether
+        the alias was added (an alias already recorded for alias_name isn't replaced).
+        '''
+        with self._lock:
+            added = self.__add_alias(
+                canonical_key(alias_name), self.__resolve(canonical_name)[0], ALIAS_REASON_MANUAL
+            )
+            self._conn.commit()
+        return added
+
+
+_entity_resolver = None
+
+
+def init_entity_resolution(config):
+    '''
+    Set up the process-wide entity resolver from ENTITY_ALIAS_DB (a local SQLite file path), if configured.
+
+    ENTITY_RESOLUTION_THRESHOLD sets how similar (0-1, by character trigrams) two names must be to be merged.
+    '''
+    global _entity_resolver
+    db_path = config.get('ENTITY_ALIAS_DB', None)
+    if not db_path:
+        _entity_resolver = None
+        return None
+
+    threshold = config.get('ENTITY_RESOLUTION_THRESHOLD', None) or DEFAULT_SIMILARITY_THRESHOLD
+    _entity_resolver = EntityResolver(db_path, similarity_threshold=threshold)
+    log_msg(f'Resolving entities against alias table at {db_path} (similarity threshold {threshold})')
+    return _entity_resolver
+
+
+def get_entity_resolver():
+    '''
+    Returns the process-wide entity resolver, or None if entity resolution isn't configured.
+    '''
+    return _entity_resolver
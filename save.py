@@ -7,10 +7,11 @@ import json
 
 import aws
 import neo
+import resolve
 from utils import log_msg, log_warn, log_error
 
 
-def _save_dict_of_entities(neo_driver, data, source=None, timestamp=None):
+def _save_dict_of_entities(neo_driver, data, source=None, timestamp=None, bulk_writer=None):
     if not timestamp:
         timestamp = neo.make_timestamp()
 
@@ -29,51 +30,75 @@ def _save_dict_of_entities(neo_driver, data, source=None, timestamp=None):
             continue
         ent = neo.EntityRecord.from_json_entry(
             ent_name, ent_data, source, timestamp)
-        if ent.has_data_to_save():
+        if not ent.has_data_to_save():
+            continue
+        if bulk_writer is not None:
+            bulk_writer.add_entity(ent)
+        else:
             ent.save_to_neo(neo_driver)
             ent.save_relationships_to_neo(neo_driver)
 
 
-def save_data_to_neo4j(data, source_uri=None, neo_config=None):
+def save_data_to_neo4j(data, source_uri=None, neo_config=None, bulk=False, bulk_batch_size=neo.DEFAULT_BULK_BATCH_SIZE):
+    '''
+    Save parse output to Neo4j.
+
+    If bulk is set, all entities and relationships are collected first and written with batched UNWIND queries
+    instead of one query per entity/relationship.
+    If entity resolution is configured, entity names are resolved to canonical ones (see resolve.py) before saving.
+    '''
     if not source_uri:
         raise ValueError('Must provide a source URI for the input data.')
-    # Ensure save input URI is an HTTP URL for easy access from Neo4j
-    source_uri = aws.s3_uri_to_http(source_uri)
+    # Ensure S3 input URIs are HTTP URLs for easy access from Neo4j
+    source_uri = aws.source_uri_for_graph(source_uri)
 
-    # Create a Neo4j driver instance
-    driver = neo.get_neo4j_driver(neo_config)
+    # Reuse the process-wide driver for this config so we don't reconnect on every save
+    driver = neo.get_shared_neo4j_driver(neo_config)
 
     # Use a single timestamp for marking creation/modification time of all entities and relationships in this run
     timestamp = neo.make_timestamp()
 
-    try:
-        if isinstance(data, dict):
-            _save_dict_of_entities(
-                driver, data, source=source_uri, timestamp=timestamp)
-        elif isinstance(data, list):
-            for obj in data:
-                _save_dict_of_entities(
-                    driver, obj, source=source_uri, timestamp=timestamp)
+    bulk_writer = neo.BulkGraphWriter(driver, batch_size=bulk_batch_size) if bulk else None
+
+    resolver = resolve.get_entity_resolver()
+    if resolver is not None:
+        if isinstance(data, list):
+            data = [resolver.resolve(obj) for obj in data]
         else:
-            log_error(
-                f'Unexpected input type. Expected dict or list, got: {type(data)}')
-            log_error(f'Exact string received: "{data}"')
-            log_error(f'Parsed as: {data}')
-            raise Exception(
-                f'Unexpected input: {data}')
-    finally:
-        driver.close()
+            data = resolver.resolve(data)
+
+    if isinstance(data, dict):
+        _save_dict_of_entities(
+            driver, data, source=source_uri, timestamp=timestamp, bulk_writer=bulk_writer)
+    elif isinstance(data, list):
+        for obj in data:
+            _save_dict_of_entities(
+                driver, obj, source=source_uri, timestamp=timestamp, bulk_writer=bulk_writer)
+    else:
+        log_error(
+            f'Unexpected input type. Expected dict or list, got: {type(data)}')
+        log_error(f'Exact string received: "{data}"')
+        log_error(f'Parsed as: {data}')
+        raise Exception(
+            f'Unexpected input: {data}')
+
+    if bulk_writer is not None:
+        bulk_writer.flush()
 
 
 WEB_SUBMISSIONS_URI = 's3://paper2graph-parse-inputs/web-submissions/'
 HASH_SLUG_LENGTH = 12
 
 
-def save_input_text_to_s3(text):
+def save_input_text(text, base_uri=None):
+    '''
+    Save submitted input text under base_uri (an s3:// or file:// location), returning the URI of the saved text.
+    '''
+    base_uri = base_uri or WEB_SUBMISSIONS_URI
     hash_slug = hashlib.sha256(text.encode('utf-8')).hexdigest()
     hash_slug = hash_slug[:HASH_SLUG_LENGTH]
-    output_uri = f'{WEB_SUBMISSIONS_URI.rstrip("/")}/{hash_slug}.txt'
+    output_uri = f'{aws.normalize_uri(base_uri).rstrip("/")}/{hash_slug}.txt'
     log_msg(f'Saving input text to {output_uri}')
     # This call will raise Exception if any issue, but just let that bubble up:
-    aws.write_to_s3_file(output_uri, text)
+    aws.write_file(output_uri, text)
     return output_uri
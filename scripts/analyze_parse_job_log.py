@@ -32,6 +32,12 @@ def main(args):
     result_length_regex = r'Parse result length \(in tokens\): (\d+)'
     result_lengths = []
 
+    cache_hit_regex = r'Parse cache hit'
+    cache_hit_count = 0
+
+    cache_miss_regex = r'Parse cache miss'
+    cache_miss_count = 0
+
     finish_reason_regex = r'OpenAI finish reason: "(\w+)"'
     finish_reasons = {}
 
@@ -51,6 +57,16 @@ def main(args):
             timeout_count += 1
             continue
 
+        cache_hit_match = re.search(cache_hit_regex, line)
+        if cache_hit_match:
+            cache_hit_count += 1
+            continue
+
+        cache_miss_match = re.search(cache_miss_regex, line)
+        if cache_miss_match:
+            cache_miss_count += 1
+            continue
+
         parse_time_match = re.search(parse_time_regex, line)
         if parse_time_match:
             parse_time = float(parse_time_match.group(1))
@@ -73,6 +89,8 @@ def main(args):
         'request_count': request_count,
         'invalid_json_count': invalid_json_count,
         'timeout_count': timeout_count,
+        'cache_hit_count': cache_hit_count,
+        'cache_miss_count': cache_miss_count,
         'finish_reasons': finish_reasons,
     }
 
@@ -0,0 +1,108 @@
+import argparse
+import json
+import time
+
+import aws
+import gpt
+from utils import json_codec
+
+
+def _make_sample_response(num_entities):
+    entities = {}
+    for i in range(num_entities):
+        entities[f'Entity {i}'] = {
+            'treats': [f'Entity {(i + j) % num_entities}' for j in range(1, 4)],
+            'studied in': f'Entity {(i + 7) % num_entities}',
+            'abbreviation': f'E{i}',
+            'empty relationship': [],
+            '_ENTITY_TYPE': 'Drug' if i % 2 else 'Disease',
+        }
+    return json.dumps(entities, indent=2)
+
+
+def _load_response(input_file):
+    if aws.is_valid_s3_uri(input_file):
+        _, data = aws.read_file_from_s3(input_file)
+        return data
+    with open(input_file, 'r') as f:
+        return f.read()
+
+
+def legacy_postprocess(response):
+    '''
+    Previous per-chunk path: clean_json decoded, filtered and re-encoded the response, every consumer decoded it again,
+    and output was encoded once more when written.
+    '''
+    cleaned = {}
+    for key, value in json.loads(response).items():
+        value = gpt.clean_json_value(key, value)
+        if value is not None:
+            cleaned[key] = value
+    result_str = json.dumps(cleaned, indent=2)
+    # e.g. the bundle writer or /raw-parse stream decoding the result
+    parse_output = json.loads(result_str)
+    return json.dumps({'parse': parse_output})
+
+
+def structured_postprocess(response):
+    '''
+    Current path: the response is decoded and cleaned once, carried as a ParseResult, and encoded only when written.
+    '''
+    cleaned, _ = gpt.clean_json(response, as_dict=True)
+    parse_result = gpt.ParseResult(cleaned)
+    return json_codec.dumps({'parse': parse_result})
+
+
+def _time_runs(fn, responses, iterations):
+    times = []
+    for _ in range(iterations):
+        start = time.perf_counter()
+        for response in responses:
+            fn(response)
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+def main(args):
+    response = _load_response(args.input_file) if args.input_file else _make_sample_response(args.entities)
+    responses = [response] * args.chunks
+
+    legacy_time = _time_runs(legacy_postprocess, responses, args.iterations)
+    structured_time = _time_runs(structured_postprocess, responses, args.iterations)
+
+    results = {
+        'response_chars': len(response),
+        'chunks': args.chunks,
+        'fast_json_codec': json_codec.HAS_FAST_JSON,
+        'legacy': {
+            'best_seconds': round(legacy_time, 4),
+            'per_chunk_ms': round(legacy_time / args.chunks * 1000, 3),
+        },
+        'structured': {
+            'best_seconds': round(structured_time, 4),
+            'per_chunk_ms': round(structured_time / args.chunks * 1000, 3),
+        },
+        'speedup': round(legacy_time / structured_time, 2) if structured_time else None,
+    }
+    print(json.dumps(results, indent=2))
+
+
+def parse_args(args):
+    parser = argparse.ArgumentParser(
+        description='Compare per-chunk post-processing of parse responses with and without JSON round trips')
+
+    parser.add_argument(
+        '--input_file',
+        default=None,
+        help='A parse response or output_N.json to use as every chunk\'s response. Can be a local path or an S3 URI.'
+    )
+    parser.add_argument(
+        '--entities',
+        type=int,
+        default=200,
+        help='Number of entities in the generated sample response, when no --input_file is given.'
+    )
+    parser.add_argument('--chunks', type=int, default=500, help='Number of chunk responses to post-process per run.')
+    parser.add_argument('--iterations', type=int, default=3, help='Number of timed runs; the best is reported.')
+
+    return parser.parse_args(args)
@@ -0,0 +1,120 @@
+import argparse
+import asyncio
+import bisect
+import json
+import time
+
+import aws
+
+
+class LocalS3StandIn:
+    '''
+    Minimal in-memory stand-in for the S3 client's list_objects_v2, with a fixed delay per call to mimic network
+    latency. Pages are capped at 1000 keys like the real API.
+    '''
+
+    def __init__(self, keys, latency_seconds):
+        self.keys = sorted(keys)
+        self.latency_seconds = latency_seconds
+        self.calls = 0
+
+    def list_objects_v2(self, Bucket, Prefix, Delimiter='/', ContinuationToken=None, MaxKeys=1000):
+        self.calls += 1
+        time.sleep(self.latency_seconds)
+        start = bisect.bisect_left(self.keys, ContinuationToken or Prefix)
+        contents = []
+        common_prefixes = []
+        i = start
+        while i < len(self.keys) and self.keys[i].startswith(Prefix):
+            if len(contents) + len(common_prefixes) >= MaxKeys:
+                return {
+                    'Contents': contents,
+                    'CommonPrefixes': common_prefixes,
+                    'IsTruncated': True,
+                    'NextContinuationToken': self.keys[i],
+                }
+            key = self.keys[i]
+            rest = key[len(Prefix):]
+            if Delimiter in rest:
+                subdir = Prefix + rest.split(Delimiter, 1)[0] + Delimiter
+                common_prefixes.append({'Prefix': subdir})
+                # Skip everything else under this subdirectory
+                i = bisect.bisect_left(self.keys, subdir + '\uffff')
+                continue
+            contents.append({'Key': key, 'Size': 100, 'ETag': f'"{hash(key) & 0xffffffff:08x}"'})
+            i += 1
+        return {'Contents': contents, 'CommonPrefixes': common_prefixes, 'IsTruncated': False}
+
+
+def _legacy_list(client, bucket, prefix):
+    # Previous behavior: one list call per prefix, no continuation token, subdirectories listed one after another
+    response = client.list_objects_v2(Bucket=bucket, Prefix=prefix, Delimiter='/')
+    objects = [obj['Key'] for obj in response.get('Contents', []) if obj.get('Size', 0) > 0]
+    for subdir in response.get('CommonPrefixes', []):
+        objects.extend(_legacy_list(client, bucket, subdir['Prefix']))
+    return objects
+
+
+async def _time_async_listing(uri):
+    start = time.perf_counter()
+    first_object_time = None
+    count = 0
+    async for _ in aws.aiter_objects_at_uri(uri):
+        if first_object_time is None:
+            first_object_time = time.perf_counter() - start
+        count += 1
+    return time.perf_counter() - start, first_object_time, count
+
+
+def main(args):
+    keys = [
+        f'inputs/folder_{f:04d}/paper_{k:06d}.txt'
+        for f in range(args.folders)
+        for k in range(args.keys // args.folders)
+    ]
+    stand_in = LocalS3StandIn(keys, args.latency_ms / 1000)
+    # Route the aws package's listing calls to the stand-in
+    aws.read.get_s3_client = lambda: stand_in
+    uri = 's3://benchmark-bucket/inputs/'
+
+    results = {'keys': len(keys), 'folders': args.folders, 'latency_ms': args.latency_ms}
+
+    stand_in.calls = 0
+    start = time.perf_counter()
+    legacy_objects = _legacy_list(stand_in, 'benchmark-bucket', 'inputs/')
+    results['legacy'] = {
+        'seconds': round(time.perf_counter() - start, 3),
+        'objects_found': len(legacy_objects),
+        'list_calls': stand_in.calls,
+    }
+
+    stand_in.calls = 0
+    start = time.perf_counter()
+    paginated_objects = aws.get_objects_at_s3_uri(uri)
+    results['paginated_serial'] = {
+        'seconds': round(time.perf_counter() - start, 3),
+        'objects_found': len(paginated_objects),
+        'list_calls': stand_in.calls,
+    }
+
+    stand_in.calls = 0
+    total_time, first_object_time, count = asyncio.run(_time_async_listing(uri))
+    results['paginated_parallel_async'] = {
+        'seconds': round(total_time, 3),
+        'seconds_to_first_object': round(first_object_time or 0, 3),
+        'objects_found': count,
+        'list_calls': stand_in.calls,
+    }
+
+    print(json.dumps(results, indent=2))
+
+
+def parse_args(args):
+    parser = argparse.ArgumentParser(
+        description='Benchmark S3 prefix listing strategies against a local stand-in with simulated latency')
+
+    parser.add_argument('--keys', type=int, default=100000, help='Total number of keys in the stand-in bucket.')
+    parser.add_argument('--folders', type=int, default=20, help='Number of folders to spread the keys across.')
+    parser.add_argument('--latency_ms', type=float, default=30, help='Simulated latency of each list call.')
+
+    return parser.parse_args(args)
@@ -0,0 +1,88 @@
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+import json
+import time
+
+import boto3
+
+import aws
+import utils
+
+
+def _legacy_get_s3_client():
+    # Previous behavior: reload config and build a fresh client for every call
+    config = utils.load_config()['aws']
+    if config.get('aws_use_iam_role'):
+        return boto3.client('s3')
+    credentials = {
+        key: config[key]
+        for key in ('aws_access_key_id', 'aws_secret_access_key', 'aws_session_token')
+        if config.get(key)
+    }
+    return boto3.client('s3', **credentials)
+
+
+def _time_client_lookups(get_client, count):
+    start = time.perf_counter()
+    for _ in range(count):
+        get_client()
+    return time.perf_counter() - start
+
+
+def _time_writes(get_client, bucket, prefix, count, threads, payload):
+    def write_one(i):
+        get_client().put_object(Bucket=bucket, Key=f'{prefix}/object_{i}.json', Body=payload)
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        list(executor.map(write_one, range(count)))
+    return time.perf_counter() - start
+
+
+def main(args):
+    config = utils.environment.load_config()
+    utils.setup_logger(**config['logger'])
+
+    results = {}
+
+    legacy_lookup_time = _time_client_lookups(_legacy_get_s3_client, args.lookups)
+    cached_lookup_time = _time_client_lookups(aws.get_s3_client, args.lookups)
+    results['client_lookups'] = {
+        'count': args.lookups,
+        'legacy_ms_per_call': round(legacy_lookup_time / args.lookups * 1000, 3),
+        'cached_ms_per_call': round(cached_lookup_time / args.lookups * 1000, 3),
+    }
+
+    if args.output_uri:
+        bucket, prefix = aws.parse_s3_uri(args.output_uri)
+        prefix = prefix.strip('/')
+        payload = json.dumps({'entity': {'relationship': ['target'] * 8}}).encode('utf-8')
+        legacy_write_time = _time_writes(
+            _legacy_get_s3_client, bucket, f'{prefix}/legacy', args.writes, args.threads, payload)
+        cached_write_time = _time_writes(
+            aws.get_s3_client, bucket, f'{prefix}/cached', args.writes, args.threads, payload)
+        results['small_object_writes'] = {
+            'count': args.writes,
+            'threads': args.threads,
+            'legacy_seconds': round(legacy_write_time, 3),
+            'cached_seconds': round(cached_write_time, 3),
+            'speedup': round(legacy_write_time / cached_write_time, 2) if cached_write_time else None,
+        }
+
+    print(json.dumps(results, indent=2))
+
+
+def parse_args(args):
+    parser = argparse.ArgumentParser(
+        description='Compare creating an S3 client per call against the cached, pooled client')
+
+    parser.add_argument(
+        '--output_uri',
+        default=None,
+        help='S3 prefix to write test objects under. Without it, only client lookup overhead is measured.'
+    )
+    parser.add_argument('--writes', type=int, default=500, help='Number of small objects to write per approach.')
+    parser.add_argument('--threads', type=int, default=16, help='Concurrent writers, as in a batch parse job.')
+    parser.add_argument('--lookups', type=int, default=200, help='Number of client lookups to time per approach.')
+
+    return parser.parse_args(args)
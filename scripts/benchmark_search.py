@@ -0,0 +1,55 @@
+import argparse
+import json
+import time
+
+import search
+import search_index
+
+
+def _time_runs(fn, iterations):
+    times = []
+    result = None
+    for _ in range(iterations):
+        start = time.perf_counter()
+        result = fn()
+        times.append(time.perf_counter() - start)
+    return min(times), result
+
+
+def main(args):
+    index = search_index.SearchIndex(args.search_index_file, args.papers_dir)
+    results = {'papers_indexed': index.doc_count(), 'queries': []}
+    try:
+        for query in args.queries:
+            index_time, index_matches = _time_runs(
+                lambda: search.search_docs_with_index(query, index), args.iterations)
+            query_result = {
+                'query': query,
+                'index': {'best_seconds': round(index_time, 4), 'matches': len(index_matches)},
+            }
+            if not args.skip_grep:
+                grep_time, grep_matches = _time_runs(
+                    lambda: search.search_docs(query, papers_dir=args.papers_dir), args.iterations)
+                query_result['grep'] = {'best_seconds': round(grep_time, 4), 'matches': len(grep_matches)}
+                query_result['speedup'] = round(grep_time / index_time, 1) if index_time else None
+            results['queries'].append(query_result)
+    finally:
+        index.close()
+    print(json.dumps(results, indent=2))
+
+
+def parse_args(args):
+    parser = argparse.ArgumentParser(
+        description='Time /search queries against the inverted index and the find/parallel/fgrep pipeline')
+
+    parser.add_argument('--papers_dir', required=True, help='Directory of .txt papers that was indexed.')
+    parser.add_argument('--search_index_file', required=True, help='Index built by build_search_index.')
+    parser.add_argument('--iterations', type=int, default=3, help='Number of timed runs; the best is reported.')
+    parser.add_argument(
+        '--skip_grep',
+        action='store_true',
+        help="Only time the index, e.g. on hosts without GNU parallel installed."
+    )
+    parser.add_argument('queries', nargs='+', help='Queries to run.')
+
+    return parser.parse_args(args)
@@ -0,0 +1,126 @@
+import argparse
+import json
+import time
+
+import tiktoken
+
+import aws
+import gpt
+
+
+def _legacy_get_token_length(text, model):
+    # Pre-caching behavior: look up the encoding on every call
+    if model.startswith('gpt-4o'):
+        encoding = tiktoken.get_encoding('cl100k_base')
+    else:
+        encoding = tiktoken.encoding_for_model(model)
+    return len(encoding.encode(text))
+
+
+def _legacy_split_paragraph_to_token_size(paragraph, token_limit, model):
+    encoding = gpt.get_encoding(model)
+    text_as_tokens = encoding.encode(paragraph)
+    text_chunks = []
+    chunk_size = token_limit - 10
+    while len(text_as_tokens) > token_limit:
+        text_chunks.append(encoding.decode(text_as_tokens[:chunk_size]))
+        text_as_tokens = text_as_tokens[chunk_size:]
+    text_chunks.append(encoding.decode(text_as_tokens))
+    return text_chunks
+
+
+def legacy_split_to_token_size(text, token_limit, model):
+    '''
+    Copy of the previous gpt.text.split_to_token_size, which re-tokenized the growing chunk on every merge attempt.
+    '''
+    text = gpt.normalize_line_endings(text)
+    paragraph_chunks = [p for p in text.split('\n\n') if p != '']
+
+    text_chunks = []
+    for chunk in paragraph_chunks:
+        if _legacy_get_token_length(chunk, model) < token_limit:
+            text_chunks.append(chunk + '\n\n')
+        else:
+            text_chunks.extend(_legacy_split_paragraph_to_token_size(chunk, token_limit, model))
+
+    rechunked_text = [text_chunks[0]]
+    i = 0
+    j = 1
+    while j < len(text_chunks):
+        if not rechunked_text[i].endswith('\n\n'):
+            rechunked_text.append(text_chunks[j])
+            i += 1
+            j += 1
+            continue
+        if (_legacy_get_token_length(rechunked_text[i], model)
+                + _legacy_get_token_length(text_chunks[j], model) < token_limit):
+            rechunked_text[i] = rechunked_text[i] + text_chunks[j]
+        else:
+            rechunked_text.append(text_chunks[j])
+            i += 1
+        j += 1
+    return rechunked_text
+
+
+def _load_input(input_file):
+    if aws.is_valid_s3_uri(input_file):
+        _, data = aws.read_file_from_s3(input_file)
+        return data
+    with open(input_file, 'r') as f:
+        return f.read()
+
+
+def _time_runs(fn, iterations):
+    times = []
+    result = None
+    for _ in range(iterations):
+        start = time.perf_counter()
+        result = fn()
+        times.append(time.perf_counter() - start)
+    return min(times), result
+
+
+def main(args):
+    text = _load_input(args.input_file) * args.repeat
+    token_limit = args.token_limit or gpt.parse.get_text_token_limit(args.model)
+
+    # Warm the encoder cache so both runs measure chunking rather than loading the BPE file
+    total_tokens = gpt.get_token_length(text, model=args.model)
+
+    legacy_time, legacy_chunks = _time_runs(
+        lambda: legacy_split_to_token_size(text, token_limit, args.model), args.iterations)
+    new_time, new_chunks = _time_runs(
+        lambda: gpt.split_to_token_size(text, token_limit, model=args.model), args.iterations)
+
+    # Running token totals can put a boundary one paragraph off where a chunk lands right at the limit
+    mismatched_chunks = sum(1 for legacy, new in zip(legacy_chunks, new_chunks) if legacy != new)
+    mismatched_chunks += abs(len(legacy_chunks) - len(new_chunks))
+
+    results = {
+        'input_chars': len(text),
+        'input_tokens': total_tokens,
+        'token_limit': token_limit,
+        'legacy': {'best_seconds': round(legacy_time, 4), 'chunks': len(legacy_chunks)},
+        'cached': {'best_seconds': round(new_time, 4), 'chunks': len(new_chunks)},
+        'speedup': round(legacy_time / new_time, 2) if new_time else None,
+        'same_boundaries': legacy_chunks == new_chunks,
+        'mismatched_chunks': mismatched_chunks,
+    }
+    print(json.dumps(results, indent=2))
+
+
+def parse_args(args):
+    parser = argparse.ArgumentParser(description='Benchmark token-aware text chunking on a large paper')
+
+    parser.add_argument('--input_file', required=True, help='Paper text to chunk. Can be a local path or an S3 URI.')
+    parser.add_argument('--model', default='gpt-3.5-turbo', help='GPT model whose tokenizer and limits to use.')
+    parser.add_argument(
+        '--token_limit',
+        type=int,
+        default=None,
+        help='Chunk size in tokens. Defaults to the parse input limit for --model.'
+    )
+    parser.add_argument('--repeat', type=int, default=1, help='Concatenate the input this many times.')
+    parser.add_argument('--iterations', type=int, default=3, help='Number of timed runs; the best is reported.')
+
+    return parser.parse_args(args)
@@ -0,0 +1,53 @@
+import argparse
+import time
+
+import search_index
+import utils
+
+
+def main(args):
+    config = utils.environment.load_config(cl_args=args)
+    utils.setup_logger(**config['logger'])
+    utils.log_msg('Logger initialized')
+
+    papers_dir = config.get('PAPERS_DIR', None)
+    index_file = config.get('SEARCH_INDEX_FILE', None)
+    if not papers_dir or not index_file:
+        utils.log_msg('Both PAPERS_DIR and SEARCH_INDEX_FILE must be set, via .env or commandline args')
+        return
+
+    index = search_index.SearchIndex(index_file, papers_dir)
+    try:
+        while True:
+            # Only new or changed papers are read, so re-running this after adding files is cheap
+            index.update(remove_missing=not args.keep_missing)
+            utils.log_msg(f'Search index at {index_file} now covers {index.doc_count():,} papers')
+            if not args.watch:
+                break
+            time.sleep(args.watch)
+    finally:
+        index.close()
+
+
+def parse_args(args):
+    parser = argparse.ArgumentParser(description='Build or incrementally update the /search inverted index')
+
+    parser.add_argument('--papers_dir', default=None, help='Directory of .txt papers to index. Overrides PAPERS_DIR.')
+    parser.add_argument(
+        '--search_index_file',
+        default=None,
+        help='Path of the SQLite index file to create or update. Overrides SEARCH_INDEX_FILE.'
+    )
+    parser.add_argument(
+        '--keep_missing',
+        action='store_true',
+        help='Keep index entries for papers that no longer exist on disk.'
+    )
+    parser.add_argument(
+        '--watch',
+        type=int,
+        default=None,
+        help='Keep running, updating the index again every this many seconds.'
+    )
+
+    return parser.parse_args(args)
@@ -76,12 +76,12 @@ def main(args):
     utils.setup_logger(name=thread_name, **config['logger'])
     log_msg('Logger initialized')
 
-    driver = neo.get_neo4j_driver(config['neo4j'])
+    driver = neo.get_shared_neo4j_driver(config['neo4j'])
 
     try:
         update_sources(driver)
     finally:
-        driver.close()
+        neo.close_shared_neo4j_drivers()
 
 
 def parse_args(args):
@@ -77,7 +77,7 @@ async def main(args):
     log_msg("Logger initialized")
 
     gpt.init_module(config)
-    driver = neo.get_neo4j_driver(config["neo4j"])
+    driver = neo.get_shared_neo4j_driver(config["neo4j"])
 
     try:
         entity_names = get_all_entity_names(driver)
@@ -98,7 +98,7 @@ async def main(args):
 
         log_msg("Done!")
     finally:
-        driver.close()
+        neo.close_shared_neo4j_drivers()
 
 
 def parse_args(args):
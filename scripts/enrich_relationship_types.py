@@ -165,7 +165,7 @@ async def main(args):
                 f"Recovered {len(name_type_pairs)} name/type pairs from previous run's log file."
             )
         else:
-            driver = neo.get_neo4j_driver(config["neo4j"])
+            driver = neo.get_shared_neo4j_driver(config["neo4j"])
             relationship_names = _get_all_relationship_names(driver)
             log_msg(f"Loaded {len(relationship_names)} relationships from Neo4j.")
 
@@ -186,13 +186,13 @@ async def main(args):
             _write_typings_to_file(name_type_pairs, args.output_file)
         else:
             log_msg("Updating relationship types in Neo4j...")
-            driver = neo.get_neo4j_driver(config["neo4j"])
+            driver = neo.get_shared_neo4j_driver(config["neo4j"])
             num_updated = _update_relationship_types(driver, name_type_pairs)
             log_msg(f"Set types on {num_updated} relationships.")
 
         log_msg("Done!")
     finally:
-        driver.close()
+        neo.close_shared_neo4j_drivers()
 
 
 def parse_args(args):
@@ -216,7 +216,7 @@ async def main(args):
 
     source_dates = load_source_dates(args.dates_file)
 
-    driver = neo.get_neo4j_driver(config['neo4j'])
+    driver = neo.get_shared_neo4j_driver(config['neo4j'])
 
     try:
         update_node_source_dates(driver, source_dates)
@@ -224,7 +224,7 @@ async def main(args):
 
         log_msg('Done!')
     finally:
-        driver.close()
+        neo.close_shared_neo4j_drivers()
 
 
 def parse_args(args):
@@ -142,7 +142,7 @@ async def main(args):
 
     sources_by_filename = load_source_strings(args.sources_dir)
 
-    driver = neo.get_neo4j_driver(config['neo4j'])
+    driver = neo.get_shared_neo4j_driver(config['neo4j'])
 
     try:
         update_node_sources(driver, sources_by_filename)
@@ -150,7 +150,7 @@ async def main(args):
 
         log_msg('Done!')
     finally:
-        driver.close()
+        neo.close_shared_neo4j_drivers()
 
 
 def parse_args(args):
@@ -1,10 +1,10 @@
 import argparse
 import asyncio
 
-from batch import BatchParseJob
+from batch import BatchParseJob, DEFAULT_MAX_OPEN_FILES, OUTPUT_FORMAT_FILES, OUTPUT_FORMATS, init_conversion_cache
 import gpt
 import utils
-from utils import log_msg
+from utils import doc_convert, log_msg
 
 
 def main(args):
@@ -13,25 +13,39 @@ def main(args):
     log_msg('Logger initialized')
 
     gpt.init_module(config)
+    init_conversion_cache(config)
 
-    parse_job = BatchParseJob(gpt_model=args.gpt_model, dry_run=args.dry_run)
-
-    asyncio.run(
-        parse_job.run(args.data_source, args.output_uri)
+    parse_job = BatchParseJob(
+        gpt_model=args.gpt_model,
+        dry_run=args.dry_run,
+        max_open_files=args.max_open_files,
+        output_format=args.output_format,
+        conversion_workers=args.conversion_workers,
+        conversion_timeout=args.conversion_timeout,
+        stream_completions=args.stream_completions,
     )
 
+    if args.resume:
+        asyncio.run(
+            parse_job.resume(args.resume)
+        )
+    else:
+        asyncio.run(
+            parse_job.run(args.data_source, args.output_uri)
+        )
+
 
 def parse_args(args):
     parser = argparse.ArgumentParser()
     parser.add_argument(
         '--data_source',
         default='s3://paper2graph-parse-inputs',
-        help="The URI for the text to be parsed, like an S3 bucket location."
+        help="The URI for the text to be parsed, like an S3 bucket location or a local directory."
     )
     parser.add_argument(
         '--output_uri',
         default='s3://paper2graph-parse-results',
-        help="The URI where output is saved, like an S3 bucket location."
+        help="The URI where output is saved, like an S3 bucket location or a local directory."
     )
     parser.add_argument(
         '--gpt_model',
@@ -44,5 +58,51 @@ def parse_args(args):
         default=False,
         help="The URI where output is saved, like an S3 bucket location."
     )
+    parser.add_argument(
+        '--resume',
+        default=None,
+        metavar='JOB_OUTPUT_URI',
+        help="Resume a previous job in its output folder, skipping chunks its manifest records as complete."
+    )
+    parser.add_argument(
+        '--parse_cache_uri',
+        default=None,
+        help="Cache parse results at this s3:// prefix or local SQLite file path and reuse them on re-runs."
+    )
+    parser.add_argument(
+        '--conversion_cache_uri',
+        default=None,
+        help="Cache text converted from documents at this s3:// prefix or local SQLite file path and reuse it on re-runs."
+    )
+    parser.add_argument(
+        '--max_open_files',
+        type=int,
+        default=DEFAULT_MAX_OPEN_FILES,
+        help="Max number of input files to fetch and parse at the same time."
+    )
+    parser.add_argument(
+        '--output_format',
+        choices=OUTPUT_FORMATS,
+        default=OUTPUT_FORMAT_FILES,
+        help="'files' writes a JSON and source text file per chunk; 'bundle' writes one gzipped JSONL file per input file."
+    )
+    parser.add_argument(
+        '--conversion_workers',
+        type=int,
+        default=doc_convert.DEFAULT_CONVERSION_WORKERS,
+        help="Number of worker processes converting PDFs and Office documents to text."
+    )
+    parser.add_argument(
+        '--conversion_timeout',
+        type=int,
+        default=doc_convert.DEFAULT_CONVERSION_TIMEOUT,
+        help="Seconds a single document may take to convert before it's skipped."
+    )
+    parser.add_argument(
+        '--stream_completions',
+        action="store_true",
+        default=False,
+        help="Stream GPT responses, keeping the entities received for chunks whose responses time out or are cut off."
+    )
 
     return parser.parse_args(args)
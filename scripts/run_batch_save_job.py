@@ -3,6 +3,8 @@ import asyncio
 
 import aws
 import batch
+import neo
+import resolve
 import utils
 
 
@@ -11,9 +13,19 @@ def main(args):
     utils.setup_logger(**config['logger'])
     utils.log_msg('Logger initialized')
 
-    asyncio.run(
-        batch.save_to_neo4j(args.data_source, config['neo4j'])
-    )
+    resolve.init_entity_resolution(config)
+
+    try:
+        asyncio.run(
+            batch.save_to_neo4j(
+                args.data_source,
+                config['neo4j'],
+                bulk_write=args.bulk_write,
+                bulk_batch_size=args.bulk_batch_size,
+            )
+        )
+    finally:
+        neo.close_shared_neo4j_drivers()
 
 
 def parse_args(args):
@@ -22,7 +34,24 @@ def parse_args(args):
     parser.add_argument(
         '--data_source',
         default='s3://paper2graph-parse-results',
-        help="The URI for the data to be ingested, like an S3 bucket location."
+        help="The URI for the data to be ingested, like an S3 bucket location or a local directory."
+    )
+    parser.add_argument(
+        '--bulk_write',
+        action='store_true',
+        default=False,
+        help="Collect each output file's entities and relationships and write them with batched UNWIND queries."
+    )
+    parser.add_argument(
+        '--bulk_batch_size',
+        type=int,
+        default=neo.DEFAULT_BULK_BATCH_SIZE,
+        help='Number of rows to write per transaction when using --bulk_write.'
+    )
+    parser.add_argument(
+        '--entity_alias_db',
+        default=None,
+        help="Resolve entity names against the alias table in this local SQLite file (and record new aliases in it)."
     )
     utils.add_neo_credential_override_args(parser)
 
@@ -1,5 +1,4 @@
 import asyncio
-import csv
 import json
 import os
 import subprocess
@@ -9,9 +8,14 @@ import tempfile
 
 import aws
 import gdrive
+from search_index import SearchIndex
+from search_metadata import PaperMetadataStore
 from utils import log_msg, log_debug
 
 
+# Where uploaded batch sets are stored unless BATCH_SET_BASE_URI is configured (can also be a file:// location)
+DEFAULT_BATCH_SET_BASE_URI = "s3://paper2graph-parse-inputs/web-search-sets"
+
 def search_docs(query, papers_dir=None):
     find_cmd = ["find", papers_dir, "-type", "f", "-name", "*.txt"]
     grep_cmd = ["parallel", "-k", "-j8", "-m", f'LC_ALL=C fgrep -Hic "{query}" {{}}']
@@ -50,22 +54,45 @@ def search_docs(query, papers_dir=None):
     return structured_result
 
 
-def load_metadata_as_dict(metadata_file):
-    log_msg(f"Loading paper metadata from {metadata_file}")
-    paper_metadata = {}
-    with open(metadata_file, "r") as f:
-        reader = csv.DictReader(f)
-        for row in reader:
-            paper_metadata[row["pmc_id"]] = {
-                "title": row.get("article_title", None),
-                "article_type": row.get("article_type", None),
-                "doi": row.get("doi", None),
-            }
-    return paper_metadata
+def open_search_index(index_file, papers_dir):
+    """
+    Open the inverted index built by scripts/build_search_index.py, or return None if it doesn't exist yet.
+    """
+    if not index_file or not os.path.isfile(index_file):
+        return None
+    search_index = SearchIndex(index_file, papers_dir)
+    log_msg(f"Opened search index at {index_file} with {search_index.doc_count():,} papers")
+    return search_index
+
+
+def search_docs_with_index(query, search_index):
+    search_st = time.time()
+    paths = search_index.search(query)
+    search_et = time.time()
+    log_msg(
+        f"Index search for {query} matched {len(paths)} papers in {(search_et - search_st) * 1000:.1f} ms"
+    )
+
+    return [
+        {
+            "pmc_id": os.path.splitext(os.path.basename(path))[0],
+            "path": os.path.join(search_index.papers_dir, path),
+        }
+        for path in paths
+    ]
 
 
-def add_metadata_to_docs_list(docs, metadata_file):
-    metadata = load_metadata_as_dict(metadata_file)
+def open_metadata_store(metadata_file):
+    """
+    Open the pmc_id-keyed store for the metadata CSV, building it first if it's missing or older than the CSV.
+    """
+    if not metadata_file:
+        return None
+    return PaperMetadataStore(metadata_file).load()
+
+
+def add_metadata_to_docs_list(docs, metadata_store):
+    metadata = metadata_store.get_many(doc["pmc_id"] for doc in docs)
     for doc in docs:
         doc_md = metadata.get(doc["pmc_id"], None)
         if not doc_md:
@@ -77,19 +104,24 @@ def add_metadata_to_docs_list(docs, metadata_file):
     return docs
 
 
-async def asearch_docs(query, papers_dir=None, metadata_file=None):
+async def asearch_docs(query, papers_dir=None, metadata_store=None, search_index=None):
     log_msg(f'Running async search for "{query}" in {papers_dir}')
     search_st = time.time()
-    search_results = await asyncio.to_thread(
-        lambda: search_docs(query, papers_dir=papers_dir)
-    )
+    if search_index:
+        search_results = await asyncio.to_thread(
+            lambda: search_docs_with_index(query, search_index)
+        )
+    else:
+        search_results = await asyncio.to_thread(
+            lambda: search_docs(query, papers_dir=papers_dir)
+        )
     search_et = time.time()
     log_msg(f"search_docs call completed in {(search_et - search_st):.2f} seconds")
 
-    if metadata_file:
+    if metadata_store:
         metadata_st = time.time()
         search_results = await asyncio.to_thread(
-            lambda: add_metadata_to_docs_list(search_results, metadata_file)
+            lambda: add_metadata_to_docs_list(search_results, metadata_store)
         )
         metadata_et = time.time()
         log_msg(
@@ -117,12 +149,12 @@ async def _process_single_gdrive_file(
         with open(temp_file_path, "w", encoding="utf-8") as f:
             f.write(file["content"])
 
-        # Upload to S3
+        # Upload to batch set storage
         new_file_uri = new_batch_set_uri + "/" + file_name
         log_msg(
             f"Uploading file {file_name} to {new_file_uri} ({file_index+1}/{total_files})"
         )
-        await asyncio.to_thread(aws.upload_to_s3, new_file_uri, temp_file_path)
+        await asyncio.to_thread(aws.upload_file, new_file_uri, temp_file_path)
         return {"success": True, "file_id": file_id}
     except Exception as e:
         log_msg(f"Error processing file {file_id}: {e}")
@@ -142,7 +174,7 @@ async def _process_single_local_file(
         log_msg(
             f"Uploading file {file_name} to {new_file_uri} ({file_index+1}/{total_files})"
         )
-        await asyncio.to_thread(aws.upload_to_s3, new_file_uri, file_path)
+        await asyncio.to_thread(aws.upload_file, new_file_uri, file_path)
         return {"success": True, "file_path": file_path}
     except Exception as e:
         log_msg(f"Error processing file {file_path}: {e}")
@@ -150,7 +182,7 @@ async def _process_single_local_file(
 
 
 async def upload_batch_set(
-    files, gdrive_creds=None, base_dir="s3://paper2graph-parse-inputs/web-search-sets"
+    files, gdrive_creds=None, base_dir=DEFAULT_BATCH_SET_BASE_URI
 ):
     # Remove any potential duplicates
     files = list(set(files))
@@ -214,7 +246,7 @@ async def upload_batch_set(
 
 
 async def aupload_batch_set(
-    files, gdrive_creds=None, base_dir="s3://paper2graph-parse-inputs/web-search-sets"
+    files, gdrive_creds=None, base_dir=DEFAULT_BATCH_SET_BASE_URI
 ):
     log_msg(f"Running async upload_batch_set with {len(files)} files")
     result = await upload_batch_set(files, gdrive_creds=gdrive_creds, base_dir=base_dir)
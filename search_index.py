@@ -0,0 +1,349 @@
+"""
+On-disk inverted index over the .txt papers in PAPERS_DIR, used by search.py instead of scanning every file per query.
+
+The index is a SQLite file holding, for every term, the documents it appears in and the token positions it appears at
+in each one, so both single-term and phrase queries can be answered from postings alone.
+"""
+
+import array
+import os
+import re
+import sqlite3
+import threading
+import time
+
+from utils import log_msg, log_debug
+
+
+TOKEN_PATTERN = re.compile(r"\w+")
+PHRASE_PATTERN = re.compile(r'"([^"]*)"')
+# Number of documents to index between commits
+INDEX_COMMIT_INTERVAL = 500
+# SQLite limits the number of bound parameters per statement
+MAX_QUERY_PARAMS = 900
+
+
+def tokenize_text(text):
+    """
+    Split text into lowercase word tokens. Token positions in the returned list are what phrase queries match on.
+    """
+    return TOKEN_PATTERN.findall(text.lower())
+
+
+def parse_search_query(query):
+    """
+    Split a query into a list of phrases, each a list of terms that must appear consecutively.
+
+    Quoted sections are phrases and any other words are required on their own. A query with no quotes is treated as
+    one phrase, matching the old fixed-string grep search.
+    """
+    if '"' not in query:
+        phrase = tokenize_text(query)
+        return [phrase] if phrase else []
+
+    phrases = [tokenize_text(p) for p in PHRASE_PATTERN.findall(query)]
+    remainder = PHRASE_PATTERN.sub(" ", query).replace('"', " ")
+    phrases.extend([term] for term in tokenize_text(remainder))
+    return [p for p in phrases if p]
+
+
+def _encode_positions(positions):
+    return array.array("I", positions).tobytes()
+
+
+def _decode_positions(data):
+    positions = array.array("I")
+    positions.frombytes(data)
+    return positions
+
+
+def _batched(items, batch_size):
+    items = list(items)
+    for i in range(0, len(items), batch_size):
+        yield items[i:i + batch_size]
+
+
+class SearchIndex:
+    """
+    Inverted index of the .txt files under a papers directory, stored in a SQLite file.
+
+    Document paths are stored relative to papers_dir so an index can be built on one machine and served from another.
+    """
+
+    def __init__(self, index_path, papers_dir):
+        if os.path.dirname(index_path):
+            os.makedirs(os.path.dirname(index_path), exist_ok=True)
+        self.index_path = index_path
+        self.papers_dir = papers_dir
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(index_path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS docs ("
+            "  doc_id INTEGER PRIMARY KEY,"
+            "  path TEXT UNIQUE NOT NULL,"
+            "  mtime REAL NOT NULL,"
+            "  size INTEGER NOT NULL"
+            ")"
+        )
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS terms ("
+            "  term_id INTEGER PRIMARY KEY,"
+            "  term TEXT UNIQUE NOT NULL,"
+            "  doc_freq INTEGER NOT NULL DEFAULT 0"
+            ")"
+        )
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS postings ("
+            "  term_id INTEGER NOT NULL,"
+            "  doc_id INTEGER NOT NULL,"
+            "  positions BLOB NOT NULL,"
+            "  PRIMARY KEY (term_id, doc_id)"
+            ") WITHOUT ROWID"
+        )
+        # Needed to remove a document's postings when it changes or is deleted
+        self._conn.execute(
+            "CREATE INDEX IF NOT EXISTS postings_doc ON postings (doc_id)"
+        )
+        self._conn.commit()
+        self._term_ids = None
+
+    def __repr__(self):
+        return f"SearchIndex({self.index_path!r}, {self.papers_dir!r})"
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+    def doc_count(self):
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM docs").fetchone()[0]
+
+    # ********
+    # Building
+    # ********
+
+    def _load_term_ids(self):
+        if self._term_ids is None:
+            self._term_ids = dict(self._conn.execute("SELECT term, term_id FROM terms"))
+        return self._term_ids
+
+    def _get_or_create_term_ids(self, terms):
+        term_ids = self._load_term_ids()
+        new_terms = [(t,) for t in terms if t not in term_ids]
+        if new_terms:
+            self._conn.executemany(
+                "INSERT OR IGNORE INTO terms (term, doc_freq) VALUES (?, 0)", new_terms
+            )
+            for batch in _batched((t for (t,) in new_terms), MAX_QUERY_PARAMS):
+                placeholders = ",".join("?" * len(batch))
+                term_ids.update(
+                    self._conn.execute(
+                        f"SELECT term, term_id FROM terms WHERE term IN ({placeholders})",
+                        batch,
+                    )
+                )
+        return term_ids
+
+    def _remove_doc(self, doc_id):
+        term_ids = [
+            row[0]
+            for row in self._conn.execute(
+                "SELECT term_id FROM postings WHERE doc_id = ?", (doc_id,)
+            )
+        ]
+        self._conn.executemany(
+            "UPDATE terms SET doc_freq = doc_freq - 1 WHERE term_id = ?",
+            [(t,) for t in term_ids],
+        )
+        self._conn.execute("DELETE FROM postings WHERE doc_id = ?", (doc_id,))
+        self._conn.execute("DELETE FROM docs WHERE doc_id = ?", (doc_id,))
+
+    def _add_doc(self, rel_path, text, mtime, size):
+        cursor = self._conn.execute(
+            "INSERT INTO docs (path, mtime, size) VALUES (?, ?, ?)",
+            (rel_path, mtime, size),
+        )
+        doc_id = cursor.lastrowid
+
+        positions_by_term = {}
+        for position, term in enumerate(tokenize_text(text)):
+            positions_by_term.setdefault(term, []).append(position)
+
+        term_ids = self._get_or_create_term_ids(positions_by_term.keys())
+        self._conn.executemany(
+            "INSERT INTO postings (term_id, doc_id, positions) VALUES (?, ?, ?)",
+            [
+                (term_ids[term], doc_id, _encode_positions(positions))
+                for term, positions in positions_by_term.items()
+            ],
+        )
+        self._conn.executemany(
+            "UPDATE terms SET doc_freq = doc_freq + 1 WHERE term_id = ?",
+            [(term_ids[term],) for term in positions_by_term],
+        )
+
+    def _list_paper_files(self):
+        for dirpath, _, files in os.walk(self.papers_dir):
+            for file in files:
+                if os.path.splitext(file)[1] != ".txt":
+                    continue
+                full_path = os.path.join(dirpath, file)
+                yield os.path.relpath(full_path, self.papers_dir), full_path
+
+    def update(self, remove_missing=True):
+        """
+        Bring the index up to date with papers_dir, indexing only files that are new or changed since the last update.
+
+        Returns a dict with counts of added, updated, removed and unchanged documents.
+        """
+        start_time = time.time()
+        stats = {"added": 0, "updated": 0, "removed": 0, "unchanged": 0}
+        with self._lock:
+            known_docs = {
+                path: (doc_id, mtime, size)
+                for doc_id, path, mtime, size in self._conn.execute(
+                    "SELECT doc_id, path, mtime, size FROM docs"
+                )
+            }
+            seen = set()
+            pending_commit = 0
+            for rel_path, full_path in self._list_paper_files():
+                seen.add(rel_path)
+                try:
+                    file_stat = os.stat(full_path)
+                except OSError as err:
+                    log_msg(f"Unable to stat {full_path}, skipping: {err}")
+                    continue
+
+                known = known_docs.get(rel_path)
+                if known and known[1] == file_stat.st_mtime and known[2] == file_stat.st_size:
+                    stats["unchanged"] += 1
+                    continue
+
+                try:
+                    with open(full_path, "r", encoding="utf-8", errors="replace") as f:
+                        text = f.read()
+                except OSError as err:
+                    log_msg(f"Unable to read {full_path}, skipping: {err}")
+                    continue
+
+                if known:
+                    self._remove_doc(known[0])
+                    stats["updated"] += 1
+                else:
+                    stats["added"] += 1
+                self._add_doc(rel_path, text, file_stat.st_mtime, file_stat.st_size)
+
+                pending_commit += 1
+                if pending_commit >= INDEX_COMMIT_INTERVAL:
+                    self._conn.commit()
+                    pending_commit = 0
+                    log_msg(f"Indexed {stats['added'] + stats['updated']:,} papers so far...")
+
+            if remove_missing:
+                for rel_path, (doc_id, _, _) in known_docs.items():
+                    if rel_path not in seen:
+                        self._remove_doc(doc_id)
+                        stats["removed"] += 1
+            self._conn.commit()
+
+        time_spent = time.time() - start_time
+        log_msg(f"Search index update finished in {time_spent:.2f} seconds: {stats}")
+        return stats
+
+    # *********
+    # Searching
+    # *********
+
+    def _lookup_terms(self, terms):
+        placeholders = ",".join("?" * len(terms))
+        return {
+            term: (term_id, doc_freq)
+            for term_id, term, doc_freq in self._conn.execute(
+                f"SELECT term_id, term, doc_freq FROM terms WHERE term IN ({placeholders})",
+                list(terms),
+            )
+        }
+
+    def _fetch_postings(self, term_id, doc_ids=None):
+        if doc_ids is None:
+            return dict(
+                self._conn.execute(
+                    "SELECT doc_id, positions FROM postings WHERE term_id = ?",
+                    (term_id,),
+                )
+            )
+        postings = {}
+        for batch in _batched(doc_ids, MAX_QUERY_PARAMS):
+            placeholders = ",".join("?" * len(batch))
+            postings.update(
+                self._conn.execute(
+                    "SELECT doc_id, positions FROM postings "
+                    f"WHERE term_id = ? AND doc_id IN ({placeholders})",
+                    [term_id, *batch],
+                )
+            )
+        return postings
+
+    @staticmethod
+    def _phrase_matches(positions_by_offset):
+        # positions_by_offset[i] holds the positions of the phrase's i-th term in one document
+        starts = set(_decode_positions(positions_by_offset[0]))
+        for offset, data in enumerate(positions_by_offset[1:], start=1):
+            starts &= {p - offset for p in _decode_positions(data)}
+            if not starts:
+                return False
+        return True
+
+    def _search_locked(self, phrases):
+        all_terms = {term for phrase in phrases for term in phrase}
+        term_info = self._lookup_terms(all_terms)
+        if len(term_info) < len(all_terms):
+            # Some term doesn't appear anywhere, so nothing can match
+            return []
+
+        # Visit terms from rarest to most common so the candidate set shrinks as fast as possible
+        ordered_terms = sorted(all_terms, key=lambda t: term_info[t][1])
+        candidates = None
+        postings_by_term = {}
+        for term in ordered_terms:
+            postings = self._fetch_postings(term_info[term][0], candidates)
+            postings_by_term[term] = postings
+            candidates = postings.keys() if candidates is None else candidates & postings.keys()
+            candidates = set(candidates)
+            if not candidates:
+                return []
+
+        matching_doc_ids = [
+            doc_id
+            for doc_id in candidates
+            if all(
+                len(phrase) == 1
+                or self._phrase_matches([postings_by_term[t][doc_id] for t in phrase])
+                for phrase in phrases
+            )
+        ]
+
+        paths = []
+        for batch in _batched(matching_doc_ids, MAX_QUERY_PARAMS):
+            placeholders = ",".join("?" * len(batch))
+            paths.extend(
+                row[0]
+                for row in self._conn.execute(
+                    f"SELECT path FROM docs WHERE doc_id IN ({placeholders})", batch
+                )
+            )
+        return sorted(paths)
+
+    def search(self, query):
+        """
+        Returns the paths (relative to papers_dir) of all documents matching the query.
+        """
+        phrases = parse_search_query(query)
+        if not phrases:
+            return []
+        with self._lock:
+            paths = self._search_locked(phrases)
+        log_debug(f"Index search for {phrases} matched {len(paths)} documents")
+        return paths
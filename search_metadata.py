@@ -0,0 +1,146 @@
+"""
+Paper metadata for /search results, stored in SQLite keyed by pmc_id so hits can be looked up without re-reading the
+PAPERS_METADATA_FILE CSV.
+"""
+
+import csv
+import os
+import sqlite3
+import threading
+import time
+
+from utils import log_msg
+
+
+METADATA_FIELDS = {
+    # store column -> CSV column written by scripts/extract_article_metadata_from_xml.py
+    "title": "article_title",
+    "article_type": "article_type",
+    "doi": "doi",
+}
+# Rows to insert per executemany call while building the store
+BUILD_BATCH_SIZE = 10000
+# SQLite limits the number of bound parameters per statement
+MAX_QUERY_PARAMS = 900
+
+
+def get_default_store_path(metadata_file):
+    return f"{metadata_file}.sqlite"
+
+
+def build_metadata_store(metadata_file, store_path):
+    """
+    Build a metadata store from the CSV at metadata_file, replacing any existing store at store_path.
+    """
+    log_msg(f"Building paper metadata store at {store_path} from {metadata_file}")
+    start_time = time.time()
+    # Build into a temp file and swap it in so readers never see a half-built store
+    temp_path = f"{store_path}.building"
+    if os.path.exists(temp_path):
+        os.remove(temp_path)
+
+    columns = list(METADATA_FIELDS.keys())
+    conn = sqlite3.connect(temp_path)
+    row_count = 0
+    try:
+        conn.execute(
+            "CREATE TABLE metadata (pmc_id TEXT PRIMARY KEY, "
+            + ", ".join(f"{c} TEXT" for c in columns)
+            + ") WITHOUT ROWID"
+        )
+        insert_query = (
+            f"INSERT OR REPLACE INTO metadata (pmc_id, {', '.join(columns)}) "
+            f"VALUES ({', '.join('?' * (len(columns) + 1))})"
+        )
+        with open(metadata_file, "r") as f:
+            reader = csv.DictReader(f)
+            batch = []
+            for row in reader:
+                batch.append(
+                    (row["pmc_id"], *(row.get(METADATA_FIELDS[c], None) for c in columns))
+                )
+                if len(batch) >= BUILD_BATCH_SIZE:
+                    conn.executemany(insert_query, batch)
+                    row_count += len(batch)
+                    batch = []
+            conn.executemany(insert_query, batch)
+            row_count += len(batch)
+        conn.commit()
+    finally:
+        conn.close()
+    os.replace(temp_path, store_path)
+
+    log_msg(
+        f"Built metadata store with {row_count:,} papers in {(time.time() - start_time):.2f} seconds"
+    )
+
+
+class PaperMetadataStore:
+    """
+    Read-only lookups of paper metadata by pmc_id.
+
+    The SQLite store is built from the CSV the first time it's needed, and rebuilt whenever the CSV is newer than it.
+    """
+
+    def __init__(self, metadata_file, store_path=None):
+        self.metadata_file = metadata_file
+        self.store_path = store_path or get_default_store_path(metadata_file)
+        self._lock = threading.Lock()
+        self._conn = None
+
+    def __repr__(self):
+        return f"PaperMetadataStore({self.store_path!r})"
+
+    def _is_stale(self):
+        if not os.path.isfile(self.store_path):
+            return True
+        if not os.path.isfile(self.metadata_file):
+            # Nothing to rebuild from; use the store we have
+            return False
+        return os.path.getmtime(self.metadata_file) > os.path.getmtime(self.store_path)
+
+    def _get_conn(self):
+        # Checking staleness is just two stat calls, so do it per lookup to pick up a regenerated CSV
+        if self._is_stale():
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+            build_metadata_store(self.metadata_file, self.store_path)
+        if self._conn is None:
+            self._conn = sqlite3.connect(
+                f"file:{self.store_path}?mode=ro", uri=True, check_same_thread=False
+            )
+        return self._conn
+
+    def load(self):
+        """
+        Open the store, building it first if needed. Called at startup so the first search doesn't pay for it.
+        """
+        with self._lock:
+            self._get_conn()
+        return self
+
+    def close(self):
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+    def get_many(self, pmc_ids):
+        """
+        Returns a dict of pmc_id -> metadata dict for every given pmc_id found in the store.
+        """
+        columns = list(METADATA_FIELDS.keys())
+        pmc_ids = list(set(pmc_ids))
+        found = {}
+        with self._lock:
+            conn = self._get_conn()
+            for i in range(0, len(pmc_ids), MAX_QUERY_PARAMS):
+                batch = pmc_ids[i:i + MAX_QUERY_PARAMS]
+                placeholders = ",".join("?" * len(batch))
+                for row in conn.execute(
+                    f"SELECT pmc_id, {', '.join(columns)} FROM metadata WHERE pmc_id IN ({placeholders})",
+                    batch,
+                ):
+                    found[row[0]] = dict(zip(columns, row[1:]))
+        return found
@@ -52,25 +52,58 @@
     }
 
 
+    function renderStreamedResults(resultsByChunk) {
+        // Show results in source order, skipping chunks that didn't produce usable JSON
+        const output = Object.keys(resultsByChunk)
+            .map(Number)
+            .sort((a, b) => a - b)
+            .map((chunkIndex) => resultsByChunk[chunkIndex])
+            .filter((result) => result !== null);
+        translateOutput.value = JSON.stringify(output, null, 2);
+    }
+
     async function handleRawParseClick() {
         translateErrorMsg.style.display = 'none';
+        translateOutput.value = '';
         showSpinnerForTranslate();
-
+        const body = buildBodyForTranslate();
+        body['stream'] = 'ndjson';
         const response = await fetch('raw-parse', {
             method: 'POST',
             mode: 'cors',
             headers: {
                 "Content-Type": "application/json",
             },
-            body: JSON.stringify(buildBodyForTranslate())
+            body: JSON.stringify(body)
         });
 
         try {
-            const parsedResponse = await response.json();
-            console.log('Parsed response json:', parsedResponse);
-
-            const output = parsedResponse.translation;
-            translateOutput.value = JSON.stringify(output, null, 2);
+            const reader = response.body.getReader();
+            const decoder = new TextDecoder();
+            const resultsByChunk = {};
+            let buffered = '';
+            while (true) {
+                const { done, value } = await reader.read();
+                buffered += decoder.decode(value ?? new Uint8Array(), { stream: !done });
+                const lines = buffered.split('\n');
+                // Last piece may be an incomplete line; keep it for the next read
+                buffered = done ? '' : lines.pop();
+                for (const line of lines) {
+                    // Blank lines are heartbeats
+                    if (!line.trim()) {
+                        continue;
+                    }
+                    const record = JSON.parse(line);
+                    if (record.event === "chunk") {
+                        console.log(`Received chunk ${record.chunk_index} (chars ${record.source_start}-${record.source_end})`);
+                        resultsByChunk[record.chunk_index] = record.result;
+                        renderStreamedResults(resultsByChunk);
+                    }
+                }
+                if (done) {
+                    break;
+                }
+            }
 
             hideSpinnerForTranslate();
 
@@ -6,7 +6,7 @@ import asyncio
 import json
 
 from gpt import get_max_requests_per_minute
-from utils import log_msg
+from utils import json_codec, log_msg
 
 
 async def create_and_run_tasks(task_inputs, work_fn, task_label, max_simul_tasks=8):
@@ -92,11 +92,16 @@ async def split_and_run_tasks_with_heartbeat(task_inputs, work_fn, task_label):
     log_msg("All parsing complete")
 
     result = []
-    for result_str in results:
+    for task_result in results:
+        if isinstance(task_result, dict):
+            # Already decoded (e.g. parse results), so there's no need to round-trip them through JSON
+            if task_result:
+                result.append(task_result)
+            continue
         try:
-            result.append(json.loads(result_str))
+            result.append(json_codec.loads(task_result))
         except json.decoder.JSONDecodeError:
             # Some of these won't have been recognizable JSON; skip them
             continue
 
-    yield json.dumps({"translation": result}, indent=2)
+    yield json_codec.dumps({"translation": result}, indent=True)
@@ -2,12 +2,42 @@
 Utilities for converting various document formats to text.
 """
 
+import asyncio
+from concurrent.futures import ProcessPoolExecutor
+import os
+import signal
+import tempfile
+
+import markitdown
 from markitdown import MarkItDown
 from utils import log_msg
 
+# Bump when conversion output changes in a way the MarkItDown version doesn't capture, to invalidate cached text
+CONVERSION_FORMAT_VERSION = 1
+
+# Default number of worker processes converting documents: conversion is CPU-bound, so one per core less one for the
+# event loop
+DEFAULT_CONVERSION_WORKERS = max(1, (os.cpu_count() or 2) - 1)
+# Seconds a single document may take to convert before it's abandoned
+DEFAULT_CONVERSION_TIMEOUT = 300
+# Extra seconds the event loop waits past the timeout, in case the worker can't interrupt the converter itself
+CONVERSION_TIMEOUT_GRACE = 30
+
 _md_converter = None
 
 
+class ConversionTimeoutError(Exception):
+    pass
+
+
+def get_converter_version() -> str:
+    """
+    Identifies the converter producing text, so cached conversions from a different version aren't reused.
+    """
+    markitdown_version = getattr(markitdown, "__version__", "unknown")
+    return f"markitdown-{markitdown_version}/{CONVERSION_FORMAT_VERSION}"
+
+
 def init_converter():
     """Initialize the MarkItDown converter."""
     global _md_converter
@@ -27,3 +57,70 @@ def convert_to_text(file_path: str) -> str:
     except Exception as e:
         log_msg(f"Error converting file {file_path}: {e}")
         raise
+
+
+def _raise_conversion_timeout(signum, frame):
+    raise ConversionTimeoutError("Document conversion timed out")
+
+
+def _convert_bytes_to_text(data: bytes, file_name: str, timeout: int) -> str:
+    """
+    Worker process entry point: convert a document's raw bytes to text, giving up after timeout seconds.
+    """
+    # MarkItDown picks a converter by file extension, so keep it on the temp file
+    with tempfile.NamedTemporaryFile(suffix=os.path.splitext(file_name)[1], delete=False) as temp_file:
+        temp_file.write(data)
+        temp_path = temp_file.name
+
+    use_alarm = timeout and hasattr(signal, "SIGALRM")
+    if use_alarm:
+        # Tasks run on the worker's main thread, so an alarm can interrupt a converter that's stuck
+        previous_handler = signal.signal(signal.SIGALRM, _raise_conversion_timeout)
+        signal.alarm(int(timeout))
+    try:
+        return convert_to_text(temp_path)
+    finally:
+        if use_alarm:
+            signal.alarm(0)
+            signal.signal(signal.SIGALRM, previous_handler)
+        os.unlink(temp_path)
+
+
+class DocumentConversionPool:
+    """
+    Converts documents to text in a pool of worker processes, each with its own warm MarkItDown instance.
+
+    Conversion is CPU-bound, so running it in other processes keeps it from holding up the event loop (and GPT
+    requests in flight) while several documents convert in parallel.
+    """
+
+    def __init__(self, max_workers=DEFAULT_CONVERSION_WORKERS, timeout=DEFAULT_CONVERSION_TIMEOUT):
+        self.max_workers = max(1, int(max_workers or DEFAULT_CONVERSION_WORKERS))
+        self.timeout = timeout
+        self._executor = None
+
+    def _get_executor(self):
+        if self._executor is None:
+            self._executor = ProcessPoolExecutor(max_workers=self.max_workers, initializer=init_converter)
+        return self._executor
+
+    async def aconvert(self, data: bytes, file_name: str) -> str:
+        """
+        Convert a document's raw bytes to text. Raises ConversionTimeoutError if it takes longer than the timeout.
+        """
+        loop = asyncio.get_running_loop()
+        future = loop.run_in_executor(
+            self._get_executor(), _convert_bytes_to_text, data, file_name, self.timeout
+        )
+        if not self.timeout:
+            return await future
+        try:
+            return await asyncio.wait_for(future, timeout=self.timeout + CONVERSION_TIMEOUT_GRACE)
+        except asyncio.TimeoutError:
+            raise ConversionTimeoutError(f"Converting {file_name} took more than {self.timeout} seconds")
+
+    def shutdown(self):
+        if self._executor is not None:
+            # Don't wait on a stuck conversion; queued ones are cancelled
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
@@ -5,6 +5,25 @@ from dotenv import dotenv_values
 from .logging import log_msg
 
 
+_dotenv_cache = {}
+
+
+def _load_dotenv_values(path='.env'):
+    '''
+    Read values from a .env file, re-parsing it only when the file has changed since the last read.
+    '''
+    full_path = os.path.abspath(path)
+    try:
+        mtime = os.path.getmtime(full_path)
+    except OSError:
+        mtime = None
+    cached = _dotenv_cache.get(full_path)
+    if cached is None or cached[0] != mtime:
+        cached = (mtime, dotenv_values(full_path) if mtime is not None else {})
+        _dotenv_cache[full_path] = cached
+    return cached[1]
+
+
 def load_config(cl_args=None):
     if cl_args:
         # Convert commandline args to uppercase to match the format of environment variables
@@ -13,7 +32,7 @@ def load_config(cl_args=None):
         cl_args = {}
 
     config_vars = {
-        **dotenv_values('.env'),  # Use values from local .env file as base, if available
+        **_load_dotenv_values('.env'),  # Use values from local .env file as base, if available
         **os.environ,  # Override values loaded from file with those set in shell (if any)
         **cl_args,  # Override values from both file and shell with those passed in as commandline args
     }
@@ -33,13 +52,15 @@ def load_config(cl_args=None):
         'aws_access_key_id': config_vars.pop('AWS_ACCESS_KEY_ID', None),
         'aws_secret_access_key': config_vars.pop('AWS_SECRET_ACCESS_KEY', None),
         'aws_session_token': config_vars.pop('AWS_SESSION_TOKEN', None),
+        'max_pool_connections': config_vars.pop('AWS_MAX_POOL_CONNECTIONS', None),
     }
     config_vars['aws'] = aws_config
 
     neo_config = {
         'uri': config_vars.pop('NEO_URI', None),
         'user': config_vars.pop('NEO_USER', None),
-        'password': config_vars.pop('NEO_PASS', None)
+        'password': config_vars.pop('NEO_PASS', None),
+        'max_pool_size': config_vars.pop('NEO_MAX_POOL_SIZE', None),
     }
     config_vars['neo4j'] = neo_config
 
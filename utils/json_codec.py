@@ -0,0 +1,32 @@
+'''
+JSON encoding and decoding for parse results, using orjson when it's installed and the standard library otherwise.
+
+Both loads() implementations raise json.JSONDecodeError (orjson's error subclasses it) on invalid input.
+'''
+import json
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+HAS_FAST_JSON = orjson is not None
+
+
+def loads(data):
+    '''
+    Decode JSON from a str or bytes.
+    '''
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+def dumps(obj, indent=False):
+    '''
+    Encode obj as a JSON str, indented by 2 spaces if indent is set.
+    '''
+    if orjson is not None:
+        return orjson.dumps(obj, option=orjson.OPT_INDENT_2 if indent else 0).decode('utf-8')
+    return json.dumps(obj, indent=2 if indent else None)